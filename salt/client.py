@@ -29,9 +29,7 @@ The data structure needs to be:
 # This means that the primary client to build is, the LocalClient
 
 import os
-import re
 import sys
-import glob
 import time
 import getpass
 
@@ -40,7 +38,9 @@ import zmq
 
 # Import salt modules
 import salt.config
+import salt.crypt
 import salt.payload
+import salt.jobcache
 import salt.utils
 import salt.utils.verify
 import salt.utils.event
@@ -77,6 +77,8 @@ class LocalClient(object):
         self.key = self.__read_master_key()
         self.salt_user = self.__get_user()
         self.event = salt.utils.event.MasterEvent(self.opts['sock_dir'])
+        self.job_cache = salt.jobcache.get_job_cache(self.opts)
+        self.key_registry = salt.crypt.KeyRegistry(self.opts)
 
     def __read_master_key(self):
         '''
@@ -118,48 +120,30 @@ class LocalClient(object):
         '''
         Return the minions found by looking via globs
         '''
-        cwd = os.getcwd()
-        try:
-            os.chdir(os.path.join(self.opts['pki_dir'], 'minions'))
-        except OSError:
+        if not os.path.isdir(os.path.join(self.opts['pki_dir'], 'minions')):
             err = ('The Salt Master has not been set up on this system, '
                    'a salt-master needs to be running to use the salt command')
             sys.stderr.write(err)
             sys.exit(2)
-        ret = set(glob.glob(expr))
-        os.chdir(cwd)
-        return ret
+        return self.key_registry.check_glob(expr)
 
     def _check_list_minions(self, expr):
         '''
         Return the minions found by looking via a list
         '''
-        ret = []
-        for fn_ in os.listdir(os.path.join(self.opts['pki_dir'], 'minions')):
-            if fn_ in expr:
-                if fn_ not in ret:
-                    ret.append(fn_)
-        return ret
+        return self.key_registry.check_list(expr)
 
     def _check_pcre_minions(self, expr):
         '''
         Return the minions found by looking via regular expressions
         '''
-        ret = set()
-        cwd = os.getcwd()
-        os.chdir(os.path.join(self.opts['pki_dir'], 'minions'))
-        reg = re.compile(expr)
-        for fn_ in os.listdir('.'):
-            if reg.match(fn_):
-                ret.add(fn_)
-        os.chdir(cwd)
-        return ret
+        return self.key_registry.check_pcre(expr)
 
     def _check_grain_minions(self, expr):
         '''
         Return the minions found by looking via a list
         '''
-        return os.listdir(os.path.join(self.opts['pki_dir'], 'minions'))
+        return list(self.key_registry.list_keys())
 
     def _convert_range_to_list(self, tgt):
         range = seco.range.Range(self.opts['range_server'])
@@ -195,11 +179,8 @@ class LocalClient(object):
         arg = condition_kwarg(arg, kwarg)
         if timeout is None:
             timeout = self.opts['timeout']
-        jid = salt.utils.prep_jid(
-                self.opts['cachedir'],
-                self.opts['hash_type']
-                )
-        pub_data = self.pub(
+        jid = self.job_cache.prep_jid()
+        pub_data = self._pub(
             tgt,
             fun,
             arg,
@@ -231,11 +212,8 @@ class LocalClient(object):
         arg = condition_kwarg(arg, kwarg)
         if timeout is None:
             timeout = self.opts['timeout']
-        jid = salt.utils.prep_jid(
-                self.opts['cachedir'],
-                self.opts['hash_type']
-                )
-        pub_data = self.pub(
+        jid = self.job_cache.prep_jid()
+        pub_data = self._pub(
             tgt,
             fun,
             arg,
@@ -276,11 +254,8 @@ class LocalClient(object):
         arg = condition_kwarg(arg, kwarg)
         if timeout is None:
             timeout = self.opts['timeout']
-        jid = salt.utils.prep_jid(
-                self.opts['cachedir'],
-                self.opts['hash_type']
-                )
-        pub_data = self.pub(
+        jid = self.job_cache.prep_jid()
+        pub_data = self._pub(
             tgt,
             fun,
             arg,
@@ -316,11 +291,8 @@ class LocalClient(object):
         arg = condition_kwarg(arg, kwarg)
         if timeout is None:
             timeout = self.opts['timeout']
-        jid = salt.utils.prep_jid(
-                self.opts['cachedir'],
-                self.opts['hash_type']
-                )
-        pub_data = self.pub(
+        jid = self.job_cache.prep_jid()
+        pub_data = self._pub(
             tgt,
             fun,
             arg,
@@ -354,11 +326,8 @@ class LocalClient(object):
         arg = condition_kwarg(arg, kwarg)
         if timeout is None:
             timeout = self.opts['timeout']
-        jid = salt.utils.prep_jid(
-                self.opts['cachedir'],
-                self.opts['hash_type']
-                )
-        pub_data = self.pub(
+        jid = self.job_cache.prep_jid()
+        pub_data = self._pub(
             tgt,
             fun,
             arg,
@@ -374,6 +343,47 @@ class LocalClient(object):
         return (self.get_full_returns(pub_data['jid'],
                 pub_data['minions'], timeout))
 
+    def get_cache_returns(self, jid):
+        '''
+        Return the returns for the jid which have already been written to the
+        job cache, this allows late joiners to pick up the returns which were
+        fired on the event bus before they started listening
+        '''
+        return self.job_cache.get_returns(jid)
+
+    def _iter_event_returns(self, jid):
+        '''
+        Yield the returns for the jid as they are fired on the master event
+        bus, the returns already in the job cache are yielded first in a
+        single dict. Returns are yielded as a dict in the form
+        {<minion id>: {'ret': <return>}} and None is yielded every time the
+        event poll comes back empty so that the caller can check its timeouts.
+        '''
+        self.event.subscribe(jid)
+        found = set()
+        try:
+            cached = self.get_cache_returns(jid)
+            if cached:
+                found.update(cached)
+                yield cached
+            while True:
+                raw = self.event.get_event(100, jid, full=True)
+                if raw is None:
+                    yield None
+                    continue
+                data = raw['data']
+                if 'id' not in data or 'return' not in data:
+                    continue
+                if data['id'] in found:
+                    continue
+                found.add(data['id'])
+                ret = {data['id']: {'ret': data['return']}}
+                if 'out' in data:
+                    ret[data['id']]['out'] = data['out']
+                yield ret
+        finally:
+            self.event.unsubscribe(jid)
+
     def get_cli_returns(
             self,
             jid,
@@ -391,55 +401,27 @@ class LocalClient(object):
             print('------------------------------------\n')
         if timeout is None:
             timeout = self.opts['timeout']
-        fret = {}
         inc_timeout = timeout
-        jid_dir = salt.utils.jid_dir(
-                jid,
-                self.opts['cachedir'],
-                self.opts['hash_type']
-                )
         start = int(time.time())
         found = set()
-        wtag = os.path.join(jid_dir, 'wtag*')
         # Check to see if the jid is real, if not return the empty dict
-        if not os.path.isdir(jid_dir):
+        if not self.job_cache.has_jid(jid):
+            self.event.unsubscribe(jid)
             yield {}
+            return
         # Wait for the hosts to check in
-        while True:
-            for fn_ in os.listdir(jid_dir):
-                ret = {}
-                if fn_.startswith('.'):
-                    continue
-                if fn_ not in found:
-                    retp = os.path.join(jid_dir, fn_, 'return.p')
-                    outp = os.path.join(jid_dir, fn_, 'out.p')
-                    if not os.path.isfile(retp):
-                        continue
-                    while fn_ not in ret:
-                        try:
-                            check = True
-                            ret_data = self.serial.load(open(retp, 'r'))
-                            if ret_data is None:
-                                # Sometimes the ret data is read at the wrong
-                                # time and returns None, do a quick re-read
-                                if check:
-                                    check = False
-                                    continue
-                            ret[fn_] = {'ret': ret_data}
-                            if os.path.isfile(outp):
-                                ret[fn_]['out'] = self.serial.load(open(outp, 'r'))
-                        except Exception:
-                            pass
-                    found.add(fn_)
-                    fret.update(ret)
-                    yield ret
-            if glob.glob(wtag) and not int(time.time()) > start + timeout + 1:
+        for ret in self._iter_event_returns(jid):
+            if ret is not None:
+                found.update(ret)
+                yield ret
+            if len(found) >= len(minions):
+                # All minions have returned, break out of the loop
+                break
+            if self.job_cache.has_wtag(jid) \
+                    and not int(time.time()) > start + timeout + 1:
                 # The timeout +1 has not been reached and there is still a
                 # write tag for the syndic
                 continue
-            if len(fret) >= len(minions):
-                # All minions have returned, break out of the loop
-                break
             if int(time.time()) > start + timeout:
                 # The timeout has been reached, check the jid to see if the
                 # timeout needs to be increased
@@ -455,13 +437,12 @@ class LocalClient(object):
                     continue
                 if verbose:
                     if tgt_type == 'glob' or tgt_type == 'pcre':
-                        if not len(fret) >= len(minions):
+                        if not len(found) >= len(minions):
                             print('\nThe following minions did not return:')
                             fail = sorted(list(minions.difference(found)))
                             for minion in fail:
                                 print(minion)
                 break
-            time.sleep(0.01)
 
     def get_iter_returns(self, jid, minions, timeout=None):
         '''
@@ -470,162 +451,66 @@ class LocalClient(object):
         '''
         if timeout is None:
             timeout = self.opts['timeout']
-        jid_dir = salt.utils.jid_dir(
-                jid,
-                self.opts['cachedir'],
-                self.opts['hash_type']
-                )
-        start = 999999999999
+        start = None
         gstart = int(time.time())
         found = set()
-        wtag = os.path.join(jid_dir, 'wtag*')
         # Check to see if the jid is real, if not return the empty dict
-        if not os.path.isdir(jid_dir):
+        if not self.job_cache.has_jid(jid):
+            self.event.unsubscribe(jid)
             yield {}
+            return
         # Wait for the hosts to check in
-        while True:
-            for fn_ in os.listdir(jid_dir):
-                ret = {}
-                if fn_.startswith('.'):
-                    continue
-                if fn_ not in found:
-                    retp = os.path.join(jid_dir, fn_, 'return.p')
-                    outp = os.path.join(jid_dir, fn_, 'out.p')
-                    if not os.path.isfile(retp):
-                        continue
-                    while fn_ not in ret:
-                        try:
-                            ret_data = self.serial.load(open(retp, 'r'))
-                            ret[fn_] = {'ret': ret_data}
-                            if os.path.isfile(outp):
-                                ret[fn_]['out'] = self.serial.load(open(outp, 'r'))
-                        except Exception:
-                            pass
-                    found.add(fn_)
-                    yield ret
-            if ret and start == 999999999999:
-                start = int(time.time())
-            if glob.glob(wtag) and not int(time.time()) > start + timeout + 1:
+        for ret in self._iter_event_returns(jid):
+            if ret is not None:
+                found.update(ret)
+                if start is None:
+                    start = int(time.time())
+                yield ret
+            else:
+                yield None
+            if len(found) >= len(minions):
+                break
+            if start is None:
+                if int(time.time()) > gstart + timeout:
+                    # No minions have replied within the specified global
+                    # timeout
+                    break
+                continue
+            if self.job_cache.has_wtag(jid) \
+                    and not int(time.time()) > start + timeout + 1:
                 # The timeout +1 has not been reached and there is still a
                 # write tag for the syndic
                 continue
-            if len(ret) >= len(minions):
-                break
             if int(time.time()) > start + timeout:
                 break
-            if int(time.time()) > gstart + timeout and not ret:
-                # No minions have replied within the specified global timeout,
-                # return an empty dict
-                break
-            yield None
-            time.sleep(0.02)
 
     def get_returns(self, jid, minions, timeout=None):
         '''
         This method starts off a watcher looking at the return data for
         a specified jid
         '''
-        if timeout is None:
-            timeout = self.opts['timeout']
-        jid_dir = salt.utils.jid_dir(
-                jid,
-                self.opts['cachedir'],
-                self.opts['hash_type']
-                )
-        start = 999999999999
-        gstart = int(time.time())
         ret = {}
-        wtag = os.path.join(jid_dir, 'wtag*')
         # If jid == 0, there is no payload
         if int(jid) == 0:
             return ret
-        # Check to see if the jid is real, if not return the empty dict
-        if not os.path.isdir(jid_dir):
-            return ret
-        # Wait for the hosts to check in
-        while True:
-            for fn_ in os.listdir(jid_dir):
-                if fn_.startswith('.'):
-                    continue
-                if fn_ not in ret:
-                    retp = os.path.join(jid_dir, fn_, 'return.p')
-                    if not os.path.isfile(retp):
-                        continue
-                    while fn_ not in ret:
-                        try:
-                            ret[fn_] = self.serial.load(open(retp, 'r'))
-                        except Exception:
-                            pass
-            if ret and start == 999999999999:
-                start = int(time.time())
-            if glob.glob(wtag) and not int(time.time()) > start + timeout + 1:
-                # The timeout +1 has not been reached and there is still a
-                # write tag for the syndic
+        for fn_ret in self.get_iter_returns(jid, minions, timeout):
+            if not fn_ret:
                 continue
-            if len(ret) >= len(minions):
-                # All Minions have returned
-                return ret
-            if int(time.time()) > start + timeout:
-                # The timeout has been reached
-                return ret
-            if int(time.time()) > gstart + timeout and not ret:
-                # No minions have replied within the specified global timeout,
-                # return an empty dict
-                return ret
-            time.sleep(0.02)
+            for id_, data in fn_ret.items():
+                ret[id_] = data['ret']
+        return ret
 
     def get_full_returns(self, jid, minions, timeout=None):
         '''
         This method starts off a watcher looking at the return data for
         a specified jid, it returns all of the information for the jid
         '''
-        if timeout is None:
-            timeout = self.opts['timeout']
-        jid_dir = salt.utils.jid_dir(
-                jid,
-                self.opts['cachedir'],
-                self.opts['hash_type']
-                )
-        start = 999999999999
-        gstart = int(time.time())
         ret = {}
-        wtag = os.path.join(jid_dir, 'wtag*')
-        # Check to see if the jid is real, if not return the empty dict
-        if not os.path.isdir(jid_dir):
-            return ret
-        # Wait for the hosts to check in
-        while True:
-            for fn_ in os.listdir(jid_dir):
-                if fn_.startswith('.'):
-                    continue
-                if fn_ not in ret:
-                    retp = os.path.join(jid_dir, fn_, 'return.p')
-                    outp = os.path.join(jid_dir, fn_, 'out.p')
-                    if not os.path.isfile(retp):
-                        continue
-                    while fn_ not in ret:
-                        try:
-                            ret_data = self.serial.load(open(retp, 'r'))
-                            ret[fn_] = {'ret': ret_data}
-                            if os.path.isfile(outp):
-                                ret[fn_]['out'] = self.serial.load(open(outp, 'r'))
-                        except Exception:
-                            pass
-            if ret and start == 999999999999:
-                start = int(time.time())
-            if glob.glob(wtag) and not int(time.time()) > start + timeout + 1:
-                # The timeout +1 has not been reached and there is still a
-                # write tag for the syndic
+        for fn_ret in self.get_iter_returns(jid, minions, timeout):
+            if not fn_ret:
                 continue
-            if len(ret) >= len(minions):
-                return ret
-            if int(time.time()) > start + timeout:
-                return ret
-            if int(time.time()) > gstart + timeout and not ret:
-                # No minions have replied within the specified global timeout,
-                # return an empty dict
-                return ret
-            time.sleep(0.02)
+            ret.update(fn_ret)
+        return ret
 
     def get_cli_event_returns(
             self,
@@ -638,63 +523,14 @@ class LocalClient(object):
         '''
         Get the returns for the command line interface via the event system
         '''
-        if verbose:
-            print('Executing job with jid {0}'.format(jid))
-            print('------------------------------------\n')
-        if timeout is None:
-            timeout = self.opts['timeout']
-        inc_timeout = timeout
-        jid_dir = salt.utils.jid_dir(
+        for ret in self.get_cli_returns(
                 jid,
-                self.opts['cachedir'],
-                self.opts['hash_type']
-                )
-        start = int(time.time())
-        found = set()
-        wtag = os.path.join(jid_dir, 'wtag*')
-        # Check to see if the jid is real, if not return the empty dict
-        if not os.path.isdir(jid_dir):
-            yield {}
-        # Wait for the hosts to check in
-        while True:
-            raw = self.event.get_event(timeout, jid)
-            if not raw is None:
-                found.add(raw['id'])
-                ret = {raw['id']: {'ret': raw['return']}}
-                if 'out' in raw:
-                    ret[raw['id']]['out'] = raw['out']
-                yield ret
-                continue
-            # Then event system timeout was reached and nothing was returned
-            if len(found) >= len(minions):
-                # All minions have returned, break out of the loop
-                break
-            if glob.glob(wtag) and not int(time.time()) > start + timeout + 1:
-                # The timeout +1 has not been reached and there is still a
-                # write tag for the syndic
-                continue
-            if int(time.time()) > start + timeout:
-                # The timeout has been reached, check the jid to see if the
-                # timeout needs to be increased
-                jinfo = self.gather_job_info(jid, tgt, tgt_type)
-                more_time = False
-                for id_ in jinfo:
-                    if jinfo[id_]:
-                        if verbose:
-                            print('Execution is still running on {0}'.format(id_))
-                        more_time = True
-                if more_time:
-                    timeout += inc_timeout
-                    continue
-                if verbose:
-                    if tgt_type == 'glob' or tgt_type == 'pcre':
-                        if not len(found) >= len(minions):
-                            print('\nThe following minions did not return:')
-                            fail = sorted(list(minions.difference(found)))
-                            for minion in fail:
-                                print(minion)
-                break
-            time.sleep(0.01)
+                minions,
+                timeout,
+                tgt,
+                tgt_type,
+                verbose):
+            yield ret
 
     def get_event_iter_returns(self, jid, minions, timeout=None):
         '''
@@ -703,60 +539,36 @@ class LocalClient(object):
         '''
         if timeout is None:
             timeout = self.opts['timeout']
-        jid_dir = salt.utils.jid_dir(
-                jid,
-                self.opts['cachedir'],
-                self.opts['hash_type']
-                )
-        start = 999999999999
-        gstart = int(time.time())
-        found = set()
         # Check to see if the jid is real, if not return the empty dict
-        if not os.path.isdir(jid_dir):
+        if not self.job_cache.has_jid(jid):
+            self.event.unsubscribe(jid)
             yield {}
+            return
+        last = time.time()
         # Wait for the hosts to check in
-        while True:
-            raw = self.event.get_event(timeout)
-            if raw is None:
-                # Timeout reached
-                break
-            found.add(raw['id'])
-            ret = {raw['id']: {'ret': raw['return']}}
-            if 'out' in raw:
-                ret[raw['id']]['out'] = raw['out']
+        for ret in self._iter_event_returns(jid):
+            if ret is None:
+                if time.time() - last > timeout:
+                    # Timeout reached
+                    break
+                continue
+            last = time.time()
             yield ret
-            time.sleep(0.02)
-
 
     def find_cmd(self, cmd):
         '''
         Hunt through the old salt calls for when cmd was run, return a dict:
         {'<jid>': <return_obj>}
         '''
-        job_dir = os.path.join(self.opts['cachedir'], 'jobs')
         ret = {}
-        for jid in os.listdir(job_dir):
-            jid_dir = salt.utils.jid_dir(
-                    jid,
-                    self.opts['cachedir'],
-                    self.opts['hash_type']
-                    )
-            loadp = os.path.join(jid_dir, '.load.p')
-            if os.path.isfile(loadp):
-                try:
-                    load = self.serial.load(open(loadp, 'r'))
-                    if load['fun'] == cmd:
-                        # We found a match! Add the return values
-                        ret[jid] = {}
-                        for host in os.listdir(jid_dir):
-                            host_dir = os.path.join(jid_dir, host)
-                            retp = os.path.join(host_dir, 'return.p')
-                            if not os.path.isfile(retp):
-                                continue
-                            ret[jid][host] = self.serial.load(open(retp))
-                except Exception:
-                    continue
-            else:
+        for jid, load in self.job_cache.list_jobs().items():
+            try:
+                if load['fun'] == cmd:
+                    # We found a match! Add the return values
+                    ret[jid] = {}
+                    for host, data in self.job_cache.get_returns(jid).items():
+                        ret[jid][host] = data['ret']
+            except Exception:
                 continue
         return ret
 
@@ -777,6 +589,26 @@ class LocalClient(object):
                 'compound': self._check_grain_minions,
                 }[expr_form](expr)
 
+    def _pub(self, tgt, fun, arg=(), expr_form='glob',
+             ret='', jid='', timeout=5):
+        '''
+        Publish the command with its returns subscribed to before the job
+        goes out so that no returns are missed, the subscription is dropped
+        again when the job is not published. The returns are then read with
+        the get_*returns methods, which drop the subscription when done.
+        '''
+        if jid:
+            self.event.subscribe(jid)
+        try:
+            pub_data = self.pub(
+                    tgt, fun, arg, expr_form, ret, jid, timeout)
+        except Exception:
+            self.event.unsubscribe(jid)
+            raise
+        if pub_data['jid'] == '0' or not pub_data['jid']:
+            self.event.unsubscribe(jid)
+        return pub_data
+
     def pub(self, tgt, fun, arg=(), expr_form='glob',
             ret='', jid='', timeout=5):
         '''
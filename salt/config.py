@@ -156,6 +156,10 @@ def minion_config(path):
             'id': socket.getfqdn(),
             'cachedir': '/var/cache/salt',
             'cache_jobs': False,
+            'return_batch_window': 0,
+            'return_batch_size': 100,
+            'return_spool': True,
+            'return_spool_rate': 20,
             'conf_file': path,
             'sock_dir': os.path.join(tempfile.gettempdir(), '.salt-unix'),
             'renderer': 'yaml_jinja',
@@ -164,6 +168,7 @@ def minion_config(path):
             'environment': None,
             'state_top': 'top.sls',
             'file_client': 'remote',
+            'file_transfer_window': 4,
             'file_roots': {
                 'base': ['/srv/salt'],
                 },
@@ -172,6 +177,9 @@ def minion_config(path):
                 },
             'hash_type': 'md5',
             'external_nodes': '',
+            'ext_nodes_cache_ttl': 0,
+            'ext_nodes_stale_time': 300,
+            'ext_nodes_max_procs': 4,
             'disable_modules': [],
             'disable_returners': [],
             'module_dirs': [],
@@ -182,6 +190,10 @@ def minion_config(path):
             'clean_dynamic_modules': True,
             'open_mode': False,
             'multiprocessing': True,
+            'job_pool_size': 0,
+            'job_queue_size': 1000,
+            'job_timeout': 0,
+            'job_priorities': {},
             'sub_timeout': 60,
             'log_file': '/var/log/salt/minion',
             'log_level': 'warning',
@@ -194,6 +206,8 @@ def minion_config(path):
             'cython_enable': False,
             'state_verbose': False,
             'acceptance_wait_time': 10,
+            'acceptance_wait_time_max': 60,
+            'auth_splay': 10,
             'dns_check': True,
             'grains': {},
             }
@@ -236,8 +250,40 @@ def master_config(path):
     '''
     opts = {'interface': '0.0.0.0',
             'publish_port': '4505',
+            'publish_topics': 0,
+            'pub_hwm': 1000,
+            'pub_queue_size': 10000,
+            'pub_queue_timeout': 10,
+            'pub_rate': 0,
             'user': 'root',
             'worker_threads': 5,
+            'worker_threads_max': 0,
+            'worker_idle_time': 300,
+            'worker_timeout': 0,
+            'worker_max_memory': 0,
+            'worker_lanes': {
+                'return': {
+                    'cmds': ['_return',
+                             '_return_batch',
+                             '_syndic_return',
+                             '_minion_event'],
+                    'weight': 4,
+                    'reserved': 1},
+                'file': {
+                    'cmds': ['_serve_file',
+                             '_serve_file_raw',
+                             '_file_hash',
+                             '_file_list',
+                             '_file_list_emptydirs',
+                             '_master_opts'],
+                    'weight': 1},
+                'pillar': {
+                    'cmds': ['_pillar', '_ext_nodes', '_master_state'],
+                    'weight': 1},
+                'default': {'weight': 2}},
+            'auth_workers': 1,
+            'auth_queue_size': 500,
+            'auth_retry_after': 10,
             'sock_dir': os.path.join(tempfile.gettempdir(), '.salt-unix'),
             'ret_port': '4506',
             'timeout': 5,
@@ -254,7 +300,12 @@ def master_config(path):
             'pillar_roots': {
                 'base': ['/srv/pillar'],
                 },
+            'pillar_cache': False,
+            'pillar_cache_ttl': 3600,
+            'pillar_pool_size': 0,
+            'pillar_timeout': 60,
             'file_buffer_size': 1048576,
+            'fileserver_list_cache_time': 20,
             'hash_type': 'md5',
             'conf_file': path,
             'open_mode': False,
@@ -263,8 +314,12 @@ def master_config(path):
             'failhard': False,
             'state_top': 'top.sls',
             'external_nodes': '',
+            'ext_nodes_cache_ttl': 0,
+            'ext_nodes_stale_time': 300,
+            'ext_nodes_max_procs': 4,
             'order_masters': False,
             'job_cache': True,
+            'job_cache_backend': 'localfs',
             'log_file': '/var/log/salt/master',
             'log_level': 'warning',
             'log_level_logfile': None,
@@ -6,15 +6,18 @@ authenticating peers
 
 # Import python libs
 import os
+import re
 import sys
 import hmac
+import time
+import fnmatch
 import getpass
 import hashlib
 import logging
 import tempfile
 
 # Import Cryptography libs
-from M2Crypto import RSA
+from M2Crypto import RSA, BIO
 from Crypto.Cipher import AES
 
 # Import zeromq libs
@@ -24,6 +27,7 @@ import zmq
 import salt.utils
 import salt.payload
 import salt.utils.verify
+from salt._compat import string_types
 from salt.exceptions import AuthenticationError, SaltClientError, SaltReqTimeoutError
 
 log = logging.getLogger(__name__)
@@ -126,6 +130,136 @@ class MasterKeys(dict):
         return open(self.pub_path, 'r').read()
 
 
+class KeyRegistry(object):
+    '''
+    Keep the minion keys under the pki_dir in memory. The ids in each of
+    the accepted, pending and rejected key directories are listed again only
+    when the directory changes, the keys are read when they are first used
+    and public keys are only parsed once.
+
+    A key overwritten in place does not change its directory, so other
+    processes which change keys are only seen when the directory changes,
+    callers should use reload() when a key does not match.
+    '''
+    states = ('minions', 'minions_pre', 'minions_rejected')
+
+    def __init__(self, opts):
+        self.opts = opts
+        self.ids = dict((state, frozenset()) for state in self.states)
+        self.mtimes = dict((state, None) for state in self.states)
+        self.pubs = {}
+        self.rsa = {}
+
+    def _refresh(self, state):
+        '''
+        List a key directory again if it changed since it was last listed
+        '''
+        path = os.path.join(self.opts['pki_dir'], state)
+        try:
+            mtime = os.stat(path).st_mtime
+        except OSError:
+            self.ids[state] = frozenset()
+            self.mtimes[state] = None
+            return
+        if mtime == self.mtimes[state]:
+            return
+        ids = frozenset(
+                fn_ for fn_ in os.listdir(path) if not fn_.startswith('.'))
+        # Forget the keys which were removed from the directory
+        for id_ in self.ids[state] - ids:
+            self.pubs.pop((state, id_), None)
+            self.rsa.pop((state, id_), None)
+        self.ids[state] = ids
+        self.mtimes[state] = mtime
+
+    def list_keys(self, state='minions'):
+        '''
+        Return the set of ids with a key in the named directory
+        '''
+        self._refresh(state)
+        return self.ids[state]
+
+    def key_state(self, id_):
+        '''
+        Return the directory the key of a minion is in, or None
+        '''
+        for state in self.states:
+            if id_ in self.list_keys(state):
+                return state
+        return None
+
+    def reload(self, id_, state='minions'):
+        '''
+        Drop the key of a minion held in memory
+        '''
+        self.mtimes[state] = None
+        self.pubs.pop((state, id_), None)
+        self.rsa.pop((state, id_), None)
+
+    def get_pub(self, id_, state='minions'):
+        '''
+        Return the public key string of a minion, or None
+        '''
+        if id_ not in self.list_keys(state):
+            return None
+        if (state, id_) not in self.pubs:
+            try:
+                with open(os.path.join(
+                        self.opts['pki_dir'], state, id_), 'r') as fp_:
+                    self.pubs[(state, id_)] = fp_.read()
+            except (IOError, OSError):
+                return None
+        return self.pubs[(state, id_)]
+
+    def set_pub(self, id_, pub, state='minions'):
+        '''
+        Write the public key of a minion into the named directory
+        '''
+        with open(os.path.join(self.opts['pki_dir'], state, id_), 'w+') as fp_:
+            fp_.write(pub)
+        self.reload(id_, state)
+        self.pubs[(state, id_)] = pub
+
+    def get_rsa(self, id_, state='minions'):
+        '''
+        Return the parsed public key of a minion, or None
+        '''
+        pub = self.get_pub(id_, state)
+        if pub is None:
+            return None
+        cached = self.rsa.get((state, id_))
+        if cached is None or cached[0] != pub:
+            try:
+                key = RSA.load_pub_key_bio(BIO.MemoryBuffer(pub))
+            except RSA.RSAError as exc:
+                log.error('Corrupt public key for {0}: {1}'.format(id_, exc))
+                return None
+            cached = self.rsa[(state, id_)] = (pub, key)
+        return cached[1]
+
+    def check_glob(self, expr):
+        '''
+        Return the accepted minions matching a glob
+        '''
+        return set(fnmatch.filter(self.list_keys(), expr))
+
+    def check_pcre(self, expr):
+        '''
+        Return the accepted minions matching a regular expression
+        '''
+        reg = re.compile(expr)
+        return set(id_ for id_ in self.list_keys() if reg.match(id_))
+
+    def check_list(self, expr):
+        '''
+        Return the accepted minions in a list, or a comma separated string
+        '''
+        if isinstance(expr, string_types):
+            expr = expr.split(',')
+        accepted = self.list_keys()
+        return [id_ for id_ in sorted(set(expr)) if id_ in accepted]
+
+
 class Auth(object):
     '''
     The Auth class provides the sequence for setting up communication with
@@ -178,6 +312,8 @@ class Auth(object):
         os.close(fd_)
         key.save_pub_key(tmp_pub)
         payload['enc'] = 'clear'
+        # The master queues the request by the command without loading it
+        payload['cmd'] = '_auth'
         payload['load'] = {}
         payload['load']['cmd'] = '_auth'
         payload['load']['id'] = self.opts['id']
@@ -248,10 +384,26 @@ class Auth(object):
         except SaltClientError:
             return 'retry'
         sreq = salt.payload.SREQ(self.opts['master_uri'])
-        try:
-            payload = sreq.send_auto(self.minion_sign_in_payload())
-        except SaltReqTimeoutError:
-            return 'retry'
+        attempt = 0
+        while True:
+            try:
+                payload = sreq.send_auto(self.minion_sign_in_payload())
+            except SaltReqTimeoutError:
+                return 'retry'
+            if 'retry_after' not in payload.get('load', {}):
+                break
+            # The master is handling too many sign ins, come back no sooner
+            # than it asked and no later than twice that, spread out so the
+            # turned away minions do not all return at once
+            retry_after = payload['load']['retry_after']
+            delay = retry_after + salt.utils.backoff(
+                    attempt,
+                    retry_after,
+                    min(retry_after, self.opts['acceptance_wait_time_max']))
+            log.info('The Salt Master is busy, signing in again in '
+                     '{0:.1f} seconds'.format(delay))
+            time.sleep(delay)
+            attempt += 1
         if 'load' in payload:
             if 'ret' in payload['load']:
                 if not payload['load']['ret']:
@@ -283,6 +435,7 @@ class Auth(object):
             sys.exit(42)
         auth['aes'] = self.decrypt_aes(payload['aes'])
         auth['publish_port'] = payload['publish_port']
+        auth['publish_topics'] = payload.get('publish_topics', 0)
         return auth
 
 
@@ -3,24 +3,24 @@ Classes that manage file clients
 '''
 # Import python libs
 import contextlib
-import logging
 import hashlib
+import logging
 import os
 import shutil
 import string
-import subprocess
 
 # Import third-party libs
-import yaml
 import zmq
 
 # Import salt libs
-from salt.exceptions import MinionError, SaltReqTimeoutError
+from salt.exceptions import AuthenticationError, MinionError, \
+    SaltReqTimeoutError
 import salt.client
 import salt.crypt
 import salt.loader
 import salt.utils
 import salt.payload
+import salt.fileserver
 import salt.utils.templates
 from salt._compat import (
     URLError, HTTPError, BaseHTTPServer, urlparse, url_open)
@@ -100,7 +100,7 @@ class Client(object):
         '''
         raise NotImplementedError
 
-    def file_list_emptydirs(self, env='base'):
+    def file_list_emptydirs(self, env='base', prefix=''):
         '''
         List the empty dirs
         '''
@@ -138,7 +138,7 @@ class Client(object):
         '''
         ret = []
         path = self._check_proto(path)
-        for fn_ in self.file_list(env):
+        for fn_ in self.file_list(env, path):
             if fn_.startswith(path):
                 local = self.cache_file('salt://{0}'.format(fn_), env)
                 if not fn_.strip():
@@ -154,7 +154,7 @@ class Client(object):
                 prefix = ''
             else:
                 prefix = separated[0]
-            for fn_ in self.file_list_emptydirs(env):
+            for fn_ in self.file_list_emptydirs(env, path):
                 if fn_.startswith(path):
                     dest = os.path.normpath(
                       os.sep.join([
@@ -191,7 +191,7 @@ class Client(object):
         return sorted(self._file_local_list(filesdest) +
                 self._file_local_list(localfilesdest))
 
-    def file_list(self, env='base'):
+    def file_list(self, env='base', prefix=''):
         '''
         This function must be overwritten
         '''
@@ -261,7 +261,7 @@ class Client(object):
             prefix = separated[0]
 
         # Copy files from master
-        for fn_ in self.file_list(env):
+        for fn_ in self.file_list(env, path):
             if fn_.startswith(path):
                 # Remove the leading directories from path to derive
                 # the relative path on the minion.
@@ -270,7 +270,7 @@ class Client(object):
                                          '%s/%s' % (dest, minion_relpath),
                                          True, env))
         # Replicate empty dirs from master
-        for fn_ in self.file_list_emptydirs(env):
+        for fn_ in self.file_list_emptydirs(env, path):
             if fn_.startswith(path):
                 # Remove the leading directories from path to derive
                 # the relative path on the minion.
@@ -378,6 +378,7 @@ class LocalClient(Client):
     '''
     def __init__(self, opts):
         Client.__init__(self, opts)
+        self._ext_nodes = None
 
     def _find_file(self, path, env='base'):
         '''
@@ -405,9 +406,10 @@ class LocalClient(Client):
             return ''
         return fnd['path']
 
-    def file_list(self, env='base'):
+    def file_list(self, env='base', prefix=''):
         '''
-        Return a list of files in the given environment
+        Return a list of files in the given environment, if a prefix is
+        passed only the files under it are returned
         '''
         ret = []
         if env not in self.opts['file_roots']:
@@ -415,20 +417,15 @@ class LocalClient(Client):
         for path in self.opts['file_roots'][env]:
             for root, dirs, files in os.walk(path):
                 for fn in files:
-                    ret.append(
-                        os.path.relpath(
-                            os.path.join(
-                                root,
-                                fn
-                                ),
-                            path
-                            )
-                        )
+                    rel = os.path.relpath(os.path.join(root, fn), path)
+                    if rel.startswith(prefix):
+                        ret.append(rel)
         return ret
 
-    def file_list_emptydirs(self, env='base'):
+    def file_list_emptydirs(self, env='base', prefix=''):
         '''
-        List the empty dirs in the file_roots
+        List the empty dirs in the file_roots, if a prefix is passed only the
+        dirs under it are returned
         '''
         ret = []
         if env not in self.opts['file_roots']:
@@ -436,7 +433,9 @@ class LocalClient(Client):
         for path in self.opts['file_roots'][env]:
             for root, dirs, files in os.walk(path):
                 if len(dirs) == 0 and len(files) == 0:
-                    ret.append(os.path.relpath(root, path))
+                    rel = os.path.relpath(root, path)
+                    if rel.startswith(prefix):
+                        ret.append(rel)
         return ret
 
     def hash_file(self, path, env='base'):
@@ -455,17 +454,14 @@ class LocalClient(Client):
                 log.warning(err)
                 return ret
             else:
-                with open(path, 'rb') as f:
-                    ret['hsum'] = hashlib.md5(f.read()).hexdigest()
+                ret['hsum'] = salt.utils.get_hash(path)
                 ret['hash_type'] = 'md5'
                 return ret
         path = self._find_file(path, env)['path']
         if not path:
             return {}
         ret = {}
-        with open(path, 'rb') as f:
-            ret['hsum'] = getattr(hashlib, self.opts['hash_type'])(
-                f.read()).hexdigest()
+        ret['hsum'] = salt.utils.get_hash(path, self.opts['hash_type'])
         ret['hash_type'] = self.opts['hash_type']
         return ret
 
@@ -486,34 +482,9 @@ class LocalClient(Client):
         Return the metadata derived from the external nodes system on the local
         system
         '''
-        if not self.opts['external_nodes']:
-            return {}
-        if not salt.utils.which(self.opts['external_nodes']):
-            log.error(('Specified external nodes controller {0} is not'
-                       ' available, please verify that it is installed'
-                       '').format(self.opts['external_nodes']))
-            return {}
-        cmd = '{0} {1}'.format(self.opts['external_nodes'], self.opts['id'])
-        ndata = yaml.safe_load(
-                subprocess.Popen(
-                    cmd,
-                    shell=True,
-                    stdout=subprocess.PIPE
-                    ).communicate()[0])
-        ret = {}
-        if 'environment' in ndata:
-            env = ndata['environment']
-        else:
-            env = 'base'
-
-        if 'classes' in ndata:
-            if isinstance(ndata['classes'], dict):
-                ret[env] = list(ndata['classes'])
-            elif isinstance(ndata['classes'], list):
-                ret[env] = ndata['classes']
-            else:
-                return ret
-        return ret
+        if self._ext_nodes is None:
+            self._ext_nodes = salt.fileserver.ExtNodes(self.opts)
+        return self._ext_nodes.get(self.opts['id'])
 
 
 class RemoteClient(Client):
@@ -524,6 +495,98 @@ class RemoteClient(Client):
         Client.__init__(self, opts)
         self.auth = salt.crypt.SAuth(opts)
         self.sreq = salt.payload.SREQ(self.opts['master_uri'])
+        self.context = None
+
+    def _get_file_windowed(self, load, dest, fn_, env):
+        '''
+        Fetch a file from the master with up to file_transfer_window chunk
+        requests in flight. The chunks arrive as raw frames next to the load
+        and are written at their offsets as they come in, a chunk which does
+        not match the digest in its load or is not answered in time is asked
+        for again, up to three times. Returns None if the master does not
+        serve windowed transfers.
+        '''
+        if self.context is None:
+            self.context = zmq.Context()
+        socket = self.context.socket(zmq.DEALER)
+        socket.linger = 0
+        socket.connect(self.opts['master_uri'])
+        poller = zmq.Poller()
+        poller.register(socket, zmq.POLLIN)
+        # The number of times each chunk was asked for
+        tries = {}
+
+        def send(loc):
+            tries[loc] = tries.get(loc, 0) + 1
+            if tries[loc] > 3:
+                raise SaltReqTimeoutError(
+                        'Failed to fetch {0} at {1} 3 times'.format(
+                            load['path'], loc))
+            req = dict(load, loc=loc, cmd='_serve_file_raw')
+            payload = {'enc': 'aes',
+                       'load': self.auth.crypticle.dumps(req),
+                       'cmd': req['cmd']}
+            # The empty frame stands in for the envelope of a REQ socket
+            socket.send_multipart(['', self.serial.dumps(payload)])
+
+        first = None
+        try:
+            send(0)
+            pending = set([0])
+            locs = []
+            window = self.opts['file_transfer_window']
+            while pending or locs:
+                while len(pending) < window and locs:
+                    pending.add(locs[0])
+                    send(locs.pop(0))
+                if not poller.poll(60000):
+                    # Ask again for the chunks which have not come in
+                    for loc in pending:
+                        send(loc)
+                    continue
+                frames = socket.recv_multipart()
+                if len(frames) != 3:
+                    return None if first is None else ''
+                header = self.auth.crypticle.loads(
+                        self.serial.loads(frames[1]))
+                if header['loc'] not in pending:
+                    # A late answer for a chunk asked for again
+                    continue
+                try:
+                    data = self.auth.crypticle.decrypt(frames[2])
+                except AuthenticationError:
+                    data = None
+                if data is None or \
+                        hashlib.sha256(data).hexdigest() != header['sum'] or \
+                        first is not None and \
+                        header['size'] != first['size']:
+                    log.warning(
+                            'Received a bad chunk of {0} at {1}'.format(
+                                load['path'], header['loc']))
+                    send(header['loc'])
+                    continue
+                pending.discard(header['loc'])
+                if first is None:
+                    first = header
+                    if not header['dest']:
+                        return dest
+                    if not fn_:
+                        cache_loc = self._cache_loc(header['dest'], env)
+                        with cache_loc as cache_dest:
+                            dest = cache_dest
+                            fn_ = open(dest, 'wb+')
+                    locs = range(
+                            header['chunk'], header['size'], header['chunk'])
+                fn_.seek(header['loc'])
+                fn_.write(data)
+            return dest
+        except SaltReqTimeoutError as exc:
+            log.error(str(exc))
+            return ''
+        finally:
+            if fn_:
+                fn_.close()
+            socket.close()
 
     def get_file(self, path, dest='', makedirs=False, env='base'):
         '''
@@ -545,6 +608,13 @@ class RemoteClient(Client):
                 else:
                     return False
             fn_ = open(dest, 'wb+')
+        if self.opts['file_transfer_window'] > 1:
+            ret = self._get_file_windowed(load, dest, fn_, env)
+            if ret is not None:
+                return ret
+            if fn_:
+                # Start over with a master serving single chunks
+                fn_ = open(dest, 'wb+')
         while True:
             if not fn_:
                 load['loc'] = 0
@@ -556,7 +626,8 @@ class RemoteClient(Client):
                             'aes',
                             self.auth.crypticle.dumps(load),
                             3,
-                            60)
+                            60,
+                            load['cmd'])
                         )
             except SaltReqTimeoutError:
                 return ''
@@ -578,11 +649,13 @@ class RemoteClient(Client):
             fn_.close()
         return dest
 
-    def file_list(self, env='base'):
+    def file_list(self, env='base', prefix=''):
         '''
-        List the files on the master
+        List the files on the master, if a prefix is passed only the files
+        under it are returned
         '''
         load = {'env': env,
+                'prefix': prefix,
                 'cmd': '_file_list'}
         try:
             return self.auth.crypticle.loads(
@@ -590,16 +663,19 @@ class RemoteClient(Client):
                         'aes',
                         self.auth.crypticle.dumps(load),
                         3,
-                        60)
+                        60,
+                        load['cmd'])
                     )
         except SaltReqTimeoutError:
             return ''
 
-    def file_list_emptydirs(self, env='base'):
+    def file_list_emptydirs(self, env='base', prefix=''):
         '''
-        List the empty dirs on the master
+        List the empty dirs on the master, if a prefix is passed only the
+        dirs under it are returned
         '''
         load = {'env': env,
+                'prefix': prefix,
                 'cmd': '_file_list_emptydirs'}
         try:
             return self.auth.crypticle.loads(
@@ -607,7 +683,8 @@ class RemoteClient(Client):
                         'aes',
                         self.auth.crypticle.dumps(load),
                         3,
-                        60)
+                        60,
+                        load['cmd'])
                     )
         except SaltReqTimeoutError:
             return ''
@@ -628,8 +705,7 @@ class RemoteClient(Client):
                 return {}
             else:
                 ret = {}
-                with open(path, 'rb') as f:
-                    ret['hsum'] = hashlib.md5(f.read()).hexdigest()
+                ret['hsum'] = salt.utils.get_hash(path)
                 ret['hash_type'] = 'md5'
                 return ret
         load = {'path': path,
@@ -641,7 +717,8 @@ class RemoteClient(Client):
                         'aes',
                         self.auth.crypticle.dumps(load),
                         3,
-                        60)
+                        60,
+                        load['cmd'])
                     )
         except SaltReqTimeoutError:
             return ''
@@ -658,7 +735,8 @@ class RemoteClient(Client):
                         'aes',
                         self.auth.crypticle.dumps(load),
                         3,
-                        60)
+                        60,
+                        load['cmd'])
                     )
         except SaltReqTimeoutError:
             return ''
@@ -674,7 +752,8 @@ class RemoteClient(Client):
                         'aes',
                         self.auth.crypticle.dumps(load),
                         3,
-                        60)
+                        60,
+                        load['cmd'])
                     )
         except SaltReqTimeoutError:
             return ''
@@ -692,7 +771,8 @@ class RemoteClient(Client):
                         'aes',
                         self.auth.crypticle.dumps(load),
                         3,
-                        60)
+                        60,
+                        load['cmd'])
                     )
         except SaltReqTimeoutError:
             return ''
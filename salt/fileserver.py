@@ -0,0 +1,485 @@
+'''
+Caches used by the master to serve files and external node data to the
+minions
+'''
+
+# Import python libs
+import os
+import time
+import bisect
+import hashlib
+import logging
+import tempfile
+import threading
+import subprocess
+
+try:
+    import fcntl
+    HAS_FCNTL = True
+except ImportError:
+    # Without fcntl the number of classifier processes is not capped
+    HAS_FCNTL = False
+
+# Import salt libs
+import salt.utils
+import salt.payload
+from salt.utils.process import pid_running
+from salt.utils.verify import valid_id
+
+# Import third party libs
+import yaml
+
+log = logging.getLogger(__name__)
+
+
+class HashCache(object):
+    '''
+    Cache the hashes of the files on the master file server. A hash is kept
+    for as long as the path, mtime, size and hash type of the file are
+    unchanged. The hashes are held in memory and written under the cachedir
+    so that every master worker can use a hash computed by another.
+    '''
+    def __init__(self, opts):
+        self.opts = opts
+        self.serial = salt.payload.Serial(opts)
+        self.cache_dir = os.path.join(opts['cachedir'], 'file_hashes')
+        self.hashes = {}
+
+    def _entry_path(self, path, hash_type):
+        '''
+        Return the location of the on disk cache entry for a path
+        '''
+        return os.path.join(
+                self.cache_dir,
+                hash_type,
+                hashlib.md5(path).hexdigest()
+                )
+
+    def _read_entry(self, path, hash_type):
+        '''
+        Return the cache entry written for a path, or None
+        '''
+        try:
+            with open(self._entry_path(path, hash_type), 'rb') as fp_:
+                entry = self.serial.load(fp_)
+        except Exception:
+            return None
+        if not isinstance(entry, dict) or entry.get('path') != path:
+            return None
+        return entry
+
+    def _write_entry(self, entry, hash_type):
+        '''
+        Atomically write the cache entry for a path
+        '''
+        dest = self._entry_path(entry['path'], hash_type)
+        try:
+            if not os.path.isdir(os.path.dirname(dest)):
+                os.makedirs(os.path.dirname(dest))
+            fd_, tmp = tempfile.mkstemp(dir=os.path.dirname(dest))
+            with os.fdopen(fd_, 'wb') as fp_:
+                fp_.write(self.serial.dumps(entry))
+            os.rename(tmp, dest)
+        except (IOError, OSError) as exc:
+            log.warning('Failed to cache the hash of {0}: {1}'.format(
+                entry['path'], exc))
+
+    def get(self, path, hash_type=None):
+        '''
+        Return the hash of the file at the given path, the file is only read
+        if it changed since it was last hashed. An empty string is returned
+        if the file cannot be read.
+        '''
+        if hash_type is None:
+            hash_type = self.opts['hash_type']
+        try:
+            stat = os.stat(path)
+        except OSError:
+            return ''
+        # The mtime is stored with its repr so that sub second changes
+        # are not lost
+        mtime = repr(stat.st_mtime)
+        entry = self.hashes.get((path, hash_type))
+        if entry and entry['mtime'] == mtime \
+                and entry['size'] == stat.st_size:
+            return entry['hsum']
+        entry = self._read_entry(path, hash_type)
+        if entry and entry['mtime'] == mtime \
+                and entry['size'] == stat.st_size:
+            self.hashes[(path, hash_type)] = entry
+            return entry['hsum']
+        try:
+            hsum = salt.utils.get_hash(path, hash_type)
+            after = os.stat(path)
+        except (IOError, OSError):
+            return ''
+        if after.st_mtime != stat.st_mtime or after.st_size != stat.st_size:
+            # The file changed while it was hashed, don't cache the hash
+            return hsum
+        entry = {'path': path,
+                 'mtime': mtime,
+                 'size': stat.st_size,
+                 'hsum': hsum}
+        self.hashes[(path, hash_type)] = entry
+        self._write_entry(entry, hash_type)
+        return hsum
+
+
+class FileIndex(object):
+    '''
+    Keep the lists of files and empty directories in each environment of the
+    file server in memory. A list is rebuilt when one of the directories in
+    the environment has changed, the directories are checked at most every
+    fileserver_list_cache_time seconds.
+    '''
+    def __init__(self, opts):
+        self.opts = opts
+        self.envs = {}
+
+    def _build(self, env):
+        '''
+        Walk the file roots of an environment and return its index
+        '''
+        files = set()
+        empty_dirs = set()
+        mtimes = {}
+        for path in self.opts['file_roots'][env]:
+            for root, dirs, fns in os.walk(path, followlinks=True):
+                try:
+                    mtimes[root] = os.stat(root).st_mtime
+                except OSError:
+                    continue
+                for fn_ in fns:
+                    files.add(os.path.relpath(os.path.join(root, fn_), path))
+                if not dirs and not fns:
+                    empty_dirs.add(os.path.relpath(root, path))
+        return {'files': sorted(files),
+                'empty_dirs': sorted(empty_dirs),
+                'mtimes': mtimes,
+                'checked': time.time()}
+
+    def _changed(self, index):
+        '''
+        Return True if a file or directory was added to or removed from any
+        of the directories in the index
+        '''
+        for path, mtime in index['mtimes'].items():
+            try:
+                if os.stat(path).st_mtime != mtime:
+                    return True
+            except OSError:
+                return True
+        return False
+
+    def _get(self, env):
+        '''
+        Return the index for an environment, rebuilding it if it is stale
+        '''
+        if env not in self.opts['file_roots']:
+            return None
+        index = self.envs.get(env)
+        now = time.time()
+        if index is None:
+            index = self.envs[env] = self._build(env)
+        elif now - index['checked'] >= self.opts['fileserver_list_cache_time']:
+            if self._changed(index):
+                log.debug('Rebuilding the file list for {0}'.format(env))
+                index = self.envs[env] = self._build(env)
+            else:
+                index['checked'] = now
+        return index
+
+    def _prefixed(self, items, prefix):
+        '''
+        Return the items in a sorted list which start with the prefix
+        '''
+        if not prefix:
+            return list(items)
+        start = end = bisect.bisect_left(items, prefix)
+        while end < len(items) and items[end].startswith(prefix):
+            end += 1
+        return items[start:end]
+
+    def file_list(self, env, prefix=''):
+        '''
+        Return the files in an environment, optionally only the files whose
+        path starts with the prefix
+        '''
+        index = self._get(env)
+        if index is None:
+            return []
+        return self._prefixed(index['files'], prefix)
+
+    def file_list_emptydirs(self, env, prefix=''):
+        '''
+        Return the empty directories in an environment, optionally only the
+        directories whose path starts with the prefix
+        '''
+        index = self._get(env)
+        if index is None:
+            return []
+        return self._prefixed(index['empty_dirs'], prefix)
+
+
+class ExtNodes(object):
+    '''
+    Run the external node classifier set in the external_nodes option. The
+    classes of each minion are cached under the cachedir for
+    ext_nodes_cache_ttl seconds. For ext_nodes_stale_time seconds after that
+    the cached classes are still returned while they are refreshed in the
+    background. At most ext_nodes_max_procs classifiers are run at once by
+    all of the processes sharing the cachedir.
+    '''
+    def __init__(self, opts):
+        self.opts = opts
+        self.serial = salt.payload.Serial(opts)
+        self.cache_dir = os.path.join(opts['cachedir'], 'ext_nodes')
+        self.stats_dir = os.path.join(self.cache_dir, '.stats')
+        self.stats = {'hits': 0,
+                      'stale': 0,
+                      'misses': 0,
+                      'runs': 0,
+                      'run_time': 0.0,
+                      'max_run_time': 0.0}
+        self._stats_written = 0
+
+    def _lock(self, path, block=True):
+        '''
+        Open and lock the named file, return None if block is False and the
+        file is locked by another process or thread
+        '''
+        if not os.path.isdir(os.path.dirname(path)):
+            os.makedirs(os.path.dirname(path))
+        fp_ = open(path, 'a')
+        if not HAS_FCNTL:
+            return fp_
+        flags = fcntl.LOCK_EX
+        if not block:
+            flags |= fcntl.LOCK_NB
+        try:
+            fcntl.flock(fp_.fileno(), flags)
+        except IOError:
+            fp_.close()
+            return None
+        return fp_
+
+    def _slot(self):
+        '''
+        Wait for one of the ext_nodes_max_procs classifier slots and return
+        its locked file
+        '''
+        slots = max(1, self.opts['ext_nodes_max_procs'])
+        while True:
+            for num in range(slots):
+                slot = self._lock(
+                        os.path.join(self.cache_dir, '.slots', str(num)),
+                        False)
+                if slot is not None:
+                    return slot
+            time.sleep(0.05)
+
+    def _count(self, key, run_time=None):
+        '''
+        Count a cache hit or miss and the time taken by a classifier run, the
+        counters of each process are written out at most every 10 seconds
+        '''
+        if key is not None:
+            self.stats[key] += 1
+        if run_time is not None:
+            self.stats['runs'] += 1
+            self.stats['run_time'] += run_time
+            self.stats['max_run_time'] = max(
+                    self.stats['max_run_time'], run_time)
+        if time.time() - self._stats_written < 10:
+            return
+        self._write(os.path.join(self.stats_dir, str(os.getpid())),
+                    self.stats)
+        self._stats_written = time.time()
+
+    def _write(self, path, data):
+        '''
+        Atomically write a cache file
+        '''
+        try:
+            if not os.path.isdir(os.path.dirname(path)):
+                os.makedirs(os.path.dirname(path))
+            fd_, tmp = tempfile.mkstemp(dir=os.path.dirname(path))
+            with os.fdopen(fd_, 'wb') as fp_:
+                fp_.write(self.serial.dumps(data))
+            os.rename(tmp, path)
+        except (IOError, OSError) as exc:
+            log.warning('Failed to write {0}: {1}'.format(path, exc))
+
+    def _read(self, id_):
+        '''
+        Return the cache entry of a minion, or None
+        '''
+        try:
+            with open(os.path.join(self.cache_dir, id_), 'rb') as fp_:
+                entry = self.serial.load(fp_)
+        except Exception:
+            return None
+        if not isinstance(entry, dict) or 'classes' not in entry:
+            return None
+        return entry
+
+    def _parse(self, ndata):
+        '''
+        Convert the output of the classifier into {'env': ['class', ...]}
+        '''
+        ret = {}
+        if not isinstance(ndata, dict):
+            return ret
+        if 'environment' in ndata:
+            env = ndata['environment']
+        else:
+            env = 'base'
+
+        if 'classes' in ndata:
+            if isinstance(ndata['classes'], dict):
+                ret[env] = list(ndata['classes'])
+            elif isinstance(ndata['classes'], list):
+                ret[env] = ndata['classes']
+        return ret
+
+    def run(self, id_, key=None):
+        '''
+        Run the classifier for a minion, return None if it failed. When the
+        cache is in use the run is counted, under key if one is given.
+        '''
+        cmd = '{0} {1}'.format(self.opts['external_nodes'], id_)
+        slot = self._slot()
+        start = time.time()
+        try:
+            proc = subprocess.Popen(cmd, shell=True, stdout=subprocess.PIPE)
+            out = proc.communicate()[0]
+        finally:
+            slot.close()
+        run_time = time.time() - start
+        log.debug('The external nodes classifier took {0:.3f} seconds for '
+                  '{1}'.format(run_time, id_))
+        if self.opts['ext_nodes_cache_ttl']:
+            self._count(key, run_time)
+        if proc.returncode:
+            log.error('The external nodes classifier failed for {0} with '
+                      'exit code {1}'.format(id_, proc.returncode))
+            return None
+        try:
+            return self._parse(yaml.safe_load(out))
+        except yaml.YAMLError as exc:
+            log.error('The external nodes classifier returned invalid yaml '
+                      'for {0}: {1}'.format(id_, exc))
+            return None
+
+    def _fetch(self, id_, key='misses'):
+        '''
+        Run the classifier and cache the classes it returned
+        '''
+        ret = self.run(id_, key)
+        if ret is None:
+            return {}
+        self._write(os.path.join(self.cache_dir, id_),
+                    {'classes': ret, 'time': time.time()})
+        return ret
+
+    def _refresh(self, id_):
+        '''
+        Refresh the cached classes of a minion in a background thread,
+        unless a refresh is already running
+        '''
+        lock = self._lock(
+                os.path.join(self.cache_dir, '.refresh', id_), False)
+        if lock is None:
+            return
+
+        def refresh():
+            try:
+                # The stale hit has already been counted
+                self._fetch(id_, None)
+            except Exception as exc:
+                log.error('Failed to refresh the external nodes data of '
+                          '{0}: {1}'.format(id_, exc))
+            finally:
+                lock.close()
+        thread = threading.Thread(target=refresh)
+        thread.daemon = True
+        thread.start()
+
+    def get(self, id_):
+        '''
+        Return the classes of a minion in the form {'env': ['class', ...]}
+        '''
+        if not self.opts['external_nodes']:
+            return {}
+        if not salt.utils.which(self.opts['external_nodes']):
+            log.error(('Specified external nodes controller {0} is not'
+                       ' available, please verify that it is installed'
+                       '').format(self.opts['external_nodes']))
+            return {}
+        ttl = self.opts['ext_nodes_cache_ttl']
+        if not ttl:
+            return self.run(id_) or {}
+        if not valid_id(id_):
+            log.error(('Not caching the external nodes data of {0!r}, the id'
+                       ' can not be used as a file name').format(id_))
+            return self.run(id_, 'misses') or {}
+        entry = self._read(id_)
+        if entry is not None:
+            age = time.time() - entry['time']
+            if age < ttl:
+                self._count('hits')
+                return entry['classes']
+            if age < ttl + self.opts['ext_nodes_stale_time']:
+                self._count('stale')
+                self._refresh(id_)
+                return entry['classes']
+        return self._fetch(id_)
+
+    def flush(self, id_=None):
+        '''
+        Remove the cached classes of a single minion, or of all minions
+        '''
+        if not os.path.isdir(self.cache_dir):
+            return []
+        if id_ is None:
+            ids = [fn_ for fn_ in os.listdir(self.cache_dir)
+                   if not fn_.startswith('.')]
+        elif valid_id(id_):
+            ids = [id_]
+        else:
+            return []
+        ret = []
+        for minion in ids:
+            path = os.path.join(self.cache_dir, minion)
+            if os.path.isfile(path):
+                os.remove(path)
+                ret.append(minion)
+        return ret
+
+    def read_stats(self):
+        '''
+        Return the counters summed over the processes using the cache. The
+        counters of processes which have exited are dropped.
+        '''
+        ret = dict((key, 0) for key in self.stats)
+        if not os.path.isdir(self.stats_dir):
+            return ret
+        for fn_ in os.listdir(self.stats_dir):
+            path = os.path.join(self.stats_dir, fn_)
+            if fn_.isdigit() and not pid_running(int(fn_)):
+                try:
+                    os.remove(path)
+                except OSError:
+                    pass
+                continue
+            try:
+                with open(path, 'rb') as fp_:
+                    stats = self.serial.load(fp_)
+            except Exception:
+                continue
+            for key in ret:
+                if key == 'max_run_time':
+                    ret[key] = max(ret[key], stats.get(key, 0))
+                else:
+                    ret[key] += stats.get(key, 0)
+        return ret
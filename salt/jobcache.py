@@ -0,0 +1,524 @@
+'''
+The job cache stores the invocation data and the returns of the jobs sent out
+by the master. The backend used is set with the ``job_cache_backend`` option:
+
+localfs
+    The default, each job is stored in a directory derived from the hash of
+    the jid and every minion return is stored in a directory of its own
+
+sqlite
+    An indexed store kept in a single sqlite database, jobs and returns are
+    looked up by jid or by minion id without walking the filesystem and
+    returns can be written in bulk
+'''
+
+# Import python libs
+import os
+import glob
+import shutil
+import logging
+import datetime
+
+# Import salt libs
+import salt.utils
+import salt.payload
+
+log = logging.getLogger(__name__)
+
+# sqlite3 is not always compiled into python
+try:
+    import sqlite3
+    HAS_SQLITE = True
+except ImportError:
+    HAS_SQLITE = False
+
+
+def get_job_cache(opts):
+    '''
+    Read in the ``job_cache_backend`` option and return the correct type of
+    job cache
+    '''
+    backend = opts.get('job_cache_backend', 'localfs')
+    if backend == 'sqlite' and not HAS_SQLITE:
+        log.error('The sqlite job cache was requested but the sqlite3 python '
+                  'module is not available, falling back to localfs')
+        backend = 'localfs'
+    try:
+        return {
+                'localfs': LocalFSJobCache,
+                'sqlite': SQLiteJobCache,
+               }[backend](opts)
+    except KeyError:
+        log.error('Unknown job_cache_backend {0}, falling back to '
+                  'localfs'.format(backend))
+        return LocalFSJobCache(opts)
+
+
+def gen_jid():
+    '''
+    Generate a jid, jids are based on the time so they sort by age
+    '''
+    return '{0:%Y%m%d%H%M%S%f}'.format(datetime.datetime.now())
+
+
+def jid_bucket(jid):
+    '''
+    Return the expiry bucket of a jid, the hour the job was created in.
+    Malformed jids land in a bucket which is always expired.
+    '''
+    if len(jid) < 18 or not jid.isdigit():
+        return '0000000000'
+    return jid[:10]
+
+
+def jid_cutoff(keep_jobs):
+    '''
+    Return the jid prefix before which jobs are older than keep_jobs hours
+    '''
+    cutoff = datetime.datetime.now() - datetime.timedelta(hours=keep_jobs)
+    return '{0:%Y%m%d%H}'.format(cutoff)
+
+
+class JobCache(object):
+    '''
+    Base class for the job cache backends. A backend provides:
+
+    prep_jid()
+        Generate a new jid and register the job in the cache
+    has_jid(jid)
+        Return True if the job is present in the cache
+    save_load(jid, load)
+        Save the invocation data of a job, the job is created if needed
+    get_load(jid)
+        Return the invocation data of a job, {} if it is unknown
+    save_return(load)
+        Save the return of a single minion, return False if the job is
+        unknown or the minion already returned for the job
+    get_returns(jid)
+        Return the returns of a job in the form
+        {<minion id>: {'ret': <return>, 'out': <outputter>}}
+    get_minion_jids(id_)
+        Return the sorted jids of the jobs the minion has returned for
+    list_jobs()
+        Return the invocation data of all of the jobs in the cache by jid
+    add_wtag(jid, id_), rm_wtag(jid, id_), has_wtag(jid)
+        Manage the write tags syndics lay down while they write the returns
+        of a job
+    clean_old_jobs()
+        Remove the jobs older than the keep_jobs option, return a dict with
+        the number of jobs reclaimed and the number of jobs retained
+
+    save_returns is built on save_return here, a backend which can write
+    returns in bulk overrides it.
+    '''
+    def __init__(self, opts):
+        self.opts = opts
+        self.serial = salt.payload.Serial(self.opts)
+
+    def save_returns(self, loads):
+        '''
+        Save a number of minion returns, returns the number of returns saved
+        '''
+        saved = 0
+        for load in loads:
+            if self.save_return(load):
+                saved += 1
+        return saved
+
+
+class LocalFSJobCache(JobCache):
+    '''
+    The job cache stored in hashed job directories under cachedir/jobs.
+
+    The jids of the jobs are also appended to an expiry index, one file per
+    hour under cachedir/jobs/.index, so that old jobs are found without
+    walking every job directory.
+    '''
+    def __init__(self, opts):
+        JobCache.__init__(self, opts)
+        self.job_dir = os.path.join(self.opts['cachedir'], 'jobs')
+        self.index_dir = os.path.join(self.job_dir, '.index')
+
+    def _index_jid(self, jid):
+        '''
+        Add the jid to its expiry bucket
+        '''
+        if not os.path.isdir(self.index_dir):
+            os.makedirs(self.index_dir)
+        # Appends this small are atomic, so the workers can share the file
+        with open(os.path.join(self.index_dir, jid_bucket(jid)), 'a') as fp_:
+            fp_.write('{0}\n'.format(jid))
+
+    def _build_index(self):
+        '''
+        Index the jobs which were stored before the expiry index existed,
+        this walks the job directories once
+        '''
+        log.info('Building the job cache expiry index')
+        indexed = set()
+        if os.path.isdir(self.index_dir):
+            for bucket in os.listdir(self.index_dir):
+                with open(os.path.join(self.index_dir, bucket), 'r') as fp_:
+                    indexed.update(fp_.read().split())
+        for f_path in self._iter_jid_dirs():
+            jid_file = os.path.join(f_path, 'jid')
+            if not os.path.isfile(jid_file):
+                continue
+            with open(jid_file, 'r') as fn_:
+                jid = fn_.read()
+            if jid not in indexed:
+                self._index_jid(jid)
+        with open(os.path.join(self.index_dir, '.built'), 'w+') as fp_:
+            fp_.write('')
+
+    def _jid_dir(self, jid):
+        '''
+        Return the directory for the jid
+        '''
+        return salt.utils.jid_dir(
+                jid,
+                self.opts['cachedir'],
+                self.opts['hash_type']
+                )
+
+    def prep_jid(self):
+        jid = salt.utils.prep_jid(
+                self.opts['cachedir'],
+                self.opts['hash_type']
+                )
+        self._index_jid(jid)
+        return jid
+
+    def has_jid(self, jid):
+        return os.path.isdir(self._jid_dir(jid))
+
+    def save_load(self, jid, load):
+        jid_dir = self._jid_dir(jid)
+        if not os.path.isdir(jid_dir):
+            os.makedirs(jid_dir)
+            with open(os.path.join(jid_dir, 'jid'), 'w+') as fn_:
+                fn_.write(jid)
+            self._index_jid(jid)
+        self.serial.dump(load, open(os.path.join(jid_dir, '.load.p'), 'w+'))
+
+    def get_load(self, jid):
+        loadp = os.path.join(self._jid_dir(jid), '.load.p')
+        if not os.path.isfile(loadp):
+            return {}
+        return self.serial.load(open(loadp, 'rb'))
+
+    def save_return(self, load):
+        jid_dir = self._jid_dir(load['jid'])
+        if not os.path.isdir(jid_dir):
+            log.error(
+                'An inconsistency occurred, a job was received with a job id '
+                'that is not present on the master: %(jid)s', load
+            )
+            return False
+        hn_dir = os.path.join(jid_dir, load['id'])
+        if not os.path.isdir(hn_dir):
+            os.makedirs(hn_dir)
+        # Otherwise the minion has already returned this jid and it should
+        # be dropped
+        else:
+            log.error(
+                    ('An extra return was detected from minion {0}, please'
+                    ' verify the minion, this could be a replay'
+                    ' attack').format(load['id'])
+                    )
+            return False
+        self.serial.dump(load['return'],
+                open(os.path.join(hn_dir, 'return.p'), 'w+'))
+        if 'out' in load:
+            self.serial.dump(load['out'],
+                    open(os.path.join(hn_dir, 'out.p'), 'w+'))
+        return True
+
+    def get_returns(self, jid):
+        ret = {}
+        jid_dir = self._jid_dir(jid)
+        if not os.path.isdir(jid_dir):
+            return ret
+        for fn_ in os.listdir(jid_dir):
+            if fn_.startswith('.'):
+                continue
+            retp = os.path.join(jid_dir, fn_, 'return.p')
+            outp = os.path.join(jid_dir, fn_, 'out.p')
+            if not os.path.isfile(retp):
+                continue
+            try:
+                ret[fn_] = {'ret': self.serial.load(open(retp, 'rb'))}
+                if os.path.isfile(outp):
+                    ret[fn_]['out'] = self.serial.load(open(outp, 'rb'))
+            except Exception:
+                # The return is still being written, skip it
+                ret.pop(fn_, None)
+        return ret
+
+    def _iter_jid_dirs(self):
+        '''
+        Walk over all of the job directories
+        '''
+        if not os.path.isdir(self.job_dir):
+            return
+        for top in os.listdir(self.job_dir):
+            if top.startswith('.'):
+                continue
+            t_path = os.path.join(self.job_dir, top)
+            if not os.path.isdir(t_path):
+                continue
+            for final in os.listdir(t_path):
+                yield os.path.join(t_path, final)
+
+    def get_minion_jids(self, id_):
+        # The hashed layout has no index by minion, walk the jobs
+        ret = []
+        for f_path in self._iter_jid_dirs():
+            if not os.path.isdir(os.path.join(f_path, id_)):
+                continue
+            jid_file = os.path.join(f_path, 'jid')
+            if os.path.isfile(jid_file):
+                with open(jid_file, 'r') as fn_:
+                    ret.append(fn_.read())
+        return sorted(ret)
+
+    def list_jobs(self):
+        ret = {}
+        for f_path in self._iter_jid_dirs():
+            loadpath = os.path.join(f_path, '.load.p')
+            if not os.path.isfile(loadpath):
+                continue
+            load = self.serial.load(open(loadpath, 'rb'))
+            ret[load['jid']] = load
+        return ret
+
+    def add_wtag(self, jid, id_):
+        wtag = os.path.join(self._jid_dir(jid), 'wtag_{0}'.format(id_))
+        with open(wtag, 'w+') as fp_:
+            fp_.write('')
+
+    def rm_wtag(self, jid, id_):
+        salt.utils.safe_rm(
+                os.path.join(self._jid_dir(jid), 'wtag_{0}'.format(id_))
+                )
+
+    def has_wtag(self, jid):
+        return bool(glob.glob(os.path.join(self._jid_dir(jid), 'wtag*')))
+
+    def clean_old_jobs(self):
+        stats = {'reclaimed': 0, 'retained': 0}
+        if self.opts['keep_jobs'] == 0:
+            return stats
+        if not os.path.isfile(os.path.join(self.index_dir, '.built')):
+            self._build_index()
+        cutoff = jid_cutoff(self.opts['keep_jobs'])
+        for bucket in os.listdir(self.index_dir):
+            if bucket.startswith('.'):
+                continue
+            b_path = os.path.join(self.index_dir, bucket)
+            with open(b_path, 'r') as fp_:
+                # A jid can be indexed more than once
+                jids = set(fp_.read().split())
+            if bucket >= cutoff:
+                # The kept buckets are left alone, the workers append to them
+                stats['retained'] += len(jids)
+                continue
+            for jid in jids:
+                jid_dir = self._jid_dir(jid)
+                if os.path.isdir(jid_dir):
+                    shutil.rmtree(jid_dir)
+                    stats['reclaimed'] += 1
+            os.remove(b_path)
+        return stats
+
+
+class SQLiteJobCache(JobCache):
+    '''
+    The job cache stored in an indexed sqlite database, cachedir/jobs.db
+    '''
+    def __init__(self, opts):
+        JobCache.__init__(self, opts)
+        self.db_path = os.path.join(self.opts['cachedir'], 'jobs.db')
+        self._conn = None
+        self._pid = None
+
+    @property
+    def conn(self):
+        '''
+        The database connection, connections are not shared with forked
+        processes
+        '''
+        if self._conn is None or self._pid != os.getpid():
+            self._conn = self._connect()
+            self._pid = os.getpid()
+        return self._conn
+
+    def _connect(self):
+        '''
+        Open the database and make sure that the schema is in place
+        '''
+        conn = sqlite3.connect(self.db_path, timeout=30)
+        conn.text_factory = str
+        # The write ahead log lets the client processes read while the
+        # master workers write
+        conn.execute('PRAGMA journal_mode=WAL')
+        conn.execute('PRAGMA synchronous=NORMAL')
+        with conn:
+            conn.execute('CREATE TABLE IF NOT EXISTS jobs '
+                         '(jid TEXT PRIMARY KEY, load BLOB)')
+            conn.execute('CREATE TABLE IF NOT EXISTS returns '
+                         '(jid TEXT, minion TEXT, ret BLOB, out BLOB, '
+                         'PRIMARY KEY (jid, minion))')
+            conn.execute('CREATE INDEX IF NOT EXISTS returns_minion '
+                         'ON returns (minion, jid)')
+            conn.execute('CREATE TABLE IF NOT EXISTS wtags '
+                         '(jid TEXT, minion TEXT, PRIMARY KEY (jid, minion))')
+        return conn
+
+    def _dumps(self, data):
+        return sqlite3.Binary(self.serial.dumps(data))
+
+    def _loads(self, data):
+        return self.serial.loads(str(data))
+
+    def prep_jid(self):
+        while True:
+            jid = gen_jid()
+            with self.conn:
+                cur = self.conn.execute(
+                        'INSERT OR IGNORE INTO jobs (jid) VALUES (?)', (jid,))
+            if cur.rowcount:
+                return jid
+
+    def has_jid(self, jid):
+        cur = self.conn.execute('SELECT 1 FROM jobs WHERE jid = ?', (jid,))
+        return cur.fetchone() is not None
+
+    def save_load(self, jid, load):
+        with self.conn:
+            self.conn.execute(
+                    'INSERT OR REPLACE INTO jobs (jid, load) VALUES (?, ?)',
+                    (jid, self._dumps(load)))
+
+    def get_load(self, jid):
+        cur = self.conn.execute('SELECT load FROM jobs WHERE jid = ?', (jid,))
+        row = cur.fetchone()
+        if row is None or row[0] is None:
+            return {}
+        return self._loads(row[0])
+
+    def _return_row(self, load):
+        '''
+        Convert a return load into a row for the returns table
+        '''
+        out = None
+        if 'out' in load:
+            out = self._dumps(load['out'])
+        return (load['jid'], load['id'], self._dumps(load['return']), out)
+
+    def save_return(self, load):
+        if not self.has_jid(load['jid']):
+            log.error(
+                'An inconsistency occurred, a job was received with a job id '
+                'that is not present on the master: %(jid)s', load
+            )
+            return False
+        try:
+            with self.conn:
+                self.conn.execute(
+                        'INSERT INTO returns (jid, minion, ret, out) '
+                        'VALUES (?, ?, ?, ?)',
+                        self._return_row(load))
+        except sqlite3.IntegrityError:
+            log.error(
+                    ('An extra return was detected from minion {0}, please'
+                    ' verify the minion, this could be a replay'
+                    ' attack').format(load['id'])
+                    )
+            return False
+        return True
+
+    def save_returns(self, loads):
+        rows = []
+        known = {}
+        for load in loads:
+            if load['jid'] not in known:
+                known[load['jid']] = self.has_jid(load['jid'])
+                if not known[load['jid']]:
+                    log.error(
+                        'An inconsistency occurred, a job was received with '
+                        'a job id that is not present on the master: '
+                        '%(jid)s', load
+                    )
+            if known[load['jid']]:
+                rows.append(self._return_row(load))
+        if not rows:
+            return 0
+        with self.conn:
+            before = self.conn.total_changes
+            self.conn.executemany(
+                    'INSERT OR IGNORE INTO returns (jid, minion, ret, out) '
+                    'VALUES (?, ?, ?, ?)',
+                    rows)
+            saved = self.conn.total_changes - before
+        if saved < len(rows):
+            log.error('{0} extra returns were detected and dropped, this '
+                      'could be a replay attack'.format(len(rows) - saved))
+        return saved
+
+    def get_returns(self, jid):
+        ret = {}
+        cur = self.conn.execute(
+                'SELECT minion, ret, out FROM returns WHERE jid = ?', (jid,))
+        for minion, ret_data, out in cur:
+            ret[minion] = {'ret': self._loads(ret_data)}
+            if out is not None:
+                ret[minion]['out'] = self._loads(out)
+        return ret
+
+    def get_minion_jids(self, id_):
+        cur = self.conn.execute(
+                'SELECT jid FROM returns WHERE minion = ? ORDER BY jid',
+                (id_,))
+        return [row[0] for row in cur]
+
+    def list_jobs(self):
+        ret = {}
+        cur = self.conn.execute(
+                'SELECT jid, load FROM jobs WHERE load IS NOT NULL')
+        for jid, load in cur:
+            ret[jid] = self._loads(load)
+        return ret
+
+    def add_wtag(self, jid, id_):
+        with self.conn:
+            self.conn.execute(
+                    'INSERT OR IGNORE INTO wtags (jid, minion) VALUES (?, ?)',
+                    (jid, id_))
+
+    def rm_wtag(self, jid, id_):
+        with self.conn:
+            self.conn.execute(
+                    'DELETE FROM wtags WHERE jid = ? AND minion = ?',
+                    (jid, id_))
+
+    def has_wtag(self, jid):
+        cur = self.conn.execute('SELECT 1 FROM wtags WHERE jid = ?', (jid,))
+        return cur.fetchone() is not None
+
+    def clean_old_jobs(self):
+        stats = {'reclaimed': 0, 'retained': 0}
+        if self.opts['keep_jobs'] == 0:
+            return stats
+        # jids start with the time they were made, so the old jobs are a
+        # range on the primary keys
+        cutoff = jid_cutoff(self.opts['keep_jobs'])
+        with self.conn:
+            for table in ('returns', 'wtags', 'jobs'):
+                cur = self.conn.execute(
+                        'DELETE FROM {0} WHERE jid < ?'.format(table),
+                        (cutoff,))
+            stats['reclaimed'] = cur.rowcount
+        cur = self.conn.execute('SELECT COUNT(*) FROM jobs')
+        stats['retained'] = cur.fetchone()[0]
+        return stats
@@ -9,20 +9,14 @@ import re
 import time
 import errno
 import signal
-import shutil
-import logging
 import hashlib
-import tempfile
-import datetime
-import subprocess
+import logging
+import collections
 import multiprocessing
 
 # Import zeromq
 import zmq
 
-# Import Third Party Libs
-import yaml
-
 # RSA Support
 from M2Crypto import RSA
 
@@ -31,10 +25,14 @@ import salt.crypt
 import salt.utils
 import salt.client
 import salt.payload
+import salt.jobcache
+import salt.fileserver
 import salt.pillar
 import salt.state
 import salt.runner
 import salt.utils.event
+from salt._compat import string_types
+from salt.exceptions import SaltReqTimeoutError
 from salt.utils.debug import enable_sigusr1_handler
 
 
@@ -57,7 +55,7 @@ def clean_proc(proc, wait_for_kill=10):
             if proc.is_alive() and (waited >= wait_for_kill):
                 log.error(('Process did not die with terminate(): {0}'
                     .format(proc.pid)))
-                os.kill(signal.SIGKILL, proc.pid)
+                os.kill(proc.pid, signal.SIGKILL)
     except (AssertionError, AttributeError) as e:
         # Catch AssertionError when the proc is evaluated inside the child
         # Catch AttributeError when the process dies between proc.is_alive()
@@ -65,6 +63,52 @@ def clean_proc(proc, wait_for_kill=10):
         pass
 
 
+def publish_topics(opts, key_registry, load):
+    '''
+    Return the topics a job is published on, or None to send it to every
+    minion. List, glob and pcre targets are matched against the accepted
+    minion keys and the job only goes to the buckets of the minions found.
+    '''
+    if not opts['publish_topics'] or opts['order_masters']:
+        return None
+    tgt_type = load.get('tgt_type', 'glob')
+    if tgt_type == 'list':
+        minions = key_registry.check_list(load['tgt'])
+    elif tgt_type == 'glob':
+        minions = key_registry.check_glob(load['tgt'])
+    elif tgt_type == 'pcre':
+        minions = key_registry.check_pcre(load['tgt'])
+    else:
+        return None
+    topics = set([salt.payload.pub_topic(id_, opts['publish_topics'])
+                  for id_ in minions])
+    if len(topics) >= 16 ** opts['publish_topics']:
+        return None
+    return sorted(topics)
+
+
+def proc_rss(pid):
+    '''
+    Return the resident memory of a process in bytes, or None where it can
+    not be read from /proc
+    '''
+    try:
+        with open('/proc/{0}/statm'.format(pid), 'r') as fp_:
+            return int(fp_.read().split()[1]) * os.sysconf('SC_PAGE_SIZE')
+    except (IOError, OSError, ValueError, IndexError):
+        return None
+
+
+def compile_pillar(pillar_cache, load):
+    '''
+    Compile the pillar requested by a minion, the pillar cache is used if it
+    is enabled
+    '''
+    if pillar_cache.opts['pillar_cache']:
+        return pillar_cache.get(load['id'], load['grains'], load['env'])
+    return pillar_cache.compile(load['id'], load['grains'], load['env'])
+
+
 class MasterExit(SystemExit):
     '''
     Named exit exception for the master process exiting
@@ -127,24 +171,13 @@ class Master(SMaster):
         '''
         if self.opts['keep_jobs'] == 0:
             return
-        jid_root = os.path.join(self.opts['cachedir'], 'jobs')
+        job_cache = salt.jobcache.get_job_cache(self.opts)
+        event = salt.utils.event.SaltEvent(self.opts['sock_dir'], 'master')
         while True:
-            cur = "{0:%Y%m%d%H}".format(datetime.datetime.now())
-
-            for top in os.listdir(jid_root):
-                t_path = os.path.join(jid_root, top)
-                for final in os.listdir(t_path):
-                    f_path = os.path.join(t_path, final)
-                    jid_file = os.path.join(f_path, 'jid')
-                    if not os.path.isfile(jid_file):
-                        continue
-                    with open(jid_file, 'r') as fn_:
-                        jid = fn_.read()
-                    if len(jid) < 18:
-                        # Invalid jid, scrub the dir
-                        shutil.rmtree(f_path)
-                    elif int(cur) - int(jid[:10]) > self.opts['keep_jobs']:
-                        shutil.rmtree(f_path)
+            stats = job_cache.clean_old_jobs()
+            log.debug(('Cleaned the job cache, {0[reclaimed]} jobs reclaimed'
+                       ' and {0[retained]} jobs retained').format(stats))
+            event.fire_event(stats, 'clear_old_jobs')
             try:
                 time.sleep(60)
             except KeyboardInterrupt:
@@ -167,6 +200,7 @@ class Master(SMaster):
                 self.master_key)
         reqserv.start_publisher()
         reqserv.start_event_publisher()
+        reqserv.start_pillar_pool()
 
         def sigterm_clean(signum, frame):
             '''
@@ -180,6 +214,7 @@ class Master(SMaster):
             clean_proc(clear_old_jobs_proc)
             clean_proc(reqserv.publisher)
             clean_proc(reqserv.eventpublisher)
+            clean_proc(reqserv.pillar_pool)
             for proc in reqserv.work_procs:
                 clean_proc(proc)
             raise MasterExit
@@ -198,10 +233,105 @@ class Publisher(multiprocessing.Process):
     '''
     The publishing interface, a simple zeromq publisher that sends out the
     commands.
+
+    Where zeromq can tell that a minion is not keeping up, XPUB_NODROP on
+    zeromq 4.1 and later, a publication is not dropped but held in a queue of
+    up to pub_queue_size publications until every minion can take it. A
+    publication held for longer than pub_queue_timeout is sent anyway and
+    the slow minions miss it, and the publications after it until they catch
+    up. Those publications are sent at once rather than held again, so a
+    minion which is hung does not hold back the others. With pub_rate set
+    the publications go out at no more than pub_rate a second. The counts
+    of sent, held back and dropped publications are fired on the master
+    event bus every ten seconds.
     '''
     def __init__(self, opts):
         super(Publisher, self).__init__()
         self.opts = opts
+        self.queue = collections.deque()
+        # The queued message already counted as delayed
+        self.held = None
+        # When publications are being sent without some slow minions, the
+        # last time one of them had no room for a publication
+        self.lagging = None
+        self.stats = {'sent': 0,
+                      'delayed': 0,
+                      'skipped': 0,
+                      'overflowed': 0,
+                      'peak': 0}
+
+    def _messages(self, frames):
+        '''
+        Return the messages to send for a package from the pull socket, the
+        package is followed by the topics to send it on
+        '''
+        if not self.opts['publish_topics'] or self.opts['order_masters']:
+            return [[frames[0]]]
+        return [[topic, frames[0]]
+                for topic in frames[1:] or [salt.payload.BROADCAST]]
+
+    def _enqueue(self, frames):
+        '''
+        Queue the messages for a package, dropping them if the queue is full
+        '''
+        now = time.time()
+        for msg in self._messages(frames):
+            if len(self.queue) >= self.opts['pub_queue_size']:
+                self.stats['overflowed'] += 1
+                log.warn(('The publish queue is full with {0} publications,'
+                          ' dropping a publication').format(len(self.queue)))
+                continue
+            self.queue.append((now, msg))
+        self.stats['peak'] = max(self.stats['peak'], len(self.queue))
+
+    def _flush(self, pub_sock, nodrop, allowance):
+        '''
+        Send the queued messages, no more than allowance of them. Returns the
+        number of messages sent.
+        '''
+        sent = 0
+        while self.queue and sent < allowance:
+            queued, msg = self.queue[0]
+            try:
+                pub_sock.send_multipart(msg, zmq.NOBLOCK)
+            except zmq.ZMQError as exc:
+                if exc.errno not in (errno.EAGAIN, errno.EINTR):
+                    raise exc
+                now = time.time()
+                if (self.lagging is None
+                        and now - queued < self.opts['pub_queue_timeout']):
+                    # A minion is behind, try again once it has caught up
+                    if self.held is not self.queue[0]:
+                        self.held = self.queue[0]
+                        self.stats['delayed'] += 1
+                    break
+                # Give up on the slow minions, the others get the message.
+                # The slow minions miss the publications after it as well
+                # until they have caught up, no publication waits for them
+                # again until then.
+                pub_sock.setsockopt(nodrop, 0)
+                pub_sock.send_multipart(msg)
+                pub_sock.setsockopt(nodrop, 1)
+                self.stats['skipped'] += 1
+                if self.lagging is None:
+                    log.warn(('A publication waited {0} seconds for slow'
+                              ' minions, the publications are sent without'
+                              ' them until they catch up').format(
+                                  self.opts['pub_queue_timeout']))
+                self.lagging = now
+            else:
+                if (self.lagging is not None
+                        and time.time() - self.lagging
+                            >= self.opts['pub_queue_timeout']):
+                    # Every minion has had room for the publications for a
+                    # while, the slow minions have caught up
+                    log.info('The slow minions have caught up with the'
+                             ' publications')
+                    self.lagging = None
+            self.queue.popleft()
+            self.stats['sent'] += 1
+            sent += 1
+        return sent
 
     def run(self):
         '''
@@ -210,14 +340,21 @@ class Publisher(multiprocessing.Process):
         # Set up the context
         context = zmq.Context(1)
         # Prepare minion publish socket
-        pub_sock = context.socket(zmq.PUB)
+        nodrop = getattr(zmq, 'XPUB_NODROP', None)
+        if nodrop is not None:
+            pub_sock = context.socket(zmq.XPUB)
+            pub_sock.setsockopt(nodrop, 1)
+        else:
+            pub_sock = context.socket(zmq.PUB)
+            log.info('zeromq can not report slow minions, publications to'
+                     ' them are dropped without being counted')
         # if 2.1 >= zmq < 3.0, we only have one HWM setting
         try:
-            pub_sock.setsockopt(zmq.HWM, 1)
+            pub_sock.setsockopt(zmq.HWM, self.opts['pub_hwm'])
         # in zmq >= 3.0, there are separate send and receive HWM settings
         except AttributeError:
-            pub_sock.setsockopt(zmq.SNDHWM, 1)
-            pub_sock.setsockopt(zmq.RCVHWM, 1)
+            pub_sock.setsockopt(zmq.SNDHWM, self.opts['pub_hwm'])
+            pub_sock.setsockopt(zmq.RCVHWM, self.opts['pub_hwm'])
         pub_uri = 'tcp://{0[interface]}:{0[publish_port]}'.format(self.opts)
         # Prepare minion pull socket
         pull_sock = context.socket(zmq.PULL)
@@ -234,14 +371,53 @@ class Publisher(multiprocessing.Process):
                     'publish_pull.ipc'),
                 448
                 )
+        event = salt.utils.event.SaltEvent(self.opts['sock_dir'], 'master')
+        poller = zmq.Poller()
+        poller.register(pull_sock, zmq.POLLIN)
+        if nodrop is not None:
+            poller.register(pub_sock, zmq.POLLIN)
+        rate = self.opts['pub_rate']
+        # A rate under one a second still has to let a whole publication out
+        burst = max(rate, 1)
+        allowance = burst
+        last = last_stats = time.time()
 
         try:
             while True:
                 # Catch and handle EINTR from when this process is sent
                 # SIGUSR1 gracefully so we don't choke and die horribly
                 try:
-                    package = pull_sock.recv()
-                    pub_sock.send(package)
+                    socks = dict(poller.poll(10 if self.queue else 1000))
+                    if socks.get(pull_sock) == zmq.POLLIN:
+                        while True:
+                            try:
+                                self._enqueue(
+                                        pull_sock.recv_multipart(zmq.NOBLOCK))
+                            except zmq.ZMQError as exc:
+                                if exc.errno == errno.EAGAIN:
+                                    break
+                                raise exc
+                    if socks.get(pub_sock) == zmq.POLLIN:
+                        # Nothing is done with the subscriptions, but they
+                        # have to be read
+                        while pub_sock.poll(0):
+                            pub_sock.recv()
+                    now = time.time()
+                    if rate:
+                        # Pace the publications to pub_rate a second
+                        allowance = min(burst, allowance + (now - last) * rate)
+                        last = now
+                        if self.queue and allowance >= 1:
+                            allowance -= self._flush(
+                                    pub_sock, nodrop, int(allowance))
+                    elif self.queue:
+                        self._flush(pub_sock, nodrop, len(self.queue))
+                    if now - last_stats >= 10:
+                        event.fire_event(
+                                dict(self.stats, queued=len(self.queue)),
+                                'publisher')
+                        self.stats['peak'] = len(self.queue)
+                        last_stats = now
                 except zmq.ZMQError as exc:
                     if exc.errno == errno.EINTR:
                         continue
@@ -251,6 +427,606 @@ class Publisher(multiprocessing.Process):
             pull_sock.close()
 
 
+class PublishChannel(object):
+    '''
+    A long lived PUSH connection to the publisher's pull socket. A master
+    worker holds a single channel and reuses it for every publish instead of
+    building a new zeromq context and socket per job. The number of messages
+    sent is logged every minute while the channel is in use and when it is
+    closed.
+    '''
+    def __init__(self, opts, linger=1000):
+        self.opts = opts
+        self.serial = salt.payload.Serial(opts)
+        self.linger = linger
+        self.pull_uri = 'ipc://{0}'.format(
+                os.path.join(self.opts['sock_dir'], 'publish_pull.ipc')
+                )
+        self.context = None
+        self.socket = None
+        self.pid = None
+        self.sent = 0
+        self.last_log = time.time()
+
+    def connect(self):
+        '''
+        Connect to the publisher, a connection inherited across a fork is
+        dropped and made again since zeromq sockets cannot be shared between
+        processes
+        '''
+        if self.socket is not None and self.pid == os.getpid():
+            return
+        self.context = zmq.Context(1)
+        self.socket = self.context.socket(zmq.PUSH)
+        # Messages still queued when the channel is closed get up to
+        # "linger" milliseconds to reach the publisher
+        self.socket.setsockopt(zmq.LINGER, self.linger)
+        self.socket.connect(self.pull_uri)
+        self.pid = os.getpid()
+
+    def send(self, payload, topics=None):
+        '''
+        Serialize the payload and hand it to the publisher. The payload is
+        sent on the given topics, or to every minion when topics is None.
+        '''
+        if topics is not None and not topics:
+            # No minion can be sent the payload
+            return
+        self.connect()
+        self.socket.send_multipart(
+                [self.serial.dumps(payload)] + list(topics or []))
+        self.sent += 1
+        now = time.time()
+        if now - self.last_log >= 60:
+            log.debug('Publish channel has sent {0} messages'.format(
+                self.sent))
+            self.last_log = now
+
+    def close(self):
+        '''
+        Flush any queued messages within the linger period and release the
+        socket and context
+        '''
+        if self.socket is None:
+            return
+        if self.pid == os.getpid():
+            self.socket.close()
+            self.context.term()
+        log.debug('Closed publish channel after {0} messages'.format(
+            self.sent))
+        self.socket = None
+        self.context = None
+
+
+class PillarPool(multiprocessing.Process):
+    '''
+    Compile pillars in a bounded pool of processes so that slow pillars do
+    not hold up the master workers' other requests. Concurrent requests for
+    the same pillar are compiled once. A request not answered within
+    pillar_timeout seconds of being received, whether it is still queued or
+    being compiled, fails and a compile still running is killed.
+    '''
+    def __init__(self, opts, factory=None):
+        super(PillarPool, self).__init__()
+        self.opts = opts
+        self.serial = salt.payload.Serial(opts)
+        self.w_uri = 'ipc://{0}'.format(
+                os.path.join(self.opts['sock_dir'], 'pillar_workers.ipc')
+                )
+        self.factory = factory or self._make_worker
+        self.children = {}
+        self.spawned = 0
+        # The requests by minion and pillar fingerprint, the keys of those
+        # not yet handed to a process in the order they came in, and the
+        # processes waiting for a pillar to compile
+        self.jobs = {}
+        self.queue = collections.deque()
+        self.idle = collections.deque()
+        # Killed processes which have not exited yet, with the time they
+        # were told to stop
+        self.dying = []
+        self.stats = {'compiled': 0,
+                      'deduplicated': 0,
+                      'expired': 0,
+                      'timed_out': 0}
+
+    def _make_worker(self, ident):
+        '''
+        Return a pillar compiling process
+        '''
+        return PillarPoolWorker(self.opts, ident, self.w_uri)
+
+    def _spawn(self):
+        '''
+        Start a pillar compiling process
+        '''
+        self.spawned += 1
+        ident = 'pillar-{0}'.format(self.spawned)
+        proc = self.factory(ident)
+        proc.start()
+        self.children[ident] = {'proc': proc, 'key': None}
+
+    def _kill(self, ident):
+        '''
+        Tell a pillar compiling process to stop without waiting for it, so
+        that the other requests are not held up
+        '''
+        child = self.children.pop(ident)
+        if ident in self.idle:
+            self.idle.remove(ident)
+        try:
+            child['proc'].terminate()
+        except (AssertionError, AttributeError, OSError):
+            pass
+        self.dying.append((child['proc'], time.time()))
+
+    def _reap(self, now):
+        '''
+        Forget the killed processes which have exited, and kill the ones
+        which ignored being told to stop
+        '''
+        dying = []
+        for proc, since in self.dying:
+            if not proc.is_alive():
+                continue
+            if now - since > 1:
+                log.error(('Process did not die with terminate(): {0}'
+                    .format(proc.pid)))
+                try:
+                    os.kill(proc.pid, signal.SIGKILL)
+                except OSError:
+                    pass
+            dying.append((proc, since))
+        self.dying = dying
+
+    def _reply(self, front, job, ret):
+        '''
+        Send the compiled pillar to every master worker waiting for it
+        '''
+        package = self.serial.dumps(ret)
+        for envelope in job['waiters']:
+            front.send_multipart(envelope + [package])
+
+    def submit(self, front, frames):
+        '''
+        Queue a pillar request from a master worker
+        '''
+        load = self.serial.loads(frames[-1]).get('load', {})
+        if 'id' not in load or 'grains' not in load:
+            front.send_multipart(frames[:-1] + [self.serial.dumps(False)])
+            return
+        key = (load['id'],
+               salt.pillar.fingerprint(load['grains'], load.get('env')))
+        if key in self.jobs:
+            self.stats['deduplicated'] += 1
+        else:
+            self.jobs[key] = {'load': load,
+                              'waiters': [],
+                              'queued': time.time()}
+            self.queue.append(key)
+        self.jobs[key]['waiters'].append(frames[:-1])
+
+    def finish(self, front, ident, package):
+        '''
+        Handle a message from a pillar compiling process, either a compiled
+        pillar or that the process is ready
+        '''
+        child = self.children.get(ident)
+        if child is None:
+            return
+        if child['key'] in self.jobs:
+            self.stats['compiled'] += 1
+            self._reply(front,
+                        self.jobs.pop(child['key']),
+                        self.serial.loads(package))
+        child['key'] = None
+        self.idle.append(ident)
+
+    def maintain(self, front, now):
+        '''
+        Fail the requests which have waited too long, kill the compiles
+        running for them and replace dead processes
+        '''
+        timeout = self.opts['pillar_timeout']
+        for key in list(self.queue):
+            if now - self.jobs[key]['queued'] <= timeout:
+                continue
+            self.stats['expired'] += 1
+            log.error(('The pillar for {0} waited longer than {1} seconds to'
+                       ' be compiled, giving up').format(key[0], timeout))
+            self.queue.remove(key)
+            self._reply(front, self.jobs.pop(key), False)
+        for ident, child in list(self.children.items()):
+            timed_out = child['key'] is not None and \
+                    now - self.jobs[child['key']]['queued'] > timeout
+            if not timed_out and child['proc'].is_alive():
+                continue
+            if timed_out:
+                self.stats['timed_out'] += 1
+                log.error(('Compiling the pillar for {0} took longer than {1}'
+                           ' seconds, giving up').format(
+                               child['key'][0], timeout))
+            if child['key'] in self.jobs:
+                self._reply(front, self.jobs.pop(child['key']), False)
+            self._kill(ident)
+            self._spawn()
+        self._reap(now)
+
+    def dispatch(self, back):
+        '''
+        Hand the queued requests to the idle processes
+        '''
+        while self.queue and self.idle:
+            ident = self.idle.popleft()
+            key = self.queue.popleft()
+            self.children[ident]['key'] = key
+            back.send_multipart(
+                    [ident, '', self.serial.dumps(self.jobs[key]['load'])]
+                    )
+
+    def run(self):
+        '''
+        Bind the pool sockets and hand out the pillar requests
+        '''
+        context = zmq.Context(1)
+        front = context.socket(zmq.ROUTER)
+        back = context.socket(zmq.ROUTER)
+        front_uri = 'ipc://{0}'.format(
+                os.path.join(self.opts['sock_dir'], 'pillar_pool.ipc')
+                )
+        front.bind(front_uri)
+        back.bind(self.w_uri)
+        # Restrict access to the sockets
+        for fn_ in ('pillar_pool.ipc', 'pillar_workers.ipc'):
+            os.chmod(os.path.join(self.opts['sock_dir'], fn_), 448)
+        event = salt.utils.event.SaltEvent(self.opts['sock_dir'], 'master')
+        poller = zmq.Poller()
+        poller.register(front, zmq.POLLIN)
+        poller.register(back, zmq.POLLIN)
+        for ind in range(self.opts['pillar_pool_size']):
+            self._spawn()
+
+        def sigterm_clean(signum, frame):
+            '''
+            Stop the compiling processes along with the pool
+            '''
+            raise KeyboardInterrupt
+
+        signal.signal(signal.SIGTERM, sigterm_clean)
+        last_stats = time.time()
+        try:
+            while True:
+                try:
+                    socks = dict(poller.poll(100 if self.dying else 1000))
+                except zmq.ZMQError as exc:
+                    if exc.errno == errno.EINTR:
+                        continue
+                    raise exc
+                if socks.get(front) == zmq.POLLIN:
+                    self.submit(front, front.recv_multipart())
+                if socks.get(back) == zmq.POLLIN:
+                    ident, _, package = back.recv_multipart()
+                    self.finish(front, ident, package)
+                now = time.time()
+                self.maintain(front, now)
+                self.dispatch(back)
+                if now - last_stats >= 10:
+                    stats = dict(self.stats, queued=len(self.queue),
+                                 running=len(self.children) - len(self.idle))
+                    event.fire_event(stats, 'pillar_pool')
+                    last_stats = now
+        except KeyboardInterrupt:
+            for child in self.children.values():
+                clean_proc(child['proc'])
+            for proc, _ in self.dying:
+                clean_proc(proc)
+            front.close()
+            back.close()
+
+
+class PillarPoolWorker(multiprocessing.Process):
+    '''
+    A process of the pillar pool, it compiles one pillar at a time
+    '''
+    def __init__(self, opts, identity, uri):
+        super(PillarPoolWorker, self).__init__()
+        self.opts = opts
+        self.identity = identity
+        self.uri = uri
+        self.serial = salt.payload.Serial(opts)
+
+    def run(self):
+        '''
+        Ask the pool for pillars to compile
+        '''
+        pillar_cache = salt.pillar.PillarCache(self.opts)
+        context = zmq.Context(1)
+        socket = context.socket(zmq.REQ)
+        socket.setsockopt(zmq.IDENTITY, self.identity)
+        socket.connect(self.uri)
+        # Tell the pool this process is ready
+        socket.send(self.serial.dumps(None))
+        try:
+            while True:
+                try:
+                    load = self.serial.loads(socket.recv())
+                except zmq.ZMQError as exc:
+                    if exc.errno == errno.EINTR:
+                        continue
+                    raise exc
+                try:
+                    ret = compile_pillar(pillar_cache, load)
+                except Exception as exc:
+                    log.error(
+                            'Failed to compile the pillar for {0}: {1}'.format(
+                                load['id'], exc)
+                            )
+                    ret = False
+                socket.send(self.serial.dumps(ret))
+        except KeyboardInterrupt:
+            socket.close()
+
+
+class WorkerPool(object):
+    '''
+    A pool of master worker processes fed from a queue kept by the request
+    server. Because the request server knows which workers are busy, the
+    pool can grow while requests are waiting, shrink once workers have been
+    idle for worker_idle_time, and replace workers which hang or grow too
+    large.
+
+    The requests are queued in lanes by their command. The lanes with
+    waiting requests share the idle workers by their weights, and a lane can
+    hold workers back which only it may use, so that quick requests such as
+    returns are not stuck behind file transfers and pillar compiles.
+    '''
+    def __init__(self,
+            opts,
+            name,
+            factory,
+            socket,
+            min_procs,
+            max_procs,
+            lanes=None):
+        self.opts = opts
+        self.name = name
+        self.factory = factory
+        self.socket = socket
+        self.lanes = {'default': {'weight': 1, 'reserved': 0}}
+        # The lane of each command, the commands of no lane go to default
+        self.lane_cmds = {}
+        for lane, conf in (lanes or {}).items():
+            self.lanes[lane] = {'weight': max(conf.get('weight', 1), 1),
+                                'reserved': conf.get('reserved', 0)}
+            for cmd in conf.get('cmds', []):
+                self.lane_cmds[cmd] = lane
+        reserved = sum(lane['reserved'] for lane in self.lanes.values())
+        # Leave at least one worker which every lane may use
+        self.min_procs = max(min_procs, reserved + 1)
+        self.max_procs = max(self.min_procs, max_procs)
+        self.children = {}
+        self.spawned = 0
+        self.queues = dict((lane, collections.deque()) for lane in self.lanes)
+        # The lanes take turns in the order of their pass, which grows by the
+        # inverse of the weight of the lane with every request handed out
+        self.passes = dict((lane, 0.0) for lane in self.lanes)
+        self.vtime = 0.0
+        self.busy = dict((lane, 0) for lane in self.lanes)
+        # The idle workers, the longest idle first
+        self.idle = []
+        self.busy_time = 0
+        self.last_stats = time.time()
+        self.last_check = 0
+        self.last_grow = 0
+        self.stats = {'handled': 0,
+                      'started': 0,
+                      'retired': 0,
+                      'hung': 0,
+                      'oversized': 0,
+                      'died': 0}
+
+    @property
+    def procs(self):
+        '''
+        The worker processes in the pool
+        '''
+        return [child['proc'] for child in self.children.values()]
+
+    def spawn(self):
+        '''
+        Start a worker process, it is handed requests once it reports in
+        '''
+        self.spawned += 1
+        ident = '{0}-{1}'.format(self.name, self.spawned)
+        log.info('Starting Salt worker process {0}'.format(ident))
+        proc = self.factory(ident)
+        proc.start()
+        self.children[ident] = {'proc': proc,
+                                'ready': False,
+                                'start': None,
+                                'lane': None,
+                                'envelope': None,
+                                'idle_since': time.time()}
+        self.stats['started'] += 1
+
+    def retire(self, ident):
+        '''
+        Stop a worker process, return the envelope of the request it was
+        handling
+        '''
+        child = self.children.pop(ident)
+        if ident in self.idle:
+            self.idle.remove(ident)
+        if child['lane'] is not None:
+            self.busy[child['lane']] -= 1
+        clean_proc(child['proc'])
+        return child['envelope']
+
+    @property
+    def queued(self):
+        '''
+        The number of requests waiting for a worker
+        '''
+        return sum(len(queue) for queue in self.queues.values())
+
+    def submit(self, frames, cmd=None):
+        '''
+        Queue a request from a minion in the lane of its command
+        '''
+        lane = self.lane_cmds.get(cmd, 'default')
+        if not self.queues[lane]:
+            # A lane does not save up turns while it has nothing waiting
+            self.passes[lane] = max(self.passes[lane], self.vtime)
+        self.queues[lane].append(frames)
+        self.dispatch()
+
+    def _next_lane(self):
+        '''
+        Return the lane to hand the next idle worker to, or None
+        '''
+        held = dict((lane, max(conf['reserved'] - self.busy[lane], 0))
+                    for lane, conf in self.lanes.items())
+        total = sum(held.values())
+        ready = [lane for lane, queue in self.queues.items()
+                 if queue and len(self.idle) > total - held[lane]]
+        if not ready:
+            return None
+        return min(ready, key=lambda lane: (self.passes[lane], lane))
+
+    def dispatch(self):
+        '''
+        Hand the queued requests to the idle workers
+        '''
+        now = time.time()
+        while self.idle:
+            lane = self._next_lane()
+            if lane is None:
+                break
+            self.vtime = self.passes[lane]
+            self.passes[lane] += 1.0 / self.lanes[lane]['weight']
+            # Use the most recently idle worker, so that the others stay idle
+            # long enough to be retired when the load drops
+            ident = self.idle.pop()
+            frames = self.queues[lane].popleft()
+            self.busy[lane] += 1
+            self.children[ident]['start'] = now
+            self.children[ident]['lane'] = lane
+            self.children[ident]['envelope'] = tuple(frames[:-1])
+            self.socket.send_multipart([ident, ''] + frames)
+
+    def receive(self):
+        '''
+        Read a message from a worker. Return the reply to send to the minion,
+        or None when the worker only reported that it is ready.
+        '''
+        frames = self.socket.recv_multipart()
+        ident, reply = frames[0], frames[2:]
+        child = self.children.get(ident)
+        if child is not None:
+            now = time.time()
+            if child['start'] is not None:
+                self.busy_time += now - max(child['start'], self.last_stats)
+                self.busy[child['lane']] -= 1
+                self.stats['handled'] += 1
+            child['ready'] = True
+            child['start'] = None
+            child['lane'] = None
+            child['envelope'] = None
+            child['idle_since'] = now
+            self.idle.append(ident)
+            self.dispatch()
+        if len(reply) > 1:
+            return reply
+        return None
+
+    def maintain(self):
+        '''
+        Replace dead, hung and oversized workers and grow or shrink the pool.
+        Return the envelopes of the requests lost with the workers.
+        '''
+        now = time.time()
+        lost = []
+        for ident, child in list(self.children.items()):
+            if not child['proc'].is_alive():
+                self.stats['died'] += 1
+                log.error('Salt worker process {0} died'.format(ident))
+            elif child['start'] is not None and \
+                    self.opts['worker_timeout'] and \
+                    now - child['start'] > self.opts['worker_timeout']:
+                self.stats['hung'] += 1
+                log.error(
+                        ('Salt worker process {0} took longer than {1}'
+                         ' seconds to handle a request, restarting it').format(
+                             ident, self.opts['worker_timeout'])
+                        )
+            else:
+                continue
+            lost.append(self.retire(ident))
+        if self.opts['worker_max_memory'] and now - self.last_check >= 10:
+            # Only idle workers are checked, a busy one is left to finish
+            self.last_check = now
+            limit = self.opts['worker_max_memory'] * 1024 * 1024
+            for ident in list(self.idle):
+                rss = proc_rss(self.children[ident]['proc'].pid)
+                if rss is not None and rss > limit:
+                    self.stats['oversized'] += 1
+                    log.warn(
+                            ('Salt worker process {0} is using {1} bytes of'
+                             ' memory, restarting it').format(ident, rss)
+                            )
+                    self.retire(ident)
+        starting = [child for child in self.children.values()
+                    if not child['ready']]
+        while len(self.children) < self.min_procs:
+            self.spawn()
+        queued = self.queued
+        # A worker is added at most every two seconds, so that a short burst
+        # of requests does not start many workers which then sit idle
+        if queued and not starting and now - self.last_grow >= 2 and \
+                len(self.children) < self.max_procs:
+            self.last_grow = now
+            self.spawn()
+        elif not queued and self.idle and \
+                len(self.children) > self.min_procs:
+            ident = self.idle[0]
+            idle = now - self.children[ident]['idle_since']
+            if idle > self.opts['worker_idle_time']:
+                log.info(
+                        ('Salt worker process {0} has been idle for {1:.0f}'
+                         ' seconds, stopping it').format(ident, idle)
+                        )
+                self.stats['retired'] += 1
+                self.retire(ident)
+        return [envelope for envelope in lost if envelope is not None]
+
+    def read_stats(self):
+        '''
+        Return the state of the pool and the share of the time since the last
+        call the workers spent handling requests
+        '''
+        now = time.time()
+        busy_time = self.busy_time
+        busy = 0
+        for child in self.children.values():
+            if child['start'] is not None:
+                busy += 1
+                busy_time += now - max(child['start'], self.last_stats)
+        elapsed = (now - self.last_stats) * len(self.children)
+        ret = dict(self.stats,
+                   pool=self.name,
+                   workers=len(self.children),
+                   busy=busy,
+                   idle=len(self.idle),
+                   queued=self.queued,
+                   lanes=dict((lane, {'queued': len(self.queues[lane]),
+                                      'busy': self.busy[lane]})
+                              for lane in self.lanes),
+                   utilisation=round(busy_time / elapsed, 3) if elapsed else 0)
+        self.busy_time = 0
+        self.last_stats = now
+        return ret
+
+
 class ReqServer(object):
     '''
     Starts up the master request server, minions send results to this
@@ -263,41 +1039,155 @@ class ReqServer(object):
         # Prepare the zeromq sockets
         self.uri = 'tcp://%(interface)s:%(ret_port)s' % self.opts
         self.clients = self.context.socket(zmq.ROUTER)
-        self.workers = self.context.socket(zmq.DEALER)
+        self.workers = self.context.socket(zmq.ROUTER)
         self.w_uri = 'ipc://{0}'.format(
             os.path.join(self.opts['sock_dir'], 'workers.ipc')
             )
+        self.auth_workers = self.context.socket(zmq.ROUTER)
+        self.a_uri = 'ipc://{0}'.format(
+            os.path.join(self.opts['sock_dir'], 'auth_workers.ipc')
+            )
+        self.serial = salt.payload.Serial(opts)
+        self.pools = {}
         # Prepare the AES key
         self.key = key
         self.crypticle = crypticle
 
+    @property
+    def work_procs(self):
+        '''
+        The worker processes of every pool
+        '''
+        procs = []
+        for pool in self.pools.values():
+            procs.extend(pool.procs)
+        return procs
+
+    def _make_worker(self, worker_class):
+        '''
+        Return a function which creates a worker of the given class
+        '''
+        def factory(ident):
+            return worker_class(self.opts,
+                                self.master_key,
+                                self.key,
+                                self.crypticle,
+                                ident)
+        return factory
+
     def __bind(self):
         '''
         Binds the reply server
         '''
         log.info('Setting up the master communication server')
         self.clients.bind(self.uri)
-        self.work_procs = []
-
-        for ind in range(int(self.opts['worker_threads'])):
-            self.work_procs.append(MWorker(self.opts,
-                    self.master_key,
-                    self.key,
-                    self.crypticle))
-
-        for ind, proc in enumerate(self.work_procs):
-            log.info('Starting Salt worker process {0}'.format(ind))
-            proc.start()
-
         self.workers.bind(self.w_uri)
+        self.auth_workers.bind(self.a_uri)
+        self.pools['workers'] = WorkerPool(
+                self.opts,
+                'worker',
+                self._make_worker(MWorker),
+                self.workers,
+                int(self.opts['worker_threads']),
+                int(self.opts['worker_threads_max']),
+                self.opts['worker_lanes'])
+        if self.opts['auth_workers']:
+            self.pools['auth'] = WorkerPool(
+                    self.opts,
+                    'auth',
+                    self._make_worker(AuthWorker),
+                    self.auth_workers,
+                    int(self.opts['auth_workers']),
+                    int(self.opts['auth_workers']))
+        for pool in self.pools.values():
+            pool.maintain()
+        self.__broker()
+
+    def _request_cmd(self, package):
+        '''
+        Return the command of a request. Requests carry their command in the
+        clear next to the load, only those fields are read so that the
+        broker never decodes the load of a large job return.
+        '''
+        try:
+            payload = self.serial.loads_keys(package, ('cmd', 'enc'))
+            cmd = payload.get('cmd')
+            if cmd is None and payload.get('enc') == 'clear' and \
+                    len(package) < 65536:
+                # A request from an older minion, clear requests such as
+                # sign ins are small
+                cmd = self.serial.loads(package)['load']['cmd']
+        except Exception:
+            return None
+        if isinstance(cmd, string_types):
+            return cmd
+        return None
 
+    def _admit(self, frames, auths, busy):
+        '''
+        Queue a request from a minion for its worker pool. A sign in is
+        turned away with the busy reply while auth_queue_size of them, whose
+        envelopes are in auths, are being handled.
+        '''
+        cmd = self._request_cmd(frames[-1])
+        if cmd != '_auth':
+            self.pools['workers'].submit(frames, cmd)
+        elif len(auths) >= self.opts['auth_queue_size']:
+            self.clients.send_multipart(frames[:-1] + [busy])
+        else:
+            auths.add(tuple(frames[:-1]))
+            self.pools.get('auth', self.pools['workers']).submit(frames, cmd)
+
+    def __broker(self):
+        '''
+        Queue the requests from the minions for the worker pools, in the lanes
+        set in worker_lanes, and pass the replies back. Sign ins go to the
+        auth workers, when auth_workers is 0 they go to the master workers,
+        and no more than auth_queue_size of them are handled at once. Sign
+        ins over the limit are told to try again after auth_retry_after
+        seconds. The pools are maintained once a second, and every ten
+        seconds the state of the pools is fired on the master event bus.
+        '''
+        busy = self.serial.dumps(
+                {'enc': 'clear',
+                 'load': {'ret': True,
+                          'retry_after': self.opts['auth_retry_after']}})
+        # The envelopes of the sign ins being handled
+        auths = set()
+        event = salt.utils.event.SaltEvent(self.opts['sock_dir'], 'master')
+        poller = zmq.Poller()
+        poller.register(self.clients, zmq.POLLIN)
+        for pool in self.pools.values():
+            poller.register(pool.socket, zmq.POLLIN)
+        last_stats = last_maintain = time.time()
         while True:
             try:
-                zmq.device(zmq.QUEUE, self.clients, self.workers)
+                socks = dict(poller.poll(1000))
             except zmq.ZMQError as exc:
                 if exc.errno == errno.EINTR:
                     continue
                 raise exc
+            if socks.get(self.clients) == zmq.POLLIN:
+                self._admit(self.clients.recv_multipart(), auths, busy)
+            for pool in self.pools.values():
+                if socks.get(pool.socket) == zmq.POLLIN:
+                    frames = pool.receive()
+                    if frames is not None:
+                        if auths and '' in frames:
+                            # The envelope ends at the first empty frame
+                            auths.discard(
+                                    tuple(frames[:frames.index('') + 1]))
+                        self.clients.send_multipart(frames)
+            now = time.time()
+            if now - last_maintain >= 1:
+                for pool in self.pools.values():
+                    for envelope in pool.maintain():
+                        auths.discard(envelope)
+                last_maintain = now
+            if now - last_stats >= 10:
+                for pool in self.pools.values():
+                    event.fire_event(pool.read_stats(), 'worker_pool')
+                last_stats = now
 
     def start_publisher(self):
         '''
@@ -308,6 +1198,15 @@ class ReqServer(object):
         self.publisher.start()
 
 
+    def start_pillar_pool(self):
+        '''
+        Start the pillar compiling pool
+        '''
+        self.pillar_pool = None
+        if self.opts['pillar_pool_size']:
+            self.pillar_pool = PillarPool(self.opts)
+            self.pillar_pool.start()
+
     def start_event_publisher(self):
         '''
         Start the salt publisher interface
@@ -328,13 +1227,18 @@ class MWorker(multiprocessing.Process):
     The worker multiprocess instance to manage the backend operations for the
     salt master.
     '''
+    # The socket the request server hands the requests out on
+    sock_name = 'workers.ipc'
+
     def __init__(self,
             opts,
             mkey,
             key,
-            crypticle):
+            crypticle,
+            identity=None):
         multiprocessing.Process.__init__(self)
         self.opts = opts
+        self.identity = identity
         self.serial = salt.payload.Serial(opts)
         self.crypticle = crypticle
         self.mkey = mkey
@@ -345,20 +1249,35 @@ class MWorker(multiprocessing.Process):
         Bind to the local port
         '''
         context = zmq.Context(1)
-        socket = context.socket(zmq.REP)
+        socket = context.socket(zmq.REQ)
+        if self.identity:
+            socket.setsockopt(zmq.IDENTITY, self.identity)
         w_uri = 'ipc://{0}'.format(
-            os.path.join(self.opts['sock_dir'], 'workers.ipc')
+            os.path.join(self.opts['sock_dir'], self.sock_name)
             )
         log.info('Worker binding to socket {0}'.format(w_uri))
         try:
             socket.connect(w_uri)
+            # Tell the request server this worker is ready
+            socket.send(self.serial.dumps(None))
 
             while True:
                 try:
-                    package = socket.recv()
-                    payload = self.serial.loads(package)
-                    ret = self.serial.dumps(self._handle_payload(payload))
-                    socket.send(ret)
+                    frames = socket.recv_multipart()
+                    # The request is preceded by the envelope of the minion
+                    envelope = frames[:-1]
+                    payload = self.serial.loads(frames[-1])
+                    ret = self._handle_payload(payload)
+                    if isinstance(ret, tuple):
+                        # The reply carries raw data frames after the load
+                        socket.send_multipart(
+                                envelope +
+                                [self.serial.dumps(ret[0])] +
+                                list(ret[1:])
+                                )
+                    else:
+                        socket.send_multipart(
+                                envelope + [self.serial.dumps(ret)])
                 # Properly handle EINTR from SIGUSR1
                 except zmq.ZMQError as exc:
                     if exc.errno == errno.EINTR:
@@ -366,6 +1285,7 @@ class MWorker(multiprocessing.Process):
                     raise exc
         except KeyboardInterrupt:
             socket.close()
+            self.pub_channel.close()
 
     def _handle_payload(self, payload):
         '''
@@ -409,17 +1329,71 @@ class MWorker(multiprocessing.Process):
         log.info('AES payload received with command {0}'.format(data['cmd']))
         return self.aes_funcs.run_func(data['cmd'], data)
 
+    def _make_funcs(self):
+        '''
+        Set up the objects which carry out the requests
+        '''
+        self.pub_channel = PublishChannel(self.opts)
+        self.key_registry = salt.crypt.KeyRegistry(self.opts)
+        self.clear_funcs = ClearFuncs(
+                self.opts,
+                self.key,
+                self.mkey,
+                self.crypticle,
+                self.pub_channel,
+                self.key_registry)
+        self.aes_funcs = AESFuncs(
+                self.opts,
+                self.crypticle,
+                self.pub_channel,
+                self.key_registry)
+
     def run(self):
         '''
         Start a Master Worker
         '''
+        def sigterm_clean(signum, frame):
+            '''
+            Close the sockets and the publish channel along with the worker
+            '''
+            raise KeyboardInterrupt
+
+        signal.signal(signal.SIGTERM, sigterm_clean)
+        self._make_funcs()
+        self.__bind()
+
+
+class AuthWorker(MWorker):
+    '''
+    A worker which only handles sign ins, so that a flood of sign ins does
+    not hold up the returns and other requests from the minions
+    '''
+    sock_name = 'auth_workers.ipc'
+
+    def _handle_payload(self, payload):
+        '''
+        Only clear sign in requests are handled
+        '''
+        try:
+            if payload['enc'] != 'clear' or payload['load']['cmd'] != '_auth':
+                return ''
+        except (KeyError, TypeError):
+            return ''
+        return self.clear_funcs._auth(payload['load'])
+
+    def _make_funcs(self):
+        '''
+        Only the ClearFuncs are needed to handle sign ins
+        '''
+        self.pub_channel = PublishChannel(self.opts)
+        self.key_registry = salt.crypt.KeyRegistry(self.opts)
         self.clear_funcs = ClearFuncs(
                 self.opts,
                 self.key,
                 self.mkey,
-                self.crypticle)
-        self.aes_funcs = AESFuncs(self.opts, self.crypticle)
-        self.__bind()
+                self.crypticle,
+                self.pub_channel,
+                self.key_registry)
 
 
 class AESFuncs(object):
@@ -428,16 +1402,27 @@ class AESFuncs(object):
     '''
     # The AES Functions:
     #
-    def __init__(self, opts, crypticle):
+    def __init__(self, opts, crypticle, pub_channel=None, key_registry=None):
         self.opts = opts
+        self.pub_channel = pub_channel or PublishChannel(self.opts)
+        self.key_registry = key_registry or salt.crypt.KeyRegistry(self.opts)
         self.event = salt.utils.event.SaltEvent(
                 self.opts['sock_dir'],
                 'master'
                 )
         self.serial = salt.payload.Serial(opts)
         self.crypticle = crypticle
+        self.job_cache = salt.jobcache.get_job_cache(self.opts)
+        self.hash_cache = salt.fileserver.HashCache(self.opts)
+        self.file_index = salt.fileserver.FileIndex(self.opts)
+        self.ext_nodes = salt.fileserver.ExtNodes(self.opts)
+        self.pillar_cache = salt.pillar.PillarCache(self.opts)
+        self.pillar_pool_uri = 'ipc://{0}'.format(
+                os.path.join(self.opts['sock_dir'], 'pillar_pool.ipc')
+                )
         # Make a client
         self.local = salt.client.LocalClient(self.opts['conf_file'])
+        self.local.key_registry = self.key_registry
 
     def __find_file(self, path, env='base'):
         '''
@@ -460,26 +1445,17 @@ class AESFuncs(object):
         Take a minion id and a string signed with the minion private key
         The string needs to verify as 'salt' with the minion public key
         '''
-        pub_path = os.path.join(self.opts['pki_dir'], 'minions', id_)
-        with open(pub_path, 'r') as fp_:
-            minion_pub = fp_.read()
-        fd_, tmp_pub = tempfile.mkstemp()
-        os.close(fd_)
-        with open(tmp_pub, 'w+') as fp_:
-            fp_.write(minion_pub)
-
-        pub = None
-        try:
-            pub = RSA.load_pub_key(tmp_pub)
-        except RSA.RSAError, e:
-            log.error('Unable to load temporary public key "{0}": {1}'
-                      .format(tmp_pub, e))
-        try:
-            os.remove(tmp_pub)
-            if pub.public_decrypt(token, 5) == 'salt':
-                return True
-        except RSA.RSAError, e:
-            log.error('Unable to decrypt token: {0}'.format(e))
+        for attempt in range(2):
+            pub = self.key_registry.get_rsa(id_)
+            if pub is not None:
+                try:
+                    if pub.public_decrypt(token, 5) == 'salt':
+                        return True
+                except RSA.RSAError, e:
+                    log.error('Unable to decrypt token: {0}'.format(e))
+            # The key may have been replaced by another process, read it
+            # again before giving up
+            self.key_registry.reload(id_)
 
         log.error('Salt minion claiming to be {0} has attempted to'
                   'communicate with the master and could not be verified'
@@ -494,34 +1470,7 @@ class AESFuncs(object):
         if not 'id' in load:
             log.error('Received call for external nodes without an id')
             return {}
-        if not self.opts['external_nodes']:
-            return {}
-        if not salt.utils.which(self.opts['external_nodes']):
-            log.error(('Specified external nodes controller {0} is not'
-                       ' available, please verify that it is installed'
-                       '').format(self.opts['external_nodes']))
-            return {}
-        cmd = '{0} {1}'.format(self.opts['external_nodes'], load['id'])
-        ndata = yaml.safe_load(
-                subprocess.Popen(
-                    cmd,
-                    shell=True,
-                    stdout=subprocess.PIPE
-                    ).communicate()[0])
-        ret = {}
-        if 'environment' in ndata:
-            env = ndata['environment']
-        else:
-            env = 'base'
-
-        if 'classes' in ndata:
-            if isinstance(ndata['classes'], dict):
-                ret[env] = list(ndata['classes'])
-            elif isinstance(ndata['classes'], list):
-                ret[env] = ndata['classes']
-            else:
-                return ret
-        return ret
+        return self.ext_nodes.get(load['id'])
 
     def _serve_file(self, load):
         '''
@@ -540,6 +1489,31 @@ class AESFuncs(object):
             ret['data'] = fp_.read(self.opts['file_buffer_size'])
         return ret
 
+    def _serve_file_raw(self, load):
+        '''
+        Return a chunk from a file with the file data kept out of the load,
+        the chunk is sent as a separate raw frame after the load. The load
+        carries the file size and chunk size so that the client can request
+        several chunks at once, and the digest of the chunk so that the
+        client can tell the chunk belongs to the load.
+        '''
+        ret = {'dest': '',
+               'loc': 0,
+               'size': 0,
+               'chunk': self.opts['file_buffer_size']}
+        data = ''
+        if 'path' in load and 'loc' in load and 'env' in load:
+            ret['loc'] = load['loc']
+            fnd = self.__find_file(load['path'], load['env'])
+            if fnd['path']:
+                ret['dest'] = fnd['rel']
+                with open(fnd['path'], 'rb') as fp_:
+                    ret['size'] = os.fstat(fp_.fileno()).st_size
+                    fp_.seek(load['loc'])
+                    data = fp_.read(self.opts['file_buffer_size'])
+        ret['sum'] = hashlib.sha256(data).hexdigest()
+        return ret, data
+
     def _file_hash(self, load):
         '''
         Return a file hash, the hash type is set in the master config file
@@ -550,46 +1524,31 @@ class AESFuncs(object):
         if not path:
             return {}
         ret = {}
-        with open(path, 'rb') as fp_:
-            ret['hsum'] = getattr(hashlib, self.opts['hash_type'])(
-                    fp_.read()).hexdigest()
+        ret['hsum'] = self.hash_cache.get(path)
+        if not ret['hsum']:
+            return {}
         ret['hash_type'] = self.opts['hash_type']
         return ret
 
     def _file_list(self, load):
         '''
         Return a list of all files on the file server in a specified
-        environment
+        environment, if a prefix is passed only the files under it are
+        returned
         '''
-        ret = []
-        if load['env'] not in self.opts['file_roots']:
-            return ret
-        for path in self.opts['file_roots'][load['env']]:
-            for root, dirs, files in os.walk(path, followlinks=True):
-                for fn in files:
-                    ret.append(
-                        os.path.relpath(
-                            os.path.join(
-                                root,
-                                fn
-                                ),
-                            path
-                            )
-                        )
-        return ret
+        if 'env' not in load:
+            return []
+        return self.file_index.file_list(load['env'], load.get('prefix', ''))
 
     def _file_list_emptydirs(self, load):
         '''
         Return a list of all empty directories on the master
         '''
-        ret = []
-        if load['env'] not in self.opts['file_roots']:
-            return ret
-        for path in self.opts['file_roots'][load['env']]:
-            for root, dirs, files in os.walk(path, followlinks=True):
-                if len(dirs) == 0 and len(files) == 0:
-                    ret.append(os.path.relpath(root, path))
-        return ret
+        if 'env' not in load:
+            return []
+        return self.file_index.file_list_emptydirs(
+                load['env'],
+                load.get('prefix', ''))
 
     def _master_opts(self, load):
         '''
@@ -603,12 +1562,19 @@ class AESFuncs(object):
         '''
         if 'id' not in load or 'grains' not in load or 'env' not in load:
             return False
-        pillar = salt.pillar.Pillar(
-                self.opts,
-                load['grains'],
-                load['id'],
-                load['env'])
-        return pillar.compile_pillar()
+        if self.opts['pillar_pool_size']:
+            # Hand the request to the pillar pool
+            sreq = salt.payload.SREQ(self.pillar_pool_uri)
+            try:
+                # The pool fails the request itself after pillar_timeout,
+                # give its answer time to arrive
+                return sreq.send(
+                        'clear', load, 1, self.opts['pillar_timeout'] + 5)
+            except SaltReqTimeoutError:
+                log.error(('Timed out compiling the pillar for {0[id]} in the'
+                           ' pillar pool').format(load))
+                return False
+        return compile_pillar(self.pillar_cache, load)
 
     def _master_state(self, load):
         '''
@@ -644,34 +1610,28 @@ class AESFuncs(object):
         self.event.fire_event(load, load['jid'])
         if not self.opts['job_cache']:
             return
-        jid_dir = salt.utils.jid_dir(
-                load['jid'],
-                self.opts['cachedir'],
-                self.opts['hash_type']
-                )
-        if not os.path.isdir(jid_dir):
-            log.error(
-                'An inconsistency occurred, a job was received with a job id '
-                'that is not present on the master: %(jid)s', load
-            )
+        if not self.job_cache.save_return(load):
             return False
-        hn_dir = os.path.join(jid_dir, load['id'])
-        if not os.path.isdir(hn_dir):
-            os.makedirs(hn_dir)
-        # Otherwise the minion has already returned this jid and it should
-        # be dropped
-        else:
-            log.error(
-                    ('An extra return was detected from minion {0}, please'
-                    ' verify the minion, this could be a replay'
-                    ' attack').format(load['id'])
-                    )
+
+    def _return_batch(self, load):
+        '''
+        Handle a batch of returns coalesced by a minion, each return is
+        fired on the event bus and the batch is saved to the job cache in one
+        call
+        '''
+        if 'returns' not in load or 'id' not in load:
             return False
-        self.serial.dump(load['return'],
-                open(os.path.join(hn_dir, 'return.p'), 'w+'))
-        if 'out' in load:
-            self.serial.dump(load['out'],
-                    open(os.path.join(hn_dir, 'out.p'), 'w+'))
+        loads = []
+        for ret in load['returns']:
+            if 'return' not in ret or 'jid' not in ret:
+                continue
+            ret['id'] = load['id']
+            log.info('Got return from {0[id]} for job {0[jid]}'.format(ret))
+            self.event.fire_event(ret, ret['jid'])
+            loads.append(ret)
+        if self.opts['job_cache'] and loads:
+            self.job_cache.save_returns(loads)
+        return True
 
     def _syndic_return(self, load):
         '''
@@ -681,22 +1641,15 @@ class AESFuncs(object):
         # Verify the load
         if 'return' not in load or 'jid' not in load or 'id' not in load:
             return None
-        # set the write flag
-        jid_dir = salt.utils.jid_dir(
-                load['jid'],
-                self.opts['cachedir'],
-                self.opts['hash_type']
-                )
-        if not os.path.isdir(jid_dir):
+        if not self.job_cache.has_jid(load['jid']):
             log.error(
                 'An inconsistency occurred, a job was received with a job id '
                 'that is not present on the master: %(jid)s', load
             )
             return False
-        wtag = os.path.join(jid_dir, 'wtag_{0}'.format(load['id']))
+        # set the write flag
         try:
-            with open(wtag, 'w+') as fp_:
-                fp_.write('')
+            self.job_cache.add_wtag(load['jid'], load['id'])
         except (IOError, OSError):
             log.error(
                     ('Failed to commit the write tag for the syndic return,'
@@ -706,13 +1659,16 @@ class AESFuncs(object):
             return False
 
         # Format individual return loads
+        loads = []
         for key, item in load['return'].items():
             ret = {'jid': load['jid'],
                    'id': key,
                    'return': item}
-            self._return(ret)
-        if os.path.isfile(wtag):
-            os.remove(wtag)
+            self.event.fire_event(ret, load['jid'])
+            loads.append(ret)
+        if self.opts['job_cache']:
+            self.job_cache.save_returns(loads)
+        self.job_cache.rm_wtag(load['jid'], load['id'])
 
     def minion_runner(self, clear_load):
         '''
@@ -823,10 +1779,7 @@ class AESFuncs(object):
         if not good:
             return {}
         # Set up the publication payload
-        jid = salt.utils.prep_jid(
-                self.opts['cachedir'],
-                self.opts['hash_type']
-                )
+        jid = self.job_cache.prep_jid()
         load = {
                 'fun': clear_load['fun'],
                 'arg': clear_load['arg'],
@@ -836,18 +1789,7 @@ class AESFuncs(object):
                 'ret': clear_load['ret'],
                 'id': clear_load['id'],
                }
-        self.serial.dump(
-                load, open(
-                    os.path.join(
-                        salt.utils.jid_dir(
-                            jid,
-                            self.opts['cachedir'],
-                            self.opts['hash_type']
-                            ),
-                        '.load.p'
-                        ),
-                    'w+')
-                )
+        self.job_cache.save_load(jid, load)
         payload = {'enc': 'aes'}
         expr_form = 'glob'
         timeout = 5
@@ -863,33 +1805,32 @@ class AESFuncs(object):
             expr_form = load['tgt_type']
         if 'timeout' in clear_load:
             timeout = clear_load['timeout']
-        # Encrypt!
-        payload['load'] = self.crypticle.dumps(load)
-        # Connect to the publisher
-        context = zmq.Context(1)
-        pub_sock = context.socket(zmq.PUSH)
-        pull_uri = 'ipc://{0}'.format(
-            os.path.join(self.opts['sock_dir'], 'publish_pull.ipc')
-            )
-        pub_sock.connect(pull_uri)
-        log.info(('Publishing minion job: #{0[jid]}, func: "{0[fun]}", args:'
-                  ' "{0[arg]}", target: "{0[tgt]}"').format(load))
-        pub_sock.send(self.serial.dumps(payload))
-        # Run the client get_returns method based on the form data sent
+        # The client get_returns method is picked by the form data sent
         if 'form' in clear_load:
             ret_form = clear_load['form']
         else:
             ret_form = 'clean'
-        if ret_form == 'clean':
-            return self.local.get_returns(
-                    jid,
-                    self.local.check_minions(
-                        clear_load['tgt'],
-                        expr_form
-                        ),
-                    timeout
-                    )
-        elif ret_form == 'full':
+        if ret_form not in ('clean', 'full'):
+            return {}
+        # Encrypt!
+        payload['load'] = self.crypticle.dumps(load)
+        log.info(('Publishing minion job: #{0[jid]}, func: "{0[fun]}", args:'
+                  ' "{0[arg]}", target: "{0[tgt]}"').format(load))
+        # Listen for the returns before the job goes out
+        self.local.event.subscribe(jid)
+        try:
+            self.pub_channel.send(
+                    payload,
+                    publish_topics(self.opts, self.key_registry, load))
+            if ret_form == 'clean':
+                return self.local.get_returns(
+                        jid,
+                        self.local.check_minions(
+                            clear_load['tgt'],
+                            expr_form
+                            ),
+                        timeout
+                        )
             ret = self.local.get_full_returns(
                     jid,
                     self.local.check_minions(
@@ -900,6 +1841,9 @@ class AESFuncs(object):
                     )
             ret['__jid__'] = jid
             return ret
+        finally:
+            # The worker lives on, events held for the job would pile up
+            self.local.event.unsubscribe(jid)
 
     def run_func(self, func, load):
         '''
@@ -915,10 +1859,14 @@ class AESFuncs(object):
             log.error(('Received function {0} which in unavailable on the '
                        'master, returning False').format(exc))
             return self.crypticle.dumps(False)
-        # Don't encrypt the return value for the _return func
+        # Don't encrypt the return value for the _return funcs
         # (we don't care about the return value, so why encrypt it?)
-        if func == '_return':
+        if func in ('_return', '_return_batch'):
             return ret
+        if func == '_serve_file_raw':
+            # Encrypt the load and the raw file data frames on their own
+            return (self.crypticle.dumps(ret[0]),
+                    self.crypticle.encrypt(ret[1]))
         # AES Encrypt the return
         return self.crypticle.dumps(ret)
 
@@ -932,12 +1880,20 @@ class ClearFuncs(object):
     # the clear:
     # publish (The publish from the LocalClient)
     # _auth
-    def __init__(self, opts, key, master_key, crypticle):
+    def __init__(self, opts, key, master_key, crypticle, pub_channel=None,
+            key_registry=None):
         self.opts = opts
+        self.pub_channel = pub_channel or PublishChannel(self.opts)
+        self.key_registry = key_registry or salt.crypt.KeyRegistry(self.opts)
         self.serial = salt.payload.Serial(opts)
         self.key = key
         self.master_key = master_key
+        self.master_pub = master_key.get_pub_str()
+        # The sign in replies sent to each minion, the aes key encrypted with
+        # the minion key is used again until either key changes
+        self.auth_envelopes = {}
         self.crypticle = crypticle
+        self.job_cache = salt.jobcache.get_job_cache(self.opts)
         # Create the event manager
         self.event = salt.utils.event.SaltEvent(
                 self.opts['sock_dir'],
@@ -945,6 +1901,7 @@ class ClearFuncs(object):
                 )
         # Make a client
         self.local = salt.client.LocalClient(self.opts['conf_file'])
+        self.local.key_registry = self.key_registry
 
     def _send_cluster(self):
         '''
@@ -979,6 +1936,16 @@ class ClearFuncs(object):
                 master_pem,
                 self.opts['conf_file']]
 
+    def _key_matches(self, id_, pub, state):
+        '''
+        Return True if the stored key of the minion is the key it sent, the
+        stored key is read again before a mismatch is reported
+        '''
+        if self.key_registry.get_pub(id_, state) == pub:
+            return True
+        self.key_registry.reload(id_, state)
+        return self.key_registry.get_pub(id_, state) == pub
+
     def _auth(self, load):
         '''
         Authenticate the client, use the sent public key to encrypt the aes key
@@ -994,22 +1961,17 @@ class ClearFuncs(object):
         # 4. encrypt the aes key as an encrypted salt.payload
         # 5. package the return and return it
         log.info('Authentication request from %(id)s', load)
-        pubfn = os.path.join(self.opts['pki_dir'],
-                'minions',
-                load['id'])
-        pubfn_pend = os.path.join(self.opts['pki_dir'],
-                'minions_pre',
-                load['id'])
-        pubfn_rejected = os.path.join(self.opts['pki_dir'],
-                'minions_rejected',
-                load['id'])
+        accepted = load['id'] in self.key_registry.list_keys('minions')
+        pending = load['id'] in self.key_registry.list_keys('minions_pre')
+        rejected = load['id'] in self.key_registry.list_keys(
+                'minions_rejected')
         if self.opts['open_mode']:
             # open mode is turned on, nuts to checks and overwrite whatever
             # is there
             pass
-        elif os.path.isfile(pubfn):
+        elif accepted:
             # The key has been accepted check it
-            if not open(pubfn, 'r').read() == load['pub']:
+            if not self._key_matches(load['id'], load['pub'], 'minions'):
                 log.error(
                     'Authentication attempt from %(id)s failed, the public '
                     'keys did not match. This may be an attempt to compromise '
@@ -1022,7 +1984,7 @@ class ClearFuncs(object):
                          'pub': load['pub']}
                 self.event.fire_event(eload, 'auth')
                 return ret
-        elif os.path.isfile(pubfn_rejected):
+        elif rejected:
             # The key has been rejected, don't place it in pending
             log.info('Public key rejected for %(id)s', load)
             ret = {'enc': 'clear',
@@ -1032,12 +1994,10 @@ class ClearFuncs(object):
                      'pub': load['pub']}
             self.event.fire_event(eload, 'auth')
             return ret
-        elif not os.path.isfile(pubfn_pend)\
-                and not self.opts['auto_accept']:
+        elif not pending and not self.opts['auto_accept']:
             # This is a new key, stick it in pre
             log.info('New public key placed in pending for %(id)s', load)
-            with open(pubfn_pend, 'w+') as fp_:
-                fp_.write(load['pub'])
+            self.key_registry.set_pub(load['id'], load['pub'], 'minions_pre')
             ret = {'enc': 'clear',
                    'load': {'ret': True}}
             eload = {'result': True,
@@ -1046,11 +2006,11 @@ class ClearFuncs(object):
                      'pub': load['pub']}
             self.event.fire_event(eload, 'auth')
             return ret
-        elif os.path.isfile(pubfn_pend)\
-                and not self.opts['auto_accept']:
+        elif pending and not self.opts['auto_accept']:
             # This key is in pending, if it is the same key ret True, else
             # ret False
-            if not open(pubfn_pend, 'r').read() == load['pub']:
+            if not self._key_matches(
+                    load['id'], load['pub'], 'minions_pre'):
                 log.error(
                     'Authentication attempt from %(id)s failed, the public '
                     'keys in pending did not match. This may be an attempt to '
@@ -1075,8 +2035,7 @@ class ClearFuncs(object):
                 self.event.fire_event(eload, 'auth')
                 return {'enc': 'clear',
                         'load': {'ret': True}}
-        elif not os.path.isfile(pubfn_pend)\
-                and self.opts['auto_accept']:
+        elif not pending and self.opts['auto_accept']:
             # This is a new key and auto_accept is turned on
             pass
         else:
@@ -1090,25 +2049,31 @@ class ClearFuncs(object):
                     'load': {'ret': False}}
 
         log.info('Authentication accepted from %(id)s', load)
-        with open(pubfn, 'w+') as fp_:
-            fp_.write(load['pub'])
-        pub = None
+        if self.key_registry.get_pub(load['id']) != load['pub']:
+            self.key_registry.set_pub(load['id'], load['pub'])
 
-        # The key payload may sometimes be corrupt when using auto-accept
-        # and an empty request comes in
-        try:
-            pub = RSA.load_pub_key(pubfn)
-        except RSA.RSAError, e:
-            log.error('Corrupt public key "{0}": {1}'.format(pubfn, e))
-            return {'enc': 'clear',
-                    'load': {'ret': False}}
+        cached = self.auth_envelopes.get(load['id'])
+        if cached is not None and cached[0] == (load['pub'], self.opts['aes']):
+            ret = dict(cached[1])
+        else:
+            # The key payload may sometimes be corrupt when using auto-accept
+            # and an empty request comes in
+            pub = self.key_registry.get_rsa(load['id'])
+            if pub is None:
+                return {'enc': 'clear',
+                        'load': {'ret': False}}
 
-        ret = {'enc': 'pub',
-               'pub_key': self.master_key.get_pub_str(),
-               'token': self.master_key.token,
-               'publish_port': self.opts['publish_port'],
-              }
-        ret['aes'] = pub.public_encrypt(self.opts['aes'], 4)
+            ret = {'enc': 'pub',
+                   'pub_key': self.master_pub,
+                   'token': self.master_key.token,
+                   'publish_port': self.opts['publish_port'],
+                  }
+            if self.opts['publish_topics'] and not self.opts['order_masters']:
+                # Tell the minion which topics to subscribe to
+                ret['publish_topics'] = self.opts['publish_topics']
+            ret['aes'] = pub.public_encrypt(self.opts['aes'], 4)
+            self.auth_envelopes[load['id']] = (
+                    (load['pub'], self.opts['aes']), ret)
         eload = {'result': True,
                  'act': 'accept',
                  'id': load['id'],
@@ -1124,19 +2089,8 @@ class ClearFuncs(object):
         # Verify that the caller has root on master
         if not clear_load.pop('key') == self.key:
             return ''
-        jid_dir = salt.utils.jid_dir(
-                clear_load['jid'],
-                self.opts['cachedir'],
-                self.opts['hash_type']
-                )
-        # Verify the jid dir
-        if not os.path.isdir(jid_dir):
-            os.makedirs(jid_dir)
         # Save the invocation information
-        self.serial.dump(
-                clear_load,
-                open(os.path.join(jid_dir, '.load.p'), 'w+')
-                )
+        self.job_cache.save_load(clear_load['jid'], clear_load)
         # Set up the payload
         payload = {'enc': 'aes'}
         # Altering the contents of the publish load is serious!! Changes here
@@ -1171,12 +2125,8 @@ class ClearFuncs(object):
 
         payload['load'] = self.crypticle.dumps(load)
         # Send 0MQ to the publisher
-        context = zmq.Context(1)
-        pub_sock = context.socket(zmq.PUSH)
-        pull_uri = 'ipc://{0}'.format(
-            os.path.join(self.opts['sock_dir'], 'publish_pull.ipc')
-            )
-        pub_sock.connect(pull_uri)
-        pub_sock.send(self.serial.dumps(payload))
+        self.pub_channel.send(
+                payload,
+                publish_topics(self.opts, self.key_registry, load))
         return {'enc': 'clear',
                 'load': {'jid': clear_load['jid']}}
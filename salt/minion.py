@@ -7,9 +7,16 @@ Routines to set up a minion
 import logging
 import multiprocessing
 
+import copy
+import errno
 import fnmatch
+import hashlib
+import heapq
 import os
+import pprint
+import random
 import re
+import signal
 import threading
 import time
 import traceback
@@ -26,6 +33,8 @@ import salt.crypt
 import salt.loader
 import salt.utils
 import salt.payload
+import salt.utils.event
+import salt.utils.spool
 from salt._compat import string_types
 from salt.utils.debug import enable_sigusr1_handler
 
@@ -39,6 +48,14 @@ log = logging.getLogger(__name__)
 # 5. connect to the publisher
 # 6. handle publications
 
+# The functions which look into or stop the other jobs, they are run at once
+# even when every process of the job pool is busy
+POOL_BYPASS = ('saltutil.running',
+               'saltutil.find_job',
+               'saltutil.signal_job',
+               'saltutil.term_job',
+               'saltutil.kill_job')
+
 
 def get_proc_dir(cachedir):
     '''
@@ -131,17 +148,35 @@ class Minion(object):
         self.functions, self.returners = self.__load_modules()
         self.matcher = Matcher(self.opts, self.functions)
         self.proc_dir = get_proc_dir(opts['cachedir'])
+        self._return_queue = []
+        self._return_queue_start = 0
+        self.return_spool = salt.utils.spool.Spool(
+                self.opts,
+                os.path.join(self.opts['cachedir'], 'return_spool')
+                )
+        self._spool_next = 0
+        # Check the spool for returns left by an earlier run
+        self._spool_pending = bool(self.opts['return_spool'])
+        # The module refresh waiting to be done, True to refresh the pillar
+        self._refresh = None
+        # When the main loop is to sign in again after the master AES key
+        # changed, and the publications waiting for the new key
+        self._reauth_at = None
+        self._held_pubs = []
+        self.job_pool = None
+        # The jobs running in processes of their own by jid, with the data
+        # saltutil.running reports for them
+        self.jobs = {}
         if hasattr(self, '_syndic') and self._syndic:
             log.warn('Starting the Salt Syndic Minion')
         else:
             log.warn('Starting the Salt Minion')
         self.authenticate()
-        opts['pillar'] = salt.pillar.get_pillar(
-            opts,
-            opts['grains'],
-            opts['id'],
-            opts['environment'],
-            ).compile_pillar()
+        opts['pillar'] = self._compile_pillar()
+        if opts['pillar'] is None:
+            # Start with an empty pillar and try again from the main loop
+            opts['pillar'] = {}
+            self._refresh = True
 
     def __prep_mod_opts(self):
         '''
@@ -178,12 +213,9 @@ class Minion(object):
         Takes the aes encrypted load, decrypts is and runs the encapsulated
         instructions
         '''
-        data = None
-        try:
-            data = self.crypticle.loads(load)
-        except AuthenticationError:
-            self.authenticate()
-            data = self.crypticle.loads(load)
+        data = self._decrypt_pub(load)
+        if data is None:
+            return
         # Verify that the publication is valid
         if 'tgt' not in data or 'jid' not in data or 'fun' not in data \
            or 'arg' not in data:
@@ -210,6 +242,19 @@ class Minion(object):
         log.debug('Command details {0}'.format(data))
         self._handle_decoded_payload(data)
 
+    def _decrypt_pub(self, load):
+        '''
+        Decrypt a publication. A publication sealed with a new master AES
+        key is held until the main loop has signed in again, and None is
+        returned.
+        '''
+        try:
+            return self.crypticle.loads(load)
+        except AuthenticationError:
+            self._held_pubs.append(load)
+            self.schedule_reauth()
+            return None
+
     def _handle_pub(self, load):
         '''
         Handle public key payloads
@@ -230,16 +275,18 @@ class Minion(object):
         if isinstance(data['fun'], string_types):
             if data['fun'] == 'sys.reload_modules':
                 self.functions, self.returners = self.__load_modules()
+                if self.job_pool is not None:
+                    self.job_pool.refresh()
 
-        if self.opts['multiprocessing']:
-            if isinstance(data['fun'], tuple) or isinstance(data['fun'], list):
-                multiprocessing.Process(
-                    target=lambda: self._thread_multi_return(data)
-                ).start()
-            else:
-                multiprocessing.Process(
-                    target=lambda: self._thread_return(data)
-                ).start()
+        if self.job_pool is not None and data['fun'] not in POOL_BYPASS:
+            self.job_pool.submit(data)
+        elif self.opts['multiprocessing']:
+            proc = multiprocessing.Process(
+                    target=self._run_job_process, args=(data,))
+            proc.start()
+            sdata = {'pid': proc.pid}
+            sdata.update(data)
+            self.jobs[data['jid']] = (proc, sdata)
         else:
             if isinstance(data['fun'], tuple) or isinstance(data['fun'], list):
                 threading.Thread(
@@ -250,6 +297,23 @@ class Minion(object):
                     target=lambda: self._thread_return(data)
                 ).start()
 
+    def _run_job(self, data):
+        '''
+        Run a job in the calling process or thread
+        '''
+        if isinstance(data['fun'], (list, tuple)):
+            self._thread_multi_return(data)
+        else:
+            self._thread_return(data)
+
+    def _run_job_process(self, data):
+        '''
+        Run a job in a process of its own
+        '''
+        # The job is killed by SIGTERM, not stopped like the minion
+        signal.signal(signal.SIGTERM, signal.SIG_DFL)
+        self._run_job(data)
+
     def _thread_return(self, data):
         '''
         This method should be used as a threading target, start the actual
@@ -374,7 +438,6 @@ class Minion(object):
                     # The file is gone already
                     pass
         log.info('Returning information for job: {0}'.format(ret['jid']))
-        sreq = salt.payload.SREQ(self.opts['master_uri'])
         if ret_cmd == '_syndic_return':
             load = {'cmd': ret_cmd,
                     'jid': ret['jid'],
@@ -396,14 +459,36 @@ class Minion(object):
                     load['out'] = oput
         except KeyError:
             pass
-        try:
-            ret_val = sreq.send('aes', self.crypticle.dumps(load))
-        except SaltReqTimeoutError:
-            ret_val = ''
-        if isinstance(ret_val, string_types) and not ret_val:
-            # The master AES key has changed, reauth
-            self.authenticate()
-            ret_val = sreq.send('aes', self.crypticle.dumps(load))
+        if ret_cmd == '_return' and self.opts['return_batch_window']:
+            # Hand the return to the main minion loop, which coalesces it
+            # with the other returns finishing close by into one request
+            del load['cmd']
+            del load['id']
+            event = salt.utils.event.MinionEvent(self.opts['sock_dir'])
+            event.fire_event(load, '__return__')
+            event.destroy()
+            ret_val = True
+        else:
+            sreq = salt.payload.SREQ(self.opts['master_uri'])
+            try:
+                ret_val = sreq.send(
+                        'aes', self.crypticle.dumps(load), cmd=ret_cmd)
+                if isinstance(ret_val, string_types) and not ret_val:
+                    # The master AES key has changed, reauth
+                    self.reauthenticate()
+                    ret_val = sreq.send(
+                            'aes', self.crypticle.dumps(load), cmd=ret_cmd)
+            except SaltReqTimeoutError:
+                ret_val = ''
+                if ret_cmd == '_return':
+                    self._spool_returns([load])
+                    if self.opts['multiprocessing']:
+                        # The job runs in a process of its own, tell the
+                        # main minion loop there are returns to replay
+                        event = salt.utils.event.MinionEvent(
+                                self.opts['sock_dir'])
+                        event.fire_event({}, '__spooled__')
+                        event.destroy()
         if self.opts['cache_jobs']:
             # Local job cache has been enabled
             fn_ = os.path.join(
@@ -417,6 +502,151 @@ class Minion(object):
             open(fn_, 'w+').write(self.serial.dumps(ret))
         return ret_val
 
+    def _handle_events(self, epull_sock, epub_sock):
+        '''
+        Drain the minion event pull socket, job returns waiting to be batched
+        are queued and everything else is republished on the event bus
+        '''
+        while True:
+            try:
+                package = epull_sock.recv(zmq.NOBLOCK)
+            except zmq.ZMQError:
+                break
+            tag = package[:20].rstrip('|')
+            if tag == '__return__':
+                self._queue_return(self.serial.loads(package[20:]))
+                continue
+            if tag == '__job_done__':
+                if self.job_pool is not None:
+                    self.job_pool.done(
+                            self.serial.loads(package[20:])['worker'])
+                continue
+            if tag == '__spooled__':
+                self._spool_pending = True
+                continue
+            if tag == 'module_refresh':
+                # Refresh once the events have been handled, a refresh
+                # asking for the pillar wins over one which does not
+                pillar = self.serial.loads(package[20:]).get('pillar', False)
+                self._refresh = bool(self._refresh) or pillar
+            epub_sock.send(package)
+
+    def _queue_return(self, load):
+        '''
+        Queue a job return to be sent to the master with the next batch
+        '''
+        if not self._return_queue:
+            self._return_queue_start = time.time()
+        self._return_queue.append(load)
+
+    def _send_batch(self, returns):
+        '''
+        Send a list of job returns to the master in one _return_batch
+        request, returns True once the master has accepted them. A master
+        which does not take batches is sent the returns one at a time.
+        '''
+        if self._reauth_at is not None:
+            # The master would not take the returns with the old AES key
+            return False
+        load = {'cmd': '_return_batch',
+                'id': self.opts['id'],
+                'returns': returns}
+        sreq = salt.payload.SREQ(self.opts['master_uri'])
+        # Keep the timeout short, this blocks the main minion loop
+        ret_val = sreq.send(
+                'aes', self.crypticle.dumps(load), 1, 10, load['cmd'])
+        if isinstance(ret_val, string_types) and not ret_val:
+            # The master AES key has changed, send once signed in again
+            self.schedule_reauth()
+            return False
+        if ret_val is True or \
+                isinstance(ret_val, int) and not isinstance(ret_val, bool):
+            return True
+        # An older master answers the unknown command with an encrypted False
+        log.info('The master did not take the batch of {0} returns, sending'
+                 ' them one at a time'.format(len(returns)))
+        for ret in returns:
+            load = dict(ret, cmd='_return', id=self.opts['id'])
+            ret_val = sreq.send(
+                    'aes', self.crypticle.dumps(load), 1, 10, load['cmd'])
+            if isinstance(ret_val, string_types) and not ret_val:
+                self.schedule_reauth()
+                return False
+        return True
+
+    def _spool_returns(self, returns):
+        '''
+        Keep job returns that could not be delivered to the master in the
+        return spool, they are replayed once the master can be reached again
+        '''
+        if not self.opts['return_spool']:
+            log.error(
+                    'Failed to send {0} job returns to the master'.format(
+                        len(returns))
+                    )
+            return
+        for ret in returns:
+            ret.pop('cmd', None)
+            ret.pop('id', None)
+        try:
+            self.return_spool.append(returns)
+        except (IOError, OSError) as exc:
+            log.error('Failed to spool {0} job returns: {1}'.format(
+                len(returns), exc))
+            return
+        self._spool_pending = True
+        log.warning(
+                ('Failed to send {0} job returns to the master, they have'
+                 ' been spooled to be sent later').format(len(returns))
+                )
+
+    def _flush_returns(self):
+        '''
+        Send the queued job returns to the master as a single _return_batch
+        once the oldest of them has waited return_batch_window seconds or
+        return_batch_size of them are queued
+        '''
+        if not self._return_queue:
+            return
+        if len(self._return_queue) < self.opts['return_batch_size'] and \
+                time.time() - self._return_queue_start < \
+                self.opts['return_batch_window']:
+            return
+        returns = self._return_queue[:self.opts['return_batch_size']]
+        try:
+            if not self._send_batch(returns):
+                return
+            log.info('Returned information for {0} jobs'.format(
+                len(returns)))
+        except SaltReqTimeoutError:
+            self._spool_returns(returns)
+        del self._return_queue[:len(returns)]
+        self._return_queue_start = time.time()
+
+    def _replay_spool(self):
+        '''
+        Send the spooled job returns to the master, at most
+        return_spool_rate returns go out each second so that a master coming
+        back from an outage is not flooded
+        '''
+        if not self._spool_pending or time.time() < self._spool_next:
+            return
+        self._spool_next = time.time() + 1
+        returns = self.return_spool.peek(self.opts['return_spool_rate'])
+        if not returns:
+            self._spool_pending = False
+            return
+        try:
+            if not self._send_batch(returns):
+                return
+        except SaltReqTimeoutError:
+            # The master is still unreachable, back off before trying again
+            self._spool_next = time.time() + 10
+            return
+        self.return_spool.consume(len(returns))
+        log.info('Replayed {0} spooled job returns, {1} remain'.format(
+            len(returns), self.return_spool.depth()))
+
     @property
     def master_pub(self):
         return 'tcp://{ip}:{port}'.format(ip=self.opts['master_ip'],
@@ -431,17 +661,72 @@ class Minion(object):
         '''
         log.debug('Attempting to authenticate with the Salt Master')
         auth = salt.crypt.Auth(self.opts)
+        attempt = 0
         while True:
             creds = auth.sign_in()
             if creds != 'retry':
                 log.info('Authentication with master successful!')
                 break
-            log.info('Waiting for minion key to be accepted by the master.')
-            time.sleep(self.opts['acceptance_wait_time'])
+            delay = salt.utils.backoff(
+                    attempt,
+                    self.opts['acceptance_wait_time'],
+                    self.opts['acceptance_wait_time_max'])
+            log.info('Waiting {0:.1f} seconds for minion key to be accepted '
+                     'by the master.'.format(delay))
+            time.sleep(delay)
+            attempt += 1
         self.aes = creds['aes']
         self.publish_port = creds['publish_port']
+        self.publish_topics = creds.get('publish_topics', 0)
         self.crypticle = salt.crypt.Crypticle(self.opts, self.aes)
 
+    def reauthenticate(self):
+        '''
+        Sign in again once the master AES key has changed. Every minion
+        finds out about a new key at the same moment, so the sign ins are
+        spread over auth_splay seconds. This sleeps, the main loop uses
+        schedule_reauth instead.
+        '''
+        if self.opts['auth_splay']:
+            delay = random.uniform(0, self.opts['auth_splay'])
+            log.info('The master AES key has changed, signing in again in '
+                     '{0:.1f} seconds'.format(delay))
+            time.sleep(delay)
+        self.authenticate()
+
+    def schedule_reauth(self):
+        '''
+        Have the main loop sign in again at a random time within auth_splay
+        seconds, the loop keeps handling events and returns meanwhile
+        '''
+        if self._reauth_at is not None:
+            return
+        delay = 0
+        if self.opts['auth_splay']:
+            delay = random.uniform(0, self.opts['auth_splay'])
+        log.info('The master AES key has changed, signing in again in '
+                 '{0:.1f} seconds'.format(delay))
+        self._reauth_at = time.time() + delay
+
+    def _check_reauth(self):
+        '''
+        Sign in again once the time picked by schedule_reauth has come, then
+        handle the publications held for the new key
+        '''
+        if self._reauth_at is None or time.time() < self._reauth_at:
+            return
+        self.authenticate()
+        self._reauth_at = None
+        held, self._held_pubs = self._held_pubs, []
+        for load in held:
+            try:
+                self.crypticle.loads(load)
+            except AuthenticationError:
+                log.error('Dropping a publication which can not be decrypted'
+                          ' with the new master AES key')
+                continue
+            self._handle_aes(load)
+
     def passive_refresh(self):
         '''
         Check to see if the salt refresh file has been laid down, if it has,
@@ -451,23 +736,134 @@ class Minion(object):
         if os.path.isfile(fn_):
             with open(fn_, 'r+') as f:
                 data = f.read()
-                if 'pillar' in data:
-                    self.opts['pillar'] = salt.pillar.get_pillar(
-                        self.opts,
-                        self.opts['grains'],
-                        self.opts['id'],
-                        self.opts['environment'],
-                        ).compile_pillar()
             try:
                 os.remove(fn_)
             except OSError:
                 pass
-            self.functions, self.returners = self.__load_modules()
+            self.module_refresh('pillar' in data)
+
+    def _compile_pillar(self):
+        '''
+        Return the pillar compiled by the master, or None when the master
+        could not compile it, the minion then keeps the pillar it has
+        '''
+        try:
+            return salt.pillar.get_pillar(
+                self.opts,
+                self.opts['grains'],
+                self.opts['id'],
+                self.opts['environment'],
+                ).compile_pillar()
+        except SaltClientError as exc:
+            log.error(
+                    'Failed to compile the pillar, it will be compiled again'
+                    ' on the next refresh: {0}'.format(exc))
+            return None
+
+    def module_refresh(self, pillar=False):
+        '''
+        Reload the functions and returners, and compile the pillar again when
+        pillar is True
+        '''
+        self._refresh = None
+        if pillar:
+            ret = self._compile_pillar()
+            if ret is not None:
+                self.opts['pillar'] = ret
+        self.functions, self.returners = self.__load_modules()
+        if self.job_pool is not None:
+            # The job processes were forked with the old modules
+            self.job_pool.refresh()
+
+    def _connect_pub(self, context):
+        '''
+        Return a socket subscribed to the publications of the master
+        '''
+        socket = context.socket(zmq.SUB)
+        self._subscribe(socket)
+        if self.opts['sub_timeout']:
+            socket.setsockopt(zmq.IDENTITY, self.opts['id'])
+        socket.connect(self.master_pub)
+        return socket
+
+    def _poll_timeout(self, last):
+        '''
+        Return the milliseconds the main loop can wait for a publication or
+        an event before something else is due, so that an idle minion does
+        not wake up needlessly
+        '''
+        now = time.time()
+        due = [now + 60]
+        if self.opts['sub_timeout']:
+            due.append(last + self.opts['sub_timeout'])
+        if self._reauth_at is not None:
+            # Nothing is sent to the master until the minion has signed in
+            # again
+            due.append(self._reauth_at)
+        else:
+            if self._return_queue:
+                due.append(self._return_queue_start +
+                           self.opts['return_batch_window'])
+            if self._spool_pending:
+                due.append(self._spool_next)
+        pool = []
+        if self.job_pool is not None:
+            pool = self.job_pool.procs()
+            if self.job_pool.jobs:
+                # Check on the running jobs
+                due.append(now + 1)
+        if [proc for proc in multiprocessing.active_children()
+                if proc not in pool]:
+            # Reap the job processes soon after they finish
+            due.append(now + 1)
+        return max(int((min(due) - now) * 1000), 0)
+
+    def _running(self, pid=None):
+        '''
+        Return the data of the jobs running on the minion, leaving out the
+        job running in the process pid
+        '''
+        ret = [sdata for proc, sdata in self.jobs.values()
+               if proc.is_alive() and sdata['pid'] != pid]
+        if self.job_pool is not None:
+            ret.extend([sdata for sdata in self.job_pool.jobs.values()
+                        if sdata['pid'] != pid])
+        return ret
+
+    def _handle_jobs(self, socket):
+        '''
+        Answer the requests of saltutil.running for the running jobs
+        '''
+        while True:
+            try:
+                load = self.serial.loads(socket.recv(zmq.NOBLOCK))
+            except zmq.ZMQError:
+                # No more requests
+                return
+            socket.send(self.serial.dumps(self._running(load.get('pid'))))
+
+    def _subscribe(self, socket):
+        '''
+        Subscribe to the publications for this minion. When the master sends
+        jobs on topics only the broadcasts and the topic of the bucket of
+        this minion are taken. A syndic passes jobs on to its own minions, so
+        it takes every topic.
+        '''
+        if not self.publish_topics or getattr(self, '_syndic', False):
+            socket.setsockopt(zmq.SUBSCRIBE, '')
+            return
+        socket.setsockopt(zmq.SUBSCRIBE, salt.payload.BROADCAST)
+        socket.setsockopt(
+                zmq.SUBSCRIBE,
+                salt.payload.pub_topic(self.opts['id'], self.publish_topics))
 
     def tune_in(self):
         '''
         Lock onto the publisher. This is the main event loop for the minion
         '''
+        if self.opts['multiprocessing'] and self.opts['job_pool_size']:
+            # Fork the job processes before any sockets are opened
+            self.job_pool = JobPool(self)
         context = zmq.Context()
 
         # Prepare the minion event system
@@ -482,9 +878,15 @@ class Minion(object):
         epull_uri = 'ipc://{0}'.format(
                 os.path.join(self.opts['sock_dir'], 'minion_event_pull.ipc')
                 )
+        # Create the socket saltutil.running asks for the running jobs on
+        jobs_sock = context.socket(zmq.REP)
+        jobs_uri = 'ipc://{0}'.format(
+                os.path.join(self.opts['sock_dir'], 'minion_jobs.ipc')
+                )
         # Bind the event sockets
         epub_sock.bind(epub_uri)
         epull_sock.bind(epull_uri)
+        jobs_sock.bind(jobs_uri)
         # Restrict access to the sockets
         os.chmod(
                 os.path.join(self.opts['sock_dir'],
@@ -496,80 +898,330 @@ class Minion(object):
                     'minion_event_pull.ipc'),
                 448
                 )
+        os.chmod(
+                os.path.join(self.opts['sock_dir'],
+                    'minion_jobs.ipc'),
+                448
+                )
 
+        # Pick up a module refresh asked for while the minion was down
+        self.passive_refresh()
+        socket = self._connect_pub(context)
         poller = zmq.Poller()
-        epoller = zmq.Poller()
-        socket = context.socket(zmq.SUB)
-        socket.setsockopt(zmq.SUBSCRIBE, '')
-        if self.opts['sub_timeout']:
-            socket.setsockopt(zmq.IDENTITY, self.opts['id'])
-        socket.connect(self.master_pub)
         poller.register(socket, zmq.POLLIN)
-        epoller.register(epull_sock, zmq.POLLIN)
+        poller.register(epull_sock, zmq.POLLIN)
+        poller.register(jobs_sock, zmq.POLLIN)
 
         # Make sure to gracefully handle SIGUSR1
         enable_sigusr1_handler()
 
-        if self.opts['sub_timeout']:
-            last = time.time()
+        def sigterm_clean(signum, frame):
+            '''
+            Stop the job processes along with the minion
+            '''
+            raise KeyboardInterrupt
+
+        signal.signal(signal.SIGTERM, sigterm_clean)
+        last = time.time()
+        try:
             while True:
                 try:
-                    socks = dict(poller.poll(self.opts['sub_timeout']))
-                    if socket in socks and socks[socket] == zmq.POLLIN:
-                        payload = self.serial.loads(socket.recv())
+                    try:
+                        socks = dict(poller.poll(self._poll_timeout(last)))
+                    except zmq.ZMQError as exc:
+                        # A signal such as SIGUSR1 interrupted the poll
+                        if exc.errno != errno.EINTR:
+                            raise exc
+                        socks = {}
+                    if socks.get(socket) == zmq.POLLIN:
+                        # The payload may follow the topic it was sent on
+                        payload = self.serial.loads(
+                                socket.recv_multipart()[-1])
                         self._handle_payload(payload)
                         last = time.time()
-                    if time.time() - last > self.opts['sub_timeout']:
-                        # It has been a while since the last command, make sure
-                        # the connection is fresh by reconnecting
+                    if socks.get(epull_sock) == zmq.POLLIN:
+                        try:
+                            self._handle_events(epull_sock, epub_sock)
+                        except Exception:
+                            pass
+                    if socks.get(jobs_sock) == zmq.POLLIN:
+                        self._handle_jobs(jobs_sock)
+                    if self.opts['sub_timeout'] and \
+                            time.time() - last > self.opts['sub_timeout']:
+                        # It has been a while since the last command, make
+                        # sure the connection is fresh by reconnecting
                         if self.opts['dns_check']:
                             try:
                                 # Verify that the dns entry has not changed
-                                self.opts['master_ip'] = salt.utils.dns_check(
-                                    self.opts['master'], safe=True)
+                                self.opts['master_ip'] = \
+                                        salt.utils.dns_check(
+                                            self.opts['master'], safe=True)
                             except SaltClientError:
                                 # Failed to update the dns, keep the old addr
                                 pass
                         poller.unregister(socket)
                         socket.close()
-                        socket = context.socket(zmq.SUB)
-                        socket.setsockopt(zmq.SUBSCRIBE, '')
-                        socket.setsockopt(zmq.IDENTITY, self.opts['id'])
-                        socket.connect(self.master_pub)
+                        socket = self._connect_pub(context)
                         poller.register(socket, zmq.POLLIN)
                         last = time.time()
-                    time.sleep(0.05)
                     multiprocessing.active_children()
-                    self.passive_refresh()
-                    # Check the event system
-                    if epoller.poll(1):
-                        try:
-                            package = epull_sock.recv(zmq.NOBLOCK)
-                            epub_sock.send(package)
-                        except Exception:
-                            pass
+                    for jid, (proc, sdata) in list(self.jobs.items()):
+                        if not proc.is_alive():
+                            del self.jobs[jid]
+                    if self.job_pool is not None:
+                        self.job_pool.maintain()
+                    if self._refresh is not None:
+                        self.module_refresh(self._refresh)
+                    self._check_reauth()
+                    self._flush_returns()
+                    self._replay_spool()
                 except Exception as exc:
-                    log.critical('A fault occured in the main minion loop {0}'.format(exc))
-        else:
-            while True:
+                    log.critical(
+                            'A fault occured in the main minion loop {0}'
+                            .format(exc))
+        finally:
+            if self.job_pool is not None:
+                self.job_pool.stop()
+
+
+class JobWorker(multiprocessing.Process):
+    '''
+    A pre-forked process of the minion job pool, it runs the jobs handed to
+    it one at a time
+    '''
+    def __init__(self, minion, worker_id, conn):
+        super(JobWorker, self).__init__()
+        self.minion = minion
+        self.worker_id = worker_id
+        self.conn = conn
+
+    def run(self):
+        '''
+        Run the jobs sent down the pipe until the minion closes it
+        '''
+        # The job is killed by SIGTERM, not stopped like the minion
+        signal.signal(signal.SIGTERM, signal.SIG_DFL)
+        event = salt.utils.event.MinionEvent(self.minion.opts['sock_dir'])
+        while True:
+            try:
+                data = self.conn.recv()
+            except (EOFError, IOError):
+                break
+            try:
+                self.minion._run_job(data)
+            except Exception:
+                log.error('Failed to run job {0}: {1}'.format(
+                    data['jid'], traceback.format_exc()))
+            try:
+                os.remove(os.path.join(self.minion.proc_dir, data['jid']))
+            except OSError:
+                pass
+            event.fire_event(
+                    {'worker': self.worker_id, 'jid': data['jid']},
+                    '__job_done__')
+
+
+class JobPool(object):
+    '''
+    Run the jobs of a minion in job_pool_size pre-forked processes. The jobs
+    over that wait in a queue of up to job_queue_size jobs, in the order of
+    the priority job_priorities gives their function and then in the order
+    they came in. A job running longer than job_timeout seconds is killed.
+    '''
+    def __init__(self, minion):
+        self.minion = minion
+        self.opts = minion.opts
+        self.serial = minion.serial
+        self.workers = {}
+        self.spawned = 0
+        self.queue = []
+        self.count = 0
+        # The data of the jobs queued or running in the pool by jid, as
+        # saltutil.running reports it
+        self.jobs = {}
+        for ind in range(self.opts['job_pool_size']):
+            self.spawn()
+
+    def procs(self):
+        '''
+        Return the processes of the pool
+        '''
+        return [worker['proc'] for worker in self.workers.values()]
+
+    def spawn(self):
+        '''
+        Fork a job process
+        '''
+        self.spawned += 1
+        worker_id = 'job-{0}'.format(self.spawned)
+        conn, child_conn = multiprocessing.Pipe()
+        proc = JobWorker(self.minion, worker_id, child_conn)
+        # The job processes are not daemons so that the jobs may start
+        # processes of their own. They hold the pipes of the ones forked
+        # before them, so they are not told to stop by closing the pipe but
+        # are terminated by stop when the minion stops.
+        proc.start()
+        child_conn.close()
+        self.workers[worker_id] = {'proc': proc,
+                                   'conn': conn,
+                                   'jid': None,
+                                   'start': 0,
+                                   'stale': False}
+
+    def retire(self, worker_id):
+        '''
+        Stop a job process and fork a new one in its place
+        '''
+        worker = self.workers.pop(worker_id)
+        worker['conn'].close()
+        if worker['proc'].is_alive():
+            worker['proc'].terminate()
+        worker['proc'].join(1)
+        self.spawn()
+
+    def stop(self):
+        '''
+        Terminate the job processes, along with the jobs they are running
+        '''
+        for worker in self.workers.values():
+            worker['conn'].close()
+            if worker['proc'].is_alive():
+                worker['proc'].terminate()
+        for worker in self.workers.values():
+            worker['proc'].join(1)
+        self.workers = {}
+
+    def _proc_fn(self, jid):
+        return os.path.join(self.minion.proc_dir, jid)
+
+    def _priority(self, fun):
+        '''
+        Return the priority of a job function, the highest runs first
+        '''
+        if isinstance(fun, (list, tuple)):
+            fun = fun[0] if fun else ''
+        matches = [priority for glob, priority
+                   in self.opts['job_priorities'].items()
+                   if fnmatch.fnmatch(fun, glob)]
+        return max(matches) if matches else 0
+
+    def _job_return(self, data, msg):
+        '''
+        Send the master a return for a job which was not run to the end, it
+        goes out with the next batch of returns so that the main minion loop
+        does not wait on the master
+        '''
+        self.minion._queue_return({'jid': data['jid'], 'return': msg})
+
+    def submit(self, data):
+        '''
+        Queue a job, it is turned away when the queue is full
+        '''
+        if len(self.queue) >= self.opts['job_queue_size']:
+            log.error('The job queue is full, job {0} is not run'.format(
+                data['jid']))
+            self._job_return(
+                    data,
+                    'ERROR: The minion has {0} jobs queued, the job was not'
+                    ' run'.format(len(self.queue)))
+            return
+        # The queued job is listed as running by the minion process, so that
+        # the master keeps waiting for it
+        sdata = {'pid': os.getpid(), 'queued': True}
+        sdata.update(data)
+        with open(self._proc_fn(data['jid']), 'w+') as fp_:
+            fp_.write(self.serial.dumps(sdata))
+        self.count += 1
+        heapq.heappush(
+                self.queue,
+                (-self._priority(data['fun']), self.count, data))
+        self.jobs[data['jid']] = sdata
+        self.dispatch()
+
+    def dispatch(self):
+        '''
+        Hand the queued jobs to the idle job processes
+        '''
+        for worker_id, worker in self.workers.items():
+            if not self.queue:
+                return
+            if worker['jid'] is not None or worker['stale']:
+                continue
+            data = None
+            while self.queue and data is None:
+                data = heapq.heappop(self.queue)[2]
+                if not os.path.isfile(self._proc_fn(data['jid'])):
+                    # The job was killed while it was queued
+                    log.info('Queued job {0} was cancelled'.format(
+                        data['jid']))
+                    self.jobs.pop(data['jid'], None)
+                    data = None
+            if data is None:
+                return
+            try:
+                worker['conn'].send(data)
+            except (IOError, OSError):
+                # The process is gone, maintain replaces it
+                heapq.heappush(self.queue, (float('-inf'), 0, data))
+                continue
+            worker['jid'] = data['jid']
+            worker['start'] = time.time()
+            sdata = {'pid': worker['proc'].pid}
+            sdata.update(data)
+            self.jobs[data['jid']] = sdata
+
+    def done(self, worker_id):
+        '''
+        A job process finished its job
+        '''
+        worker = self.workers.get(worker_id)
+        if worker is None:
+            return
+        self.jobs.pop(worker['jid'], None)
+        worker['jid'] = None
+        if worker['stale']:
+            self.retire(worker_id)
+        self.dispatch()
+
+    def refresh(self):
+        '''
+        Replace the job processes so that they load the modules again, the
+        busy ones once they finish their jobs
+        '''
+        for worker_id, worker in list(self.workers.items()):
+            if worker['jid'] is None:
+                self.retire(worker_id)
+            else:
+                worker['stale'] = True
+
+    def maintain(self):
+        '''
+        Replace the job processes which died and kill the jobs which ran
+        for too long
+        '''
+        now = time.time()
+        for worker_id, worker in list(self.workers.items()):
+            jid = worker['jid']
+            if worker['proc'].is_alive():
+                if jid is None or not self.opts['job_timeout'] or \
+                        now - worker['start'] <= self.opts['job_timeout']:
+                    continue
+                log.error('Job {0} ran for more than {1} seconds, killing'
+                          ' it'.format(jid, self.opts['job_timeout']))
+                self._job_return(
+                        {'jid': jid, 'fun': self.jobs[jid]['fun']},
+                        'ERROR: The job was killed after running for {0}'
+                        ' seconds'.format(self.opts['job_timeout']))
+            elif jid is not None:
+                log.warn('The process running job {0} died'.format(jid))
+            if jid is not None:
+                self.jobs.pop(jid, None)
                 try:
-                    socks = dict(poller.poll(60))
-                    if socket in socks and socks[socket] == zmq.POLLIN:
-                        payload = self.serial.loads(socket.recv())
-                        self._handle_payload(payload)
-                        last = time.time()
-                    time.sleep(0.05)
-                    multiprocessing.active_children()
-                    self.passive_refresh()
-                    # Check the event system
-                    if epoller.poll(1):
-                        try:
-                            package = epull_sock.recv(zmq.NOBLOCK)
-                            epub_sock.send(package)
-                        except Exception:
-                            pass
-                except Exception as exc:
-                    log.critical('A fault occured in the main minion loop {0}'.format(exc))
+                    os.remove(self._proc_fn(jid))
+                except OSError:
+                    pass
+            self.retire(worker_id)
+        self.dispatch()
 
 
 class Syndic(salt.client.LocalClient, Minion):
@@ -587,13 +1239,10 @@ class Syndic(salt.client.LocalClient, Minion):
         Takes the aes encrypted load, decrypts is and runs the encapsulated
         instructions
         '''
-        data = None
         # If the AES authentication has changed, re-authenticate
-        try:
-            data = self.crypticle.loads(load)
-        except AuthenticationError:
-            self.authenticate()
-            data = self.crypticle.loads(load)
+        data = self._decrypt_pub(load)
+        if data is None:
+            return
         # Verify that the publication is valid
         if 'tgt' not in data or 'jid' not in data or 'fun' not in data \
            or 'to' not in data or 'arg' not in data:
@@ -630,7 +1279,7 @@ class Syndic(salt.client.LocalClient, Minion):
         if 'tgt_type' not in data:
             data['tgt_type'] = 'glob'
         # Send out the publication
-        pub_data = self.pub(
+        pub_data = self._pub(
                 data['tgt'],
                 data['fun'],
                 data['arg'],
@@ -830,3 +1479,190 @@ class Matcher(object):
         if tgt in nodegroups:
             return self.compound_match(nodegroups[tgt])
         return False
+
+
+class TargetMatcher(object):
+    '''
+    A target compiled once so that it can be checked against the id and
+    grains of any number of minions. Exsel and pillar matches need the
+    minion itself, targets using them are flagged as dynamic and are left to
+    the Matcher.
+    '''
+    ref = {'G': 'grain',
+           'P': 'grain_pcre',
+           'X': 'exsel',
+           'I': 'pillar',
+           'L': 'list',
+           'E': 'pcre'}
+
+    def __init__(self, tgt, matcher='glob', nodegroups=None):
+        self.tgt = tgt
+        self.matcher = matcher
+        self.dynamic = False
+        if matcher == 'nodegroup':
+            tgt = (nodegroups or {}).get(tgt)
+            matcher = 'compound'
+        self.func = self._compile(matcher, tgt)
+
+    def __call__(self, id_, grains):
+        '''
+        Return True if the target matches the minion
+        '''
+        return self.func(id_, grains)
+
+    def _never(self, id_, grains):
+        return False
+
+    def _compile(self, matcher, tgt):
+        '''
+        Return a function of the minion id and grains for the target
+        '''
+        if matcher in ('exsel', 'pillar'):
+            self.dynamic = True
+            return self._never
+        compiler = getattr(self, '_compile_{0}'.format(matcher), None)
+        if compiler is None:
+            log.error('Attempting to match with unknown matcher: {0}'.format(
+                matcher
+                ))
+            return self._never
+        if tgt is None:
+            return self._never
+        try:
+            return compiler(tgt)
+        except Exception as exc:
+            log.error('Failed to compile the {0} target {1}: {2}'.format(
+                matcher, tgt, exc))
+            return self._never
+
+    def _compile_glob(self, tgt):
+        regex = re.compile(fnmatch.translate(os.path.normcase(tgt)))
+        return lambda id_, grains: bool(regex.match(os.path.normcase(id_)))
+
+    def _compile_pcre(self, tgt):
+        regex = re.compile(tgt)
+        return lambda id_, grains: bool(regex.match(id_))
+
+    def _compile_list(self, tgt):
+        if isinstance(tgt, string_types):
+            tgt = tgt.split(',')
+        ids = set(tgt)
+        return lambda id_, grains: id_ in ids
+
+    def _grain_func(self, tgt, regex):
+        '''
+        Return a function matching the named grain, or any member of a list
+        grain, against a compiled regex
+        '''
+        key = tgt.split(':')[0]
+
+        def func(id_, grains):
+            if key not in grains:
+                return False
+            val = grains[key]
+            if isinstance(val, list):
+                for member in val:
+                    if regex.match(str(member).lower()):
+                        return True
+                return False
+            return bool(regex.match(str(val).lower()))
+        return func
+
+    def _compile_grain(self, tgt):
+        comps = tgt.split(':')
+        if len(comps) < 2:
+            log.error('Got insufficient arguments for grains from master')
+            return self._never
+        return self._grain_func(
+                tgt, re.compile(fnmatch.translate(comps[1].lower())))
+
+    def _compile_grain_pcre(self, tgt):
+        comps = tgt.split(':')
+        if len(comps) < 2:
+            log.error('Got insufficient arguments for grains from master')
+            return self._never
+        return self._grain_func(tgt, re.compile(comps[1].lower()))
+
+    def _compile_compound(self, tgt):
+        if not isinstance(tgt, string_types):
+            log.debug('Compound target received that is not a string')
+            return self._never
+        funcs = []
+        expr = []
+        for match in tgt.split():
+            if '@' in match and match[1] == '@':
+                comps = match.split('@')
+                matcher = self.ref.get(comps[0])
+                if not matcher:
+                    # An unknown matcher fails the whole target
+                    return self._never
+                sub = TargetMatcher('@'.join(comps[1:]), matcher)
+                if sub.dynamic:
+                    self.dynamic = True
+                    return self._never
+                funcs.append(sub.func)
+                expr.append('funcs[{0}](id_, grains)'.format(len(funcs) - 1))
+            elif match in ('and', 'or', 'not'):
+                expr.append(match)
+            else:
+                funcs.append(self._compile_glob(match))
+                expr.append('funcs[{0}](id_, grains)'.format(len(funcs) - 1))
+        # The expression keeps the short circuiting and precedence of the
+        # boolean operators in the target
+        func = eval('lambda funcs, id_, grains: {0}'.format(' '.join(expr)))
+        return lambda id_, grains: bool(func(funcs, id_, grains))
+
+
+class TopMatcher(object):
+    '''
+    The targets of a merged top file compiled into TargetMatchers. The sls
+    matches of each minion are kept, keyed by the id and grains of the
+    minion, for as long as the TopMatcher is used, so a TopMatcher should be
+    replaced when the top file changes.
+    '''
+    def __init__(self, top, nodegroups=None):
+        self.nodegroups = nodegroups or {}
+        self.targets = []
+        self.dynamic = False
+        self.results = {}
+        for env, body in top.items():
+            for match, data in body.items():
+                if not data:
+                    log.error('Recived bad data when setting the match from '
+                              'the top file')
+                    continue
+                matcher = 'glob'
+                for item in data:
+                    if isinstance(item, dict):
+                        if 'match' in item:
+                            matcher = item['match']
+                target = TargetMatcher(match, matcher, nodegroups)
+                if target.dynamic:
+                    self.dynamic = True
+                sls = [item for item in data if isinstance(item, string_types)]
+                self.targets.append((env, match, data, target, sls))
+
+    def matches(self, id_, grains, env=None, matcher=None):
+        '''
+        Return the sls matches of a single minion, a Matcher for the minion
+        is needed to check dynamic targets
+        '''
+        key = (id_, env)
+        digest = hashlib.md5(pprint.pformat(grains)).hexdigest()
+        if not self.dynamic and key in self.results \
+                and self.results[key][0] == digest:
+            return copy.deepcopy(self.results[key][1])
+        ret = {}
+        for t_env, match, data, target, sls in self.targets:
+            if env and t_env != env:
+                continue
+            if target.dynamic:
+                if matcher is None or not matcher.confirm_top(
+                        target.tgt, data, self.nodegroups):
+                    continue
+            elif not target(id_, grains):
+                continue
+            ret.setdefault(t_env, []).extend(sls)
+        if not self.dynamic:
+            self.results[key] = (digest, copy.deepcopy(ret))
+        return ret
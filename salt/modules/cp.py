@@ -185,16 +185,18 @@ def list_states(env='base'):
     return client.list_states(env)
 
 
-def list_master(env='base'):
+def list_master(env='base', prefix=''):
     '''
-    List all of the files stored on the master
+    List all of the files stored on the master, pass a prefix to only list
+    the files under a path
 
     CLI Example::
 
         salt '*' cp.list_master
+        salt '*' cp.list_master prefix=apache
     '''
     client = salt.fileclient.get_file_client(__opts__)
-    return client.file_list(env)
+    return client.file_list(env, prefix)
 
 
 def list_minion(env='base'):
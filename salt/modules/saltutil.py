@@ -10,8 +10,13 @@ import shutil
 import signal
 import logging
 
+# Import third party libs
+import zmq
+
 # Import Salt libs
 import salt.payload
+import salt.utils.event
+import salt.utils.spool
 from salt._compat import string_types
 
 log = logging.getLogger(__name__)
@@ -48,9 +53,7 @@ def _sync(form, env):
             shutil.copyfile(fn_, dest)
             ret.append('{0}.{1}'.format(form, os.path.basename(fn_)))
     if ret:
-        mod_file = os.path.join(__opts__['cachedir'], 'module_refresh')
-        with open(mod_file, 'a+') as f:
-            f.write('')
+        salt.utils.event.refresh_minion(__opts__['sock_dir'])
     if __opts__.get('clean_dynamic_modules', True):
         current = set(os.listdir(mod_dir))
         for fn_ in current - remote:
@@ -156,13 +159,47 @@ def refresh_pillar():
 
         salt '*' saltutil.refresh_pillar
     '''
-    mod_file = os.path.join(__opts__['cachedir'], 'module_refresh')
+    salt.utils.event.refresh_minion(__opts__['sock_dir'], pillar=True)
+    return True
+
+
+def spool_depth():
+    '''
+    Return the number of job returns waiting in the return spool to be sent
+    to the master
+
+    CLI Example::
+
+        salt '*' saltutil.spool_depth
+    '''
+    spool = salt.utils.spool.Spool(
+            __opts__,
+            os.path.join(__opts__['cachedir'], 'return_spool')
+            )
+    return spool.depth()
+
+
+def _minion_running(serial, pid):
+    '''
+    Ask the minion process for the jobs it runs, returns None when the minion
+    does not answer
+    '''
+    path = os.path.join(__opts__['sock_dir'], 'minion_jobs.ipc')
+    if not os.path.exists(path):
+        return None
+    context = zmq.Context()
+    socket = context.socket(zmq.REQ)
+    socket.setsockopt(zmq.LINGER, 0)
     try:
-        with open(mod_file, 'a+') as f:
-            f.write('pillar')
-        return True
-    except IOError:
-        return False
+        socket.connect('ipc://{0}'.format(path))
+        socket.send(serial.dumps({'pid': pid}))
+        if socket.poll(5000):
+            return serial.loads(socket.recv())
+        log.warning('The minion did not answer for its running jobs')
+        return None
+    finally:
+        socket.close()
+        context.term()
 
 
 def running():
@@ -173,10 +210,14 @@ def running():
 
         salt '*' saltutil.running
     '''
-    procs = __salt__['status.procs']()
-    ret = []
     serial = salt.payload.Serial(__opts__)
     pid = os.getpid()
+    ret = _minion_running(serial, pid)
+    if ret is not None:
+        return ret
+    # Fall back to the proc files the jobs leave behind
+    procs = __salt__['status.procs']()
+    ret = []
     proc_dir = os.path.join(__opts__['cachedir'], 'proc')
     if not os.path.isdir(proc_dir):
         return []
@@ -221,6 +262,13 @@ def signal_job(jid, sig):
     '''
     for data in running():
         if data['jid'] == jid:
+            if data.get('queued'):
+                # The job waits in the job pool queue, it is dropped from the
+                # queue once its proc file is gone
+                path = os.path.join(__opts__['cachedir'], 'proc', str(jid))
+                if os.path.isfile(path):
+                    os.remove(path)
+                return 'Job {0} was queued and has been cancelled'.format(jid)
             try:
                 os.kill(int(data['pid']), sig)
                 return 'Signal {0} sent to job {1} at pid {2}'.format(
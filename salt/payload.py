@@ -5,7 +5,10 @@ in here
 '''
 
 # Import python libs
+import os
 import sys
+import hashlib
+import threading
 
 # Import salt libs
 import salt.log
@@ -18,6 +21,11 @@ import zmq
 
 log = salt.log.logging.getLogger(__name__)
 
+# The topic of the publications sent to every minion, the topics of the
+# minion buckets start with TOPIC so that neither is a prefix of the other
+BROADCAST = 'B'
+TOPIC = 'T'
+
 try:
     # Attempt to import msgpack
     import msgpack
@@ -53,6 +61,14 @@ def unpackage(package_):
     return msgpack.loads(package_, use_list=True)
 
 
+def pub_topic(id_, digits):
+    '''
+    Return the publish topic of the bucket a minion id falls into, there are
+    16 ** digits buckets
+    '''
+    return TOPIC + hashlib.md5(id_).hexdigest()[:digits]
+
+
 def format_payload(enc, **kwargs):
     '''
     Pass in the required arguments for a payload, the enc type and the cmd,
@@ -91,6 +107,26 @@ class Serial(object):
             except Exception:
                 return msgpack.loads(msg, use_list=True)
 
+    def loads_keys(self, msg, keys):
+        '''
+        Return the named top level fields of a serialized dict. With msgpack
+        the other fields are skipped over without being decoded, which is
+        far cheaper than loading a large message.
+        '''
+        if self.serial != 'msgpack' or not hasattr(msgpack, 'Unpacker'):
+            data = self.loads(msg)
+            return dict((key, data[key]) for key in keys if key in data)
+        unpacker = msgpack.Unpacker(max_buffer_size=0)
+        unpacker.feed(msg)
+        ret = {}
+        for _ in range(unpacker.read_map_header()):
+            key = unpacker.unpack()
+            if key in keys:
+                ret[key] = unpacker.unpack()
+            else:
+                unpacker.skip()
+        return ret
+
     def load(self, fn_):
         '''
         Run the correct serialization to load a file
@@ -116,38 +152,142 @@ class Serial(object):
         fn_.close()
 
 
+class ReqPool(object):
+    '''
+    A process wide pool of REQ sockets keyed by the uri they connect to.
+    Sockets are checked out for a single request and checked back in once
+    the reply has been read, so repeated calls to the same master reuse an
+    established connection instead of paying for a new connect and
+    handshake. A socket that times out is stuck waiting for a reply and is
+    thrown away rather than returned to the pool.
+    '''
+    # The number of idle sockets held per uri
+    max_idle = 8
+
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.pid = None
+        self.context = None
+        self.idle = {}
+        self.stats = {'in_flight': 0,
+                      'created': 0,
+                      'reused': 0,
+                      'timed_out': 0}
+
+    def _check_pid(self):
+        '''
+        zeromq contexts and sockets cannot be used across a fork, if this
+        process is a child of the one that built the pool start over
+        '''
+        if self.pid == os.getpid():
+            return
+        self.pid = os.getpid()
+        self.context = zmq.Context()
+        self.idle = {}
+        for key in self.stats:
+            self.stats[key] = 0
+
+    def checkout(self, uri, linger=0):
+        '''
+        Return a REQ socket connected to the given uri
+        '''
+        with self.lock:
+            self._check_pid()
+            self.stats['in_flight'] += 1
+            if self.idle.get(uri):
+                self.stats['reused'] += 1
+                socket = self.idle[uri].pop()
+                socket.linger = linger
+                return socket
+            self.stats['created'] += 1
+            socket = self.context.socket(zmq.REQ)
+        socket.linger = linger
+        socket.connect(uri)
+        return socket
+
+    def checkin(self, uri, socket):
+        '''
+        Hand a socket that has completed a request back to the pool
+        '''
+        with self.lock:
+            self.stats['in_flight'] -= 1
+            if self.pid == os.getpid():
+                idle = self.idle.setdefault(uri, [])
+                if len(idle) < self.max_idle:
+                    idle.append(socket)
+                    return
+        socket.close()
+
+    def discard(self, socket, timed_out=True):
+        '''
+        Close a socket that can no longer be used, such as a REQ socket
+        which sent a request and never got an answer
+        '''
+        with self.lock:
+            self.stats['in_flight'] -= 1
+            if timed_out:
+                self.stats['timed_out'] += 1
+        socket.close(linger=0)
+
+
+_REQ_POOL = ReqPool()
+
+
+def req_stats():
+    '''
+    Return the counters for the REQ socket pool in this process
+    '''
+    return dict(_REQ_POOL.stats)
+
+
 class SREQ(object):
     '''
-    Create a generic interface to wrap salt zeromq req calls. 
+    Create a generic interface to wrap salt zeromq req calls. The sockets
+    are drawn from a process wide pool, so creating many SREQ instances for
+    the same master is cheap.
     '''
     def __init__(self, master, serial='msgpack', linger=0):
         self.master = master
         self.serial = Serial(serial)
-        context = zmq.Context()
-        self.socket = context.socket(zmq.REQ)
-        self.socket.linger = linger
-        self.socket.connect(master)
+        self.linger = linger
 
-    def send(self, enc, load, tries=1, timeout=60):
+    def send(self, enc, load, tries=1, timeout=60, cmd=None):
         '''
-        Takes two arguments, the encryption type and the base payload
+        Takes two arguments, the encryption type and the base payload. The
+        request is tried up to "tries" times, each attempt waiting "timeout"
+        seconds for the reply on a fresh socket. The command named by "cmd"
+        is sent in the clear so the master can queue an encrypted request
+        without decrypting it.
         '''
         payload = {'enc': enc}
         payload['load'] = load
+        if cmd:
+            payload['cmd'] = cmd
         package = self.serial.dumps(payload)
-        self.socket.send(package)
-        poller = zmq.Poller()
-        poller.register(self.socket, zmq.POLLIN)
         tried = 0
         while True:
-            if not poller.poll(timeout*1000) and tried >= tries:
-                raise SaltReqTimeoutError('Waited {0} seconds'.format(timeout))
-            else:
-                break
+            socket = _REQ_POOL.checkout(self.master, self.linger)
+            poller = zmq.Poller()
+            poller.register(socket, zmq.POLLIN)
+            reply = None
+            try:
+                socket.send(package)
+                if poller.poll(timeout * 1000):
+                    reply = socket.recv()
+            except Exception:
+                _REQ_POOL.discard(socket, False)
+                raise
+            if reply is not None:
+                _REQ_POOL.checkin(self.master, socket)
+                return self.serial.loads(reply)
+            _REQ_POOL.discard(socket)
             tried += 1
-        ret = self.serial.loads(self.socket.recv())
-        poller.unregister(self.socket)
-        return ret
+            if tried >= tries:
+                raise SaltReqTimeoutError(
+                        'Waited {0} seconds'.format(timeout * tried)
+                        )
+            log.debug('Request to {0} timed out, retrying'.format(
+                self.master))
 
     def send_auto(self, payload):
         '''
@@ -155,4 +295,4 @@ class SREQ(object):
         '''
         enc = payload.get('enc', 'clear')
         load = payload.get('load', {})
-        return self.send(enc, load)
+        return self.send(enc, load, cmd=payload.get('cmd'))
@@ -4,7 +4,13 @@ Render the pillar data
 
 # Import python libs
 import os
+import sys
 import copy
+import time
+import pprint
+import shutil
+import hashlib
+import tempfile
 import collections
 import logging
 import subprocess
@@ -14,8 +20,12 @@ import salt.loader
 import salt.fileclient
 import salt.minion
 import salt.crypt
+import salt.payload
 from salt._compat import string_types
-from salt.template import compile_template
+from salt.exceptions import SaltClientError
+from salt.utils.process import pid_running
+from salt.utils.verify import valid_id
+from salt.template import compile_template, template_is_static
 
 # Import third party libs
 import zmq
@@ -24,6 +34,14 @@ import yaml
 log = logging.getLogger(__name__)
 
 
+def fingerprint(grains, env=None):
+    '''
+    Return a digest of the grains and environment a pillar is compiled for
+    '''
+    # pformat sorts dict keys, so equal grains give the same fingerprint
+    return hashlib.md5(pprint.pformat((env, grains))).hexdigest()
+
+
 def get_pillar(opts, grains, id_, env=None):
     '''
     Return the correct pillar driver based on the file_client option
@@ -58,9 +76,20 @@ class RemotePillar(object):
                 'grains': self.grains,
                 'env': self.opts['environment'],
                 'cmd': '_pillar'}
-        return self.auth.crypticle.loads(
-                self.sreq.send('aes', self.auth.crypticle.dumps(load), 3, 7200)
+        ret = self.auth.crypticle.loads(
+                self.sreq.send(
+                    'aes',
+                    self.auth.crypticle.dumps(load),
+                    3,
+                    7200,
+                    load['cmd'])
                 )
+        if not isinstance(ret, dict):
+            # Rendering against an empty pillar would be worse than failing
+            raise SaltClientError(
+                    'The master failed to compile the pillar for {0}'.format(
+                        self.id_))
+        return ret
 
 
 
@@ -71,11 +100,60 @@ class Pillar(object):
     def __init__(self, opts, grains, id_, env):
         # use the local file client
         self.opts = self.__gen_opts(opts, grains, id_, env)
+        self.set_env = 'environment' not in opts
         self.client = salt.fileclient.get_file_client(self.opts)
-        self.matcher = salt.minion.Matcher(self.opts)
         self.functions = salt.loader.minion_mods(self.opts)
+        self.matcher = salt.minion.Matcher(self.opts, self.functions)
         self.rend = salt.loader.render(self.opts, self.functions)
         self.ext_pillars = salt.loader.pillars(self.opts, self.functions)
+        # The files the pillar was rendered from, with their mtimes
+        self.deps = {}
+        self.errors = []
+        # The rendered top file and its compiled targets, kept across
+        # calls to reset() while the top files are unchanged
+        self._top = None
+
+    def _loaded_modules(self):
+        '''
+        Return the module objects behind the loaded functions, renderers and
+        ext_pillars
+        '''
+        mods = {}
+        for funcs in (self.functions, self.rend, self.ext_pillars):
+            for func in funcs.values():
+                name = getattr(func, '__module__', None)
+                mod = sys.modules.get(name)
+                if mod is not None and hasattr(mod, '__grains__'):
+                    mods[name] = mod
+        return mods.values()
+
+    def reset(self, grains, id_, env=None):
+        '''
+        Prepare to compile the pillar of another minion. The loaded modules,
+        renderers and ext_pillars are kept, only the grains and id they see
+        are swapped, which is far cheaper than making a new Pillar.
+        '''
+        self.opts['grains'] = grains
+        self.opts['id'] = id_
+        if self.set_env:
+            self.opts['environment'] = env
+        # The module objects are shared by every loader in the process, so
+        # point them at this minion every time
+        for mod in self._loaded_modules():
+            mod.__grains__ = grains
+            if hasattr(mod, '__opts__'):
+                mod.__opts__['grains'] = grains
+                mod.__opts__['id'] = id_
+        self.deps = {}
+        self.errors = []
+
+    def _track(self, path):
+        '''
+        Record a file the pillar depends on and return the path
+        '''
+        if isinstance(path, string_types) and os.path.isfile(path):
+            self.deps[path] = os.path.getmtime(path)
+        return path
 
     def __gen_opts(self, opts, grains, id_, env=None):
         '''
@@ -118,10 +196,10 @@ class Pillar(object):
             if self.opts['environment']:
                 tops[self.opts['environment']] = [
                         compile_template(
-                            self.client.cache_file(
+                            self._track(self.client.cache_file(
                                 self.opts['state_top'],
                                 self.opts['environment']
-                                ),
+                                )),
                             self.rend,
                             self.opts['renderer'],
                             self.opts['environment']
@@ -131,10 +209,10 @@ class Pillar(object):
                 for env in self._get_envs():
                     tops[env].append(
                             compile_template(
-                                self.client.cache_file(
+                                self._track(self.client.cache_file(
                                     self.opts['state_top'],
                                     env
-                                    ),
+                                    )),
                                 self.rend,
                                 self.opts['renderer'],
                                 env=env
@@ -166,10 +244,10 @@ class Pillar(object):
                     try:
                         tops[env].append(
                                 compile_template(
-                                    self.client.get_state(
+                                    self._track(self.client.get_state(
                                         sls,
                                         env
-                                        ),
+                                        )),
                                     self.rend,
                                     self.opts['renderer'],
                                     env=env
@@ -211,12 +289,67 @@ class Pillar(object):
                         top[env][tgt].extend(list(states))
         return top
 
+    def _root_mtimes(self):
+        '''
+        Return the mtimes of the pillar roots, a top file added to a root
+        changes its mtime
+        '''
+        ret = {}
+        for paths in self.opts['file_roots'].values():
+            for path in paths:
+                try:
+                    ret[path] = os.path.getmtime(path)
+                except OSError:
+                    ret[path] = None
+        return ret
+
+    def _top_current(self):
+        '''
+        Return True if the kept top file was rendered for the same
+        environment from files which are unchanged
+        '''
+        if self._top['env'] != self.opts['environment']:
+            return False
+        if self._top['roots'] != self._root_mtimes():
+            return False
+        for path, mtime in self._top['deps'].items():
+            try:
+                if os.path.getmtime(path) != mtime:
+                    return False
+            except OSError:
+                return False
+        return True
+
     def get_top(self):
         '''
-        Returns the high data derived from the top file
+        Returns the high data derived from the top file. The rendered top is
+        kept for the next minion unless the top files are templates, which
+        can render differently for each minion.
         '''
+        if self._top is not None and self._top_current():
+            self.deps.update(self._top['deps'])
+            return self._top['top'], []
+        deps = self.deps
+        self.deps = {}
         tops, errors = self.get_tops()
-        return self.merge_tops(tops), errors
+        top = self.merge_tops(tops)
+        top_deps = self.deps
+        self.deps = deps
+        self.deps.update(top_deps)
+        self._top = None
+        static = True
+        for path in top_deps:
+            if not template_is_static(
+                    path, self.rend, self.opts['renderer']):
+                static = False
+        if static and not errors:
+            self._top = {'top': top,
+                         'deps': top_deps,
+                         'env': self.opts['environment'],
+                         'roots': self._root_mtimes(),
+                         'matcher': salt.minion.TopMatcher(
+                             top, self.opts.get('nodegroups', {}))}
+        return top, errors
 
     def top_matches(self, top):
         '''
@@ -226,22 +359,16 @@ class Pillar(object):
         Returns:
         {'env': ['state1', 'state2', ...]}
         '''
-        matches = {}
-        for env, body in top.items():
-            if self.opts['environment']:
-                if not env == self.opts['environment']:
-                    continue
-            for match, data in body.items():
-                if self.matcher.confirm_top(
-                        match,
-                        data,
-                        self.opts.get('nodegroups', {}),
-                        ):
-                    if env not in matches:
-                        matches[env] = []
-                    for item in data:
-                        if isinstance(item, string_types):
-                            matches[env].append(item)
+        if self._top is not None and self._top['top'] is top:
+            top_matcher = self._top['matcher']
+        else:
+            top_matcher = salt.minion.TopMatcher(
+                    top, self.opts.get('nodegroups', {}))
+        matches = top_matcher.matches(
+                self.opts['id'],
+                self.opts['grains'],
+                self.opts['environment'],
+                self.matcher)
         ext_matches = self.client.ext_nodes()
         for env in ext_matches:
             if env in matches:
@@ -256,7 +383,7 @@ class Pillar(object):
         '''
         err = ''
         errors = []
-        fn_ = self.client.get_state(sls, env)
+        fn_ = self._track(self.client.get_state(sls, env))
         if not fn_:
             errors.append(('Specified SLS {0} in environment {1} is not'
                            ' available on the salt master').format(sls, env))
@@ -325,6 +452,11 @@ class Pillar(object):
                 log.critical('The "ext_pillar" option is malformed')
                 return {}
             for key, val in run.items():
+                # An ext_pillar reading a file named in its arguments
+                # depends on that file
+                for arg in (val.values() if isinstance(val, dict)
+                            else val if isinstance(val, list) else [val]):
+                    self._track(arg)
                 if key not in self.ext_pillars:
                     err = ('Specified ext_pillar interface {0} is '
                            'unavailable').format(key)
@@ -350,8 +482,167 @@ class Pillar(object):
         pillar, errors = self.render_pillar(matches)
         pillar.update(self.ext_pillar())
         errors.extend(terrors)
+        self.errors = errors
         if errors:
             for error in errors:
                 log.critical('Pillar render error: {0}'.format(error))
             return {}
         return pillar
+
+
+class PillarCache(object):
+    '''
+    Cache compiled pillar data on the master. Entries are keyed by minion
+    id, environment and a fingerprint of the grains, and are written under
+    the cachedir so that they are shared by all of the master workers. An
+    entry is used until one of the files it was rendered from changes or
+    it is older than pillar_cache_ttl seconds.
+    '''
+    def __init__(self, opts):
+        self.opts = opts
+        self.serial = salt.payload.Serial(opts)
+        self.cache_dir = os.path.join(opts['cachedir'], 'pillar_cache')
+        self.stats_dir = os.path.join(self.cache_dir, '.stats')
+        self.stats = {'hits': 0, 'misses': 0}
+        self._stats_written = 0
+        self.pillar = None
+
+    def _entry_path(self, id_, grains, env):
+        '''
+        Return the location of the cache entry
+        '''
+        return os.path.join(self.cache_dir, id_, fingerprint(grains, env))
+
+    def _valid(self, entry):
+        '''
+        Return True if none of the files the entry depends on changed and the
+        entry has not expired
+        '''
+        if time.time() - entry['time'] > self.opts['pillar_cache_ttl']:
+            return False
+        for path, mtime in entry['deps'].items():
+            try:
+                if os.path.getmtime(path) != mtime:
+                    return False
+            except OSError:
+                return False
+        return True
+
+    def _write(self, path, entry):
+        '''
+        Atomically write a cache entry, pillar data is readable only by the
+        master user
+        '''
+        cumask = os.umask(63)
+        try:
+            if not os.path.isdir(os.path.dirname(path)):
+                os.makedirs(os.path.dirname(path))
+            fd_, tmp = tempfile.mkstemp(dir=os.path.dirname(path))
+            with os.fdopen(fd_, 'wb') as fp_:
+                fp_.write(self.serial.dumps(entry))
+            os.rename(tmp, path)
+        except (IOError, OSError) as exc:
+            log.warning('Failed to cache the pillar: {0}'.format(exc))
+        finally:
+            os.umask(cumask)
+
+    def _count(self, key):
+        '''
+        Count a hit or miss, the counters of each worker are written out at
+        most every 10 seconds for the pillar runner to read
+        '''
+        self.stats[key] += 1
+        if time.time() - self._stats_written < 10:
+            return
+        self._write(os.path.join(self.stats_dir, str(os.getpid())),
+                    self.stats)
+        self._stats_written = time.time()
+
+    def get(self, id_, grains, env=None):
+        '''
+        Return the pillar for a minion, rendering it only if the cached
+        pillar is missing or stale
+        '''
+        if not valid_id(id_):
+            log.error(('Not caching the pillar of {0!r}, the id can not be'
+                       ' used as a file name').format(id_))
+            return self.compile(id_, grains, env)
+        path = self._entry_path(id_, grains, env)
+        try:
+            with open(path, 'rb') as fp_:
+                entry = self.serial.load(fp_)
+        except (IOError, OSError):
+            entry = None
+        except Exception:
+            log.warning('Discarding unreadable pillar cache entry {0}'.format(
+                path))
+            entry = None
+        if isinstance(entry, dict) and self._valid(entry):
+            self._count('hits')
+            return entry['pillar']
+        self._count('misses')
+        start = time.time()
+        ret = self.compile(id_, grains, env)
+        if not self.pillar.errors:
+            self._write(path, {'pillar': ret,
+                               'deps': self.pillar.deps,
+                               'time': start})
+        return ret
+
+    def compile(self, id_, grains, env=None):
+        '''
+        Compile the pillar for a minion without consulting the cache. The
+        Pillar is kept, loading its modules is the bulk of the cost of
+        compiling a pillar.
+        '''
+        if self.pillar is None:
+            self.pillar = Pillar(self.opts, grains, id_, env)
+        else:
+            self.pillar.reset(grains, id_, env)
+        return self.pillar.compile_pillar()
+
+    def flush(self, id_=None):
+        '''
+        Remove the cached pillar of a single minion, or of all minions
+        '''
+        if not os.path.isdir(self.cache_dir):
+            return []
+        if id_ is None:
+            ids = [fn_ for fn_ in os.listdir(self.cache_dir)
+                   if not fn_.startswith('.')]
+        elif valid_id(id_):
+            ids = [id_]
+        else:
+            return []
+        ret = []
+        for minion in ids:
+            path = os.path.join(self.cache_dir, minion)
+            if os.path.isdir(path):
+                shutil.rmtree(path)
+                ret.append(minion)
+        return ret
+
+    def read_stats(self):
+        '''
+        Return the hit and miss counters summed over the master workers. The
+        counters of workers which have exited are dropped.
+        '''
+        ret = {'hits': 0, 'misses': 0}
+        if not os.path.isdir(self.stats_dir):
+            return ret
+        for fn_ in os.listdir(self.stats_dir):
+            path = os.path.join(self.stats_dir, fn_)
+            if fn_.isdigit() and not pid_running(int(fn_)):
+                try:
+                    os.remove(path)
+                except OSError:
+                    pass
+                continue
+            try:
+                with open(path, 'rb') as fp_:
+                    stats = self.serial.load(fp_)
+            except Exception:
+                continue
+            for key in ret:
+                ret[key] += stats.get(key, 0)
+        return ret
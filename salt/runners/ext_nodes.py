@@ -0,0 +1,29 @@
+'''
+Manage the external nodes classifier cache on the master
+'''
+
+# Import salt libs
+import salt.fileserver
+
+# Import Third party libs
+import yaml
+
+
+def flush(minion=None):
+    '''
+    Remove the cached classes of a minion, or of every minion if none is
+    named
+    '''
+    ret = salt.fileserver.ExtNodes(__opts__).flush(minion)
+    print(yaml.dump(ret))
+    return ret
+
+
+def stats():
+    '''
+    Show the cache hits and misses and the time spent running the classifier
+    counted by the master workers
+    '''
+    ret = salt.fileserver.ExtNodes(__opts__).read_stats()
+    print(yaml.dump(ret))
+    return ret
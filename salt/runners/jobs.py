@@ -2,12 +2,9 @@
 A conveniance system to manage jobs, both active and already run
 '''
 
-# Import Python Modules
-import os
-
 # Import Salt Modules
 import salt.client
-import salt.payload
+import salt.jobcache
 import salt.utils
 from salt._compat import string_types
 from salt.exceptions import SaltException
@@ -22,7 +19,7 @@ def active():
     perspective
     '''
     ret = {}
-    job_dir = os.path.join(__opts__['cachedir'], 'jobs')
+    job_cache = salt.jobcache.get_job_cache(__opts__)
     client = salt.client.LocalClient(__opts__['conf_file'])
     active_ = client.cmd('*', 'saltutil.running', timeout=__opts__['timeout'])
     for minion, data in active_.items():
@@ -39,18 +36,7 @@ def active():
             else:
                 ret[job['jid']]['Running'].append({minion: job['pid']})
     for jid in ret:
-        jid_dir = salt.utils.jid_dir(
-                jid,
-                __opts__['cachedir'],
-                __opts__['hash_type']
-                )
-        if not os.path.isdir(jid_dir):
-            continue
-        for minion in os.listdir(jid_dir):
-            if minion.startswith('.'):
-                continue
-            if os.path.exists(os.path.join(jid_dir, minion)):
-                ret[jid]['Returned'].append(minion)
+        ret[jid]['Returned'].extend(job_cache.get_returns(jid))
     print(yaml.dump(ret))
     return ret
 
@@ -71,8 +57,8 @@ def lookup_jid(jid):
                 out = data['out']
         return ret, out
 
-    client = salt.client.LocalClient(__opts__['conf_file'])
-    full_ret = client.get_full_returns(jid, [], 0)
+    job_cache = salt.jobcache.get_job_cache(__opts__)
+    full_ret = job_cache.get_returns(jid)
     formatted = _format_ret(full_ret)
 
     if formatted:
@@ -99,21 +85,13 @@ def list_jobs():
     '''
     List all detectable jobs and associated functions
     '''
-    serial = salt.payload.Serial(__opts__)
     ret = {}
-    job_dir = os.path.join(__opts__['cachedir'], 'jobs')
-    for top in os.listdir(job_dir):
-        t_path = os.path.join(job_dir, top)
-        for final in os.listdir(t_path):
-            loadpath = os.path.join(t_path, final, '.load.p')
-            if not os.path.isfile(loadpath):
-                continue
-            load = serial.load(open(loadpath, 'rb'))
-            jid = load['jid']
-            ret[jid] = {'Start Time': salt.utils.jid_to_time(jid),
-                        'Function': load['fun'],
-                        'Arguments': list(load['arg']),
-                        'Target': load['tgt'],
-                        'Target-type': load['tgt_type']}
+    job_cache = salt.jobcache.get_job_cache(__opts__)
+    for jid, load in job_cache.list_jobs().items():
+        ret[jid] = {'Start Time': salt.utils.jid_to_time(jid),
+                    'Function': load['fun'],
+                    'Arguments': list(load['arg']),
+                    'Target': load['tgt'],
+                    'Target-type': load['tgt_type']}
     print(yaml.dump(ret))
     return ret
@@ -0,0 +1,28 @@
+'''
+Manage the pillar cache on the master
+'''
+
+# Import salt libs
+import salt.pillar
+
+# Import Third party libs
+import yaml
+
+
+def flush(minion=None):
+    '''
+    Remove the cached pillar of a minion, or of every minion if none is
+    named
+    '''
+    ret = salt.pillar.PillarCache(__opts__).flush(minion)
+    print(yaml.dump(ret))
+    return ret
+
+
+def cache_stats():
+    '''
+    Show the pillar cache hits and misses counted by the master workers
+    '''
+    ret = salt.pillar.PillarCache(__opts__).read_stats()
+    print(yaml.dump(ret))
+    return ret
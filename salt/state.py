@@ -14,6 +14,7 @@ The data sent to the state calls is as follows:
 # Import python libs
 import os
 import copy
+import pprint
 import inspect
 import fnmatch
 import logging
@@ -29,13 +30,20 @@ import salt.loader
 import salt.minion
 import salt.pillar
 import salt.fileclient
+import salt.utils.event
 from salt._compat import string_types, callable
 
-from salt.template import compile_template, compile_template_str
+from salt.template import compile_template, compile_template_str, \
+        template_is_static
 from salt.exceptions import SaltReqTimeoutError
 
 log = logging.getLogger(__name__)
 
+# The top files rendered in this process which hold no template markup,
+# keyed by location and environment, and the last compiled top
+TOP_FILES = {}
+TOP_MATCHER = {}
+
 
 def _gen_tag(low):
     '''
@@ -251,11 +259,7 @@ class State(object):
         '''
         def _refresh():
             self.load_modules()
-            module_refresh_path = os.path.join(
-                self.opts['cachedir'],
-                'module_refresh')
-            with open(module_refresh_path, 'w+') as f:
-                f.write('')
+            salt.utils.event.refresh_minion(self.opts['sock_dir'])
 
         if data['state'] == 'file':
             if data['fun'] == 'managed':
@@ -1045,6 +1049,12 @@ class BaseHighState(object):
     def __init__(self, opts):
         self.opts = self.__gen_opts(opts)
         self.avail = self.__gather_avail()
+        # The content hashes of the top files being rendered, None once one
+        # of them can render differently for each minion, and the last top
+        # returned by get_top with the key of the TopMatcher it can share
+        self._top_sums = None
+        self._top = None
+        self._top_key = None
 
     def __gather_avail(self):
         '''
@@ -1099,27 +1109,23 @@ class BaseHighState(object):
         # Gather initial top files
         if self.opts['environment']:
             tops[self.opts['environment']] = [
-                    compile_template(
+                    self.render_top(
                         self.client.cache_file(
                             self.opts['state_top'],
                             self.opts['environment']
                             ),
-                        self.state.rend,
-                        self.state.opts['renderer'],
-                        env=self.opts['environment']
+                        self.opts['environment']
                         )
                     ]
         else:
             for env in self._get_envs():
                 tops[env].append(
-                        compile_template(
+                        self.render_top(
                             self.client.cache_file(
                                 self.opts['state_top'],
                                 env
                                 ),
-                            self.state.rend,
-                            self.state.opts['renderer'],
-                            env=env
+                            env
                             )
                         )
 
@@ -1143,14 +1149,12 @@ class BaseHighState(object):
                         if sls in done[env]:
                             continue
                         tops[env].append(
-                                compile_template(
+                                self.render_top(
                                     self.client.get_state(
                                         sls,
                                         env
                                         ),
-                                    self.state.rend,
-                                    self.state.opts['renderer'],
-                                    env=env
+                                    env
                                     )
                                 )
                         done[env].append(sls)
@@ -1159,6 +1163,33 @@ class BaseHighState(object):
                     include.pop(env)
         return tops
 
+    def render_top(self, path, env):
+        '''
+        Render a top file. The data rendered from a top file without
+        template markup is kept in the process and used again while the
+        contents of the file are unchanged.
+        '''
+        if not path or not os.path.isfile(path):
+            self._top_sums = None
+            return compile_template(
+                    path, self.state.rend, self.state.opts['renderer'], env)
+        hsum = salt.utils.get_hash(path, 'md5')
+        cached = TOP_FILES.get((path, env))
+        if cached is not None and cached[0] == hsum:
+            if self._top_sums is not None:
+                self._top_sums.append((path, env, hsum))
+            return copy.deepcopy(cached[1])
+        data = compile_template(
+                path, self.state.rend, self.state.opts['renderer'], env=env)
+        if template_is_static(
+                path, self.state.rend, self.state.opts['renderer']):
+            TOP_FILES[(path, env)] = (hsum, copy.deepcopy(data))
+            if self._top_sums is not None:
+                self._top_sums.append((path, env, hsum))
+        else:
+            self._top_sums = None
+        return data
+
     def merge_tops(self, tops):
         '''
         Cleanly merge the top files
@@ -1232,8 +1263,17 @@ class BaseHighState(object):
         '''
         Returns the high data derived from the top file
         '''
+        self._top_sums = []
         tops = self.get_tops()
-        return self.merge_tops(tops)
+        top = self.merge_tops(tops)
+        self._top = top
+        self._top_key = None
+        if self._top_sums is not None:
+            # Every top file was static, the same files give the same top
+            self._top_key = (tuple(sorted(self._top_sums)),
+                             pprint.pformat(self.opts['nodegroups']))
+        self._top_sums = None
+        return top
 
     def top_matches(self, top):
         '''
@@ -1243,22 +1283,21 @@ class BaseHighState(object):
         Returns:
         {'env': ['state1', 'state2', ...]}
         '''
-        matches = {}
-        for env, body in top.items():
-            if self.opts['environment']:
-                if not env == self.opts['environment']:
-                    continue
-            for match, data in body.items():
-                if self.matcher.confirm_top(
-                        match,
-                        data,
-                        self.opts['nodegroups']
-                        ):
-                    if env not in matches:
-                        matches[env] = []
-                    for item in data:
-                        if isinstance(item, string_types):
-                            matches[env].append(item)
+        # The compiled top is kept while the top files rendered by get_top
+        # are unchanged, any other top is compiled for this call only
+        if self._top_key is not None and self._top is top:
+            if TOP_MATCHER.get('key') != self._top_key:
+                TOP_MATCHER['key'] = self._top_key
+                TOP_MATCHER['matcher'] = salt.minion.TopMatcher(
+                        top, self.opts['nodegroups'])
+            top_matcher = TOP_MATCHER['matcher']
+        else:
+            top_matcher = salt.minion.TopMatcher(top, self.opts['nodegroups'])
+        matches = top_matcher.matches(
+                self.opts['id'],
+                self.opts.get('grains', {}),
+                self.opts['environment'],
+                self.matcher)
         ext_matches = self.client.ext_nodes()
         for env in ext_matches:
             if env in matches:
@@ -1601,7 +1640,8 @@ class RemoteHighState(object):
                     'aes',
                     self.auth.crypticle.dumps(load),
                     3,
-                    72000))
+                    72000,
+                    load['cmd']))
         except SaltReqTimeoutError:
             return {}
 
@@ -1,6 +1,7 @@
 '''
 Manage basic template commands
 '''
+import re
 import time
 import os
 import tempfile
@@ -53,6 +54,23 @@ def compile_template_str(template, renderers, default):
     return high
 
 
+# The markup of the jinja, mako and wempy templating engines
+TEMPLATE_TAGS = re.compile(r'{{|{%|\${|<%|^\s*%', re.MULTILINE)
+
+
+def template_is_static(template, renderers, default):
+    '''
+    Return True if the template renders to the same data for every minion,
+    that is if it is not rendered by python and holds no template markup
+    '''
+    if not isinstance(template, string_types) or not os.path.isfile(template):
+        return True
+    if template_shebang(template, renderers, default) == 'py':
+        return False
+    with open(template, 'r') as f:
+        return not TEMPLATE_TAGS.search(f.read())
+
+
 def template_shebang(template, renderers, default):
     '''
     Check the template shebang line and return the renderer
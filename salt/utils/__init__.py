@@ -405,6 +405,27 @@ def jid_dir(jid, cachedir, sum_type):
     return os.path.join(cachedir, 'jobs', jhash[:2], jhash[2:])
 
 
+def get_hash(path, form='md5', chunk_size=65536):
+    '''
+    Return the hex digest of a file, the file is read in chunks so that
+    large files are not loaded into memory
+    '''
+    hash_obj = getattr(hashlib, form)()
+    with open(path, 'rb') as fp_:
+        for chunk in iter(lambda: fp_.read(chunk_size), ''):
+            hash_obj.update(chunk)
+    return hash_obj.hexdigest()
+
+
+def backoff(attempt, base, maximum):
+    '''
+    Return the number of seconds to wait before the given retry, counted
+    from 0. The wait is drawn at random up to a limit which doubles with
+    every attempt, so that clients failing together do not retry together.
+    '''
+    return random.uniform(0, min(maximum, base * 2 ** attempt))
+
+
 def check_or_die(command):
     '''
     Simple convienence function for modules to  use
@@ -14,6 +14,7 @@ Manage events
 #
 # Import Python libs
 import os
+import time
 import errno
 import multiprocessing
 
@@ -34,6 +35,8 @@ class SaltEvent(object):
         self.poller = zmq.Poller()
         self.cpub = False
         self.cpush = False
+        self.subscriptions = set()
+        self.pending = []
         if node == 'master':
             self.puburi = 'ipc://{0}'.format(os.path.join(
                     sock_dir,
@@ -70,23 +73,67 @@ class SaltEvent(object):
         self.push.connect(self.pulluri)
         self.cpush = True
 
-    def get_event(self, wait=5, tag='', full=False):
+    def subscribe(self, tag=''):
         '''
-        Get a single publication
+        Subscribe to events matching the passed tag. Subscribing before the
+        event is fired (such as before a job is published) makes sure that
+        no events are missed.
         '''
         if not self.cpub:
             self.connect_pub()
+        if tag in self.subscriptions:
+            return
         self.sub.setsockopt(zmq.SUBSCRIBE, tag)
+        self.subscriptions.add(tag)
+
+    def unsubscribe(self, tag=''):
+        '''
+        Stop receiving events matching the passed tag
+        '''
+        if not self.cpub or tag not in self.subscriptions:
+            return
+        self.sub.setsockopt(zmq.UNSUBSCRIBE, tag)
+        self.subscriptions.discard(tag)
+        # Keep only the events still held for another subscription
+        self.pending = [evt for evt in self.pending
+                        if self._held_for(evt['tag'])]
+
+    def _held_for(self, evt_tag, tag=None):
+        '''
+        Return True if an event with the passed tag belongs to a specific
+        subscription other than the passed tag
+        '''
+        for sub in self.subscriptions:
+            if sub and sub != tag and evt_tag.startswith(sub):
+                return True
+        return False
+
+    def get_event(self, wait=5, tag='', full=False):
+        '''
+        Get a single publication, wait is the number of milliseconds to wait
+        for the event to arrive
+        '''
+        self.subscribe(tag)
+        for ind, evt in enumerate(self.pending):
+            if evt['tag'].startswith(tag):
+                self.pending.pop(ind)
+                return evt if full else evt['data']
+        # Events for other subscriptions do not restart the wait
+        end = time.time() + wait / 1000.0
         while True:
-            socks = dict(self.poller.poll(wait))
+            socks = dict(self.poller.poll(
+                max(int((end - time.time()) * 1000), 0)))
             if self.sub in socks and socks[self.sub] == zmq.POLLIN:
                 raw = self.sub.recv()
-                data = self.serial.loads(raw[20:])
-                if full:
-                    ret = {'data': data,
-                           'tag': raw[:20].rstrip('|')}
-                    return ret
-                return data
+                evt = {'data': self.serial.loads(raw[20:]),
+                       'tag': raw[:20].rstrip('|')}
+                if not evt['tag'].startswith(tag):
+                    # The event was received for another subscription on
+                    # this socket, hold it until it is asked for
+                    if self._held_for(evt['tag'], tag):
+                        self.pending.append(evt)
+                    continue
+                return evt if full else evt['data']
             else:
                 return None
 
@@ -112,6 +159,21 @@ class SaltEvent(object):
         self.push.send(event)
         return True
 
+    def destroy(self, linger=1000):
+        '''
+        Close the event sockets, events that have been fired but not yet
+        delivered get up to linger milliseconds to go out
+        '''
+        if self.cpub:
+            self.poller.unregister(self.sub)
+            self.sub.close()
+            self.cpub = False
+        if self.cpush:
+            self.push.setsockopt(zmq.LINGER, linger)
+            self.push.close()
+            self.cpush = False
+        self.context.term()
+
 
 class MasterEvent(SaltEvent):
     '''
@@ -130,6 +192,16 @@ class MinionEvent(SaltEvent):
         super(MinionEvent, self).__init__(sock_dir, 'minion')
 
 
+def refresh_minion(sock_dir, pillar=False):
+    '''
+    Tell the running minion to reload its modules, and to compile its pillar
+    again when pillar is True
+    '''
+    event = MinionEvent(sock_dir)
+    event.fire_event({'pillar': pillar}, 'module_refresh')
+    event.destroy()
+
+
 class EventPublisher(multiprocessing.Process):
     '''
     The interface that takes master events and republishes them out to anyone
@@ -1,3 +1,4 @@
+import errno
 import logging
 import os
 import signal
@@ -20,6 +21,18 @@ def set_pidfile(pidfile):
         pass
 
 
+def pid_running(pid):
+    '''
+    Return True if a process with the given pid is running
+    '''
+    try:
+        os.kill(pid, 0)
+    except OSError as exc:
+        # The process exists but belongs to another user
+        return exc.errno == errno.EPERM
+    return True
+
+
 def clean_proc(proc, wait_for_kill=10):
     '''
     Generic method for cleaning up multiprocessing procs
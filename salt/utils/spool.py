@@ -0,0 +1,207 @@
+'''
+A simple disk backed spool. Records are appended to a log file and consumed
+from the front, the position of the first unconsumed record and the end of
+the last record written are kept next to the log. Once every record has been
+consumed the log is truncated. Records which can no longer be read are moved
+aside to a file of their own.
+'''
+# Each record in the log is a 4 byte big endian length followed by the
+# serialized record, so the log can be walked without deserializing it.
+
+# Import python libs
+import os
+import struct
+import logging
+
+try:
+    import fcntl
+    HAS_FCNTL = True
+except ImportError:
+    # Windows has no fcntl, access to the spool is then unlocked
+    HAS_FCNTL = False
+
+# Import salt libs
+import salt.payload
+
+log = logging.getLogger(__name__)
+
+HEADER = struct.Struct('>I')
+
+
+class Spool(object):
+    '''
+    An append only spool of serializable records stored in the named
+    directory
+    '''
+    def __init__(self, opts, path):
+        self.serial = salt.payload.Serial(opts)
+        self.path = path
+        self.log_path = os.path.join(path, 'spool.log')
+        self.pos_path = os.path.join(path, 'spool.pos')
+        self.bad_path = os.path.join(path, 'spool.bad')
+
+    def _open(self):
+        '''
+        Open the log for reading and appending and lock it
+        '''
+        if not os.path.isdir(self.path):
+            os.makedirs(self.path)
+        fp_ = open(self.log_path, 'a+b')
+        if HAS_FCNTL:
+            fcntl.flock(fp_.fileno(), fcntl.LOCK_EX)
+        return fp_
+
+    def _read_pos(self):
+        '''
+        Return the offset of the first unconsumed record and the end offset
+        of the last record written, which is None when it is not known
+        '''
+        try:
+            with open(self.pos_path, 'r') as fp_:
+                offsets = [int(offset) for offset in fp_.read().split()]
+        except (IOError, OSError, ValueError):
+            return 0, None
+        if not offsets:
+            return 0, None
+        if len(offsets) < 2:
+            return offsets[0], None
+        return offsets[0], offsets[1]
+
+    def _write_pos(self, pos, end):
+        '''
+        Record the offset of the first unconsumed record and the end offset
+        of the last record written
+        '''
+        tmp = '{0}.tmp'.format(self.pos_path)
+        with open(tmp, 'w') as fp_:
+            if end is None:
+                fp_.write(str(pos))
+            else:
+                fp_.write('{0} {1}'.format(pos, end))
+        os.rename(tmp, self.pos_path)
+
+    def _iter_records(self, fp_, pos, count=None):
+        '''
+        Yield the end offset and data of the records from pos onwards, a
+        record cut short by a crash while it was being written ends the log
+        '''
+        fp_.seek(pos)
+        num = 0
+        while count is None or num < count:
+            head = fp_.read(HEADER.size)
+            if len(head) < HEADER.size:
+                return
+            size = HEADER.unpack(head)[0]
+            data = fp_.read(size)
+            if len(data) < size:
+                return
+            pos += HEADER.size + size
+            num += 1
+            yield pos, data
+
+    def _tail(self, fp_, pos):
+        '''
+        Return the end offset of the last complete record from pos onwards,
+        only the record headers are read
+        '''
+        fp_.seek(0, os.SEEK_END)
+        end = fp_.tell()
+        while pos + HEADER.size <= end:
+            fp_.seek(pos)
+            size = HEADER.unpack(fp_.read(HEADER.size))[0]
+            if pos + HEADER.size + size > end:
+                break
+            pos += HEADER.size + size
+        return pos
+
+    def append(self, records):
+        '''
+        Append a list of records to the spool
+        '''
+        fp_ = self._open()
+        try:
+            pos, end = self._read_pos()
+            fp_.seek(0, os.SEEK_END)
+            size = fp_.tell()
+            if end is None or end < pos or end > size:
+                end = pos
+            # Only what was written after the last recorded end is walked
+            tail = self._tail(fp_, end)
+            if tail < size:
+                # A record cut short by a crash would swallow the records
+                # written after it
+                log.warn(('Dropping {0} bytes of a record cut short in the'
+                          ' spool {1}').format(size - tail, self.log_path))
+                fp_.truncate(tail)
+            fp_.seek(0, os.SEEK_END)
+            for record in records:
+                data = self.serial.dumps(record)
+                fp_.write(HEADER.pack(len(data)) + data)
+            fp_.flush()
+            os.fsync(fp_.fileno())
+            self._write_pos(pos, fp_.tell())
+        finally:
+            fp_.close()
+
+    def peek(self, count):
+        '''
+        Return up to count of the oldest unconsumed records. A record which
+        cannot be deserialized is moved to the bad records file once it is
+        the oldest, the records before it are returned until then.
+        '''
+        if not os.path.isfile(self.log_path) or \
+                not os.path.getsize(self.log_path):
+            return []
+        fp_ = self._open()
+        try:
+            pos, end = self._read_pos()
+            ret = []
+            for next_pos, data in self._iter_records(fp_, pos, count):
+                try:
+                    ret.append(self.serial.loads(data))
+                except Exception as exc:
+                    if ret:
+                        break
+                    log.error(('Moving a corrupt record of the spool {0} to'
+                               ' {1}: {2}').format(
+                                   self.log_path, self.bad_path, exc))
+                    with open(self.bad_path, 'ab') as bad:
+                        bad.write(HEADER.pack(len(data)) + data)
+                    pos = next_pos
+                    self._write_pos(pos, end)
+            return ret
+        finally:
+            fp_.close()
+
+    def consume(self, count):
+        '''
+        Drop the count oldest records from the spool
+        '''
+        fp_ = self._open()
+        try:
+            pos, end = self._read_pos()
+            for pos, _ in self._iter_records(fp_, pos, count):
+                pass
+            fp_.seek(0, os.SEEK_END)
+            if pos >= fp_.tell():
+                # Everything has been consumed, start the log over
+                fp_.truncate(0)
+                pos = end = 0
+            self._write_pos(pos, end)
+        finally:
+            fp_.close()
+
+    def depth(self):
+        '''
+        Return the number of unconsumed records in the spool
+        '''
+        if not os.path.isfile(self.log_path):
+            return 0
+        fp_ = self._open()
+        try:
+            num = 0
+            for _ in self._iter_records(fp_, self._read_pos()[0]):
+                num += 1
+            return num
+        finally:
+            fp_.close()
@@ -10,6 +10,7 @@ import socket
 import getpass
 import logging
 
+from salt._compat import string_types
 from salt.exceptions import SaltClientError
 
 log = logging.getLogger(__name__)
@@ -212,3 +213,18 @@ def check_parent_dirs(fname, user='root'):
             # Propagate this exception up so there isn't a sys.exit()
             # in the middle of code that could be imported elsewhere.
             raise SaltClientError(msg)
+
+
+def valid_id(id_):
+    '''
+    Return True if a minion id can safely be used as a file name, ids come
+    from the minions and must not lead out of the directory they are put in
+    '''
+    if not isinstance(id_, string_types) or not id_:
+        return False
+    if id_.startswith('.') or '..' in id_ or '\0' in id_:
+        return False
+    for sep in (os.sep, os.altsep, '/'):
+        if sep and sep in id_:
+            return False
+    return True
@@ -0,0 +1,67 @@
+import os
+import shutil
+import tempfile
+from saltunittest import TestCase, TestLoader, TextTestRunner
+
+import salt.crypt
+
+
+class KeyRegistryTest(TestCase):
+    def setUp(self):
+        super(KeyRegistryTest, self).setUp()
+        self.tmpdir = tempfile.mkdtemp()
+        for state in salt.crypt.KeyRegistry.states:
+            os.makedirs(os.path.join(self.tmpdir, state))
+        for id_ in ('web1', 'web2', 'db1'):
+            self._write('minions', id_, 'pub-{0}'.format(id_))
+        self._write('minions_pre', 'new1', 'pub-new1')
+        self.registry = salt.crypt.KeyRegistry({'pki_dir': self.tmpdir})
+
+    def tearDown(self):
+        shutil.rmtree(self.tmpdir)
+        super(KeyRegistryTest, self).tearDown()
+
+    def _write(self, state, id_, pub):
+        with open(os.path.join(self.tmpdir, state, id_), 'w') as fp_:
+            fp_.write(pub)
+
+    def test_keys(self):
+        self.assertEqual(self.registry.list_keys(),
+                         frozenset(['web1', 'web2', 'db1']))
+        self.assertEqual(self.registry.key_state('new1'), 'minions_pre')
+        self.assertEqual(self.registry.key_state('nope'), None)
+        self.assertEqual(self.registry.get_pub('web1'), 'pub-web1')
+        self.assertEqual(self.registry.get_pub('new1'), None)
+        # Accepting a key changes both directories
+        os.rename(os.path.join(self.tmpdir, 'minions_pre', 'new1'),
+                  os.path.join(self.tmpdir, 'minions', 'new1'))
+        for state in ('minions', 'minions_pre'):
+            os.utime(os.path.join(self.tmpdir, state), (0, 0))
+        self.assertEqual(self.registry.key_state('new1'), 'minions')
+        self.assertEqual(self.registry.get_pub('new1'), 'pub-new1')
+
+    def test_reload(self):
+        self.registry.get_pub('web1')
+        # A key overwritten in place is only seen after a reload
+        self._write('minions', 'web1', 'pub-other')
+        os.utime(os.path.join(self.tmpdir, 'minions'), None)
+        self.registry.reload('web1')
+        self.assertEqual(self.registry.get_pub('web1'), 'pub-other')
+        self.registry.set_pub('web3', 'pub-web3')
+        self.assertEqual(self.registry.get_pub('web3'), 'pub-web3')
+        self.assertTrue('web3' in self.registry.list_keys())
+
+    def test_check(self):
+        self.assertEqual(self.registry.check_glob('web*'),
+                         set(['web1', 'web2']))
+        self.assertEqual(self.registry.check_pcre('(web|db)1'),
+                         set(['web1', 'db1']))
+        self.assertEqual(self.registry.check_list('web1,db1,nope'),
+                         ['db1', 'web1'])
+        self.assertEqual(self.registry.check_list(['web2']), ['web2'])
+
+
+if __name__ == "__main__":
+    loader = TestLoader()
+    tests = loader.loadTestsFromTestCase(KeyRegistryTest)
+    TextTestRunner(verbosity=1).run(tests)
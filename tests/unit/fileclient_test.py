@@ -0,0 +1,108 @@
+import os
+import shutil
+import tempfile
+import threading
+from saltunittest import TestCase, TestLoader, TextTestRunner
+
+import zmq
+
+import salt.crypt
+import salt.fileclient
+import salt.master
+import salt.payload
+
+
+class FakeAuth(object):
+    def __init__(self, crypticle):
+        self.crypticle = crypticle
+
+
+class WindowedTransferTest(TestCase):
+    def setUp(self):
+        super(WindowedTransferTest, self).setUp()
+        self.tmpdir = tempfile.mkdtemp()
+        self.src = os.path.join(self.tmpdir, 'src')
+        with open(self.src, 'wb') as fp_:
+            fp_.write(''.join(chr(ind % 256) for ind in range(95)))
+        self.serial = salt.payload.Serial('msgpack')
+        self.crypticle = salt.crypt.Crypticle(
+                {'serial': 'msgpack'},
+                salt.crypt.Crypticle.generate_key_string())
+        # Serve the file in chunks of 10 bytes
+        self.aes = salt.master.AESFuncs.__new__(salt.master.AESFuncs)
+        self.aes.opts = {'file_buffer_size': 10}
+        self.aes.crypticle = self.crypticle
+        self.aes._AESFuncs__find_file = lambda path, env: {
+                'path': self.src, 'rel': 'src'}
+        self.uri = 'ipc://{0}'.format(os.path.join(self.tmpdir, 'ret.ipc'))
+        self.context = zmq.Context()
+        self.socket = self.context.socket(zmq.ROUTER)
+        self.socket.linger = 0
+        self.socket.bind(self.uri)
+        self.locs = []
+        self.client = salt.fileclient.RemoteClient.__new__(
+                salt.fileclient.RemoteClient)
+        self.client.opts = {'master_uri': self.uri,
+                            'file_transfer_window': 4}
+        self.client.serial = self.serial
+        self.client.auth = FakeAuth(self.crypticle)
+        self.client.context = self.context
+
+    def tearDown(self):
+        self.socket.close()
+        self.context.term()
+        shutil.rmtree(self.tmpdir)
+        super(WindowedTransferTest, self).tearDown()
+
+    def _serve(self):
+        while self.socket.poll(500):
+            frames = self.socket.recv_multipart()
+            load = self.crypticle.loads(self.serial.loads(frames[-1])['load'])
+            self.locs.append(load['loc'])
+            header, data = self.aes.run_func('_serve_file_raw', load)
+            reply = frames[:-1] + [self.serial.dumps(header), data]
+            if load['loc'] == 30 and self.locs.count(30) == 1:
+                # Hand back another chunk with the load of this one
+                reply[-1] = self.aes.run_func(
+                        '_serve_file_raw', dict(load, loc=40))[1]
+            self.socket.send_multipart(reply)
+            if load['loc'] == 50 and self.locs.count(50) == 1:
+                # A chunk answered twice is written once
+                self.socket.send_multipart(reply)
+
+    def _get(self, dest):
+        thread = threading.Thread(target=self._serve)
+        thread.start()
+        try:
+            return self.client._get_file_windowed(
+                    {'path': 'salt://src', 'env': 'base',
+                     'cmd': '_serve_file'},
+                    dest, open(dest, 'wb+'), 'base')
+        finally:
+            thread.join()
+
+    def test_windowed(self):
+        dest = os.path.join(self.tmpdir, 'dest')
+        self.assertEqual(self._get(dest), dest)
+        with open(self.src, 'rb') as fp_:
+            self.assertEqual(open(dest, 'rb').read(), fp_.read())
+        # The bad chunk was asked for again
+        self.assertEqual(sorted(self.locs),
+                         [0, 10, 20, 30, 30, 40, 50, 60, 70, 80, 90])
+
+    def test_retries(self):
+        # A chunk which keeps coming back bad is given up on
+        self.aes.run_func = lambda func, load: (
+                self.crypticle.dumps(dict(
+                    salt.master.AESFuncs._serve_file_raw(self.aes, load)[0],
+                    sum=''
+                    )),
+                self.crypticle.encrypt(''))
+        self.assertEqual(self._get(os.path.join(self.tmpdir, 'dest')), '')
+        self.assertEqual(self.locs, [0, 0, 0])
+
+
+if __name__ == "__main__":
+    loader = TestLoader()
+    tests = loader.loadTestsFromTestCase(WindowedTransferTest)
+    TextTestRunner(verbosity=1).run(tests)
@@ -0,0 +1,191 @@
+import os
+import time
+import shutil
+import hashlib
+import tempfile
+import subprocess
+from saltunittest import TestCase, TestLoader, TextTestRunner
+
+import salt.fileserver
+
+
+class HashCacheTest(TestCase):
+    def setUp(self):
+        super(HashCacheTest, self).setUp()
+        self.tmpdir = tempfile.mkdtemp()
+        self.opts = {'cachedir': os.path.join(self.tmpdir, 'cache'),
+                     'hash_type': 'md5',
+                     'serial': 'msgpack'}
+        self.path = os.path.join(self.tmpdir, 'file')
+        self._write('foo')
+
+    def tearDown(self):
+        shutil.rmtree(self.tmpdir)
+        super(HashCacheTest, self).tearDown()
+
+    def _write(self, data, mtime=None):
+        with open(self.path, 'w') as fp_:
+            fp_.write(data)
+        if mtime is not None:
+            os.utime(self.path, (mtime, mtime))
+
+    def test_get(self):
+        cache = salt.fileserver.HashCache(self.opts)
+        self.assertEqual(cache.get(self.path), hashlib.md5('foo').hexdigest())
+        self.assertEqual(cache.get(self.path, 'sha256'),
+                         hashlib.sha256('foo').hexdigest())
+        self.assertEqual(cache.get(os.path.join(self.tmpdir, 'missing')), '')
+
+    def test_shared(self):
+        mtime = time.time() - 60
+        self._write('foo', mtime)
+        salt.fileserver.HashCache(self.opts).get(self.path)
+        # Another worker reads the hash from disk, the stale hash shows
+        # the file is not read again
+        entry = os.path.join(self.opts['cachedir'], 'file_hashes', 'md5',
+                             hashlib.md5(self.path).hexdigest())
+        self.assertTrue(os.path.isfile(entry))
+        cache = salt.fileserver.HashCache(self.opts)
+        self._write('bar', mtime)
+        self.assertEqual(cache.get(self.path), hashlib.md5('foo').hexdigest())
+        # A changed size or mtime invalidates the hash
+        self._write('barbaz', mtime)
+        self.assertEqual(cache.get(self.path),
+                         hashlib.md5('barbaz').hexdigest())
+
+
+class FileIndexTest(TestCase):
+    def setUp(self):
+        super(FileIndexTest, self).setUp()
+        self.tmpdir = tempfile.mkdtemp()
+        for path in ('top.sls', 'apache/init.sls', 'apache/conf/httpd.conf',
+                     'apachex/init.sls'):
+            self._touch(path)
+        os.makedirs(os.path.join(self.tmpdir, 'apache', 'empty'))
+        self.index = salt.fileserver.FileIndex(
+                {'file_roots': {'base': [self.tmpdir]},
+                 'fileserver_list_cache_time': 0})
+
+    def tearDown(self):
+        shutil.rmtree(self.tmpdir)
+        super(FileIndexTest, self).tearDown()
+
+    def _touch(self, path):
+        path = os.path.join(self.tmpdir, path)
+        if not os.path.isdir(os.path.dirname(path)):
+            os.makedirs(os.path.dirname(path))
+        open(path, 'w').close()
+
+    def test_file_list(self):
+        self.assertEqual(
+                self.index.file_list('base'),
+                ['apache/conf/httpd.conf', 'apache/init.sls',
+                 'apachex/init.sls', 'top.sls'])
+        self.assertEqual(
+                self.index.file_list('base', 'apache/'),
+                ['apache/conf/httpd.conf', 'apache/init.sls'])
+        self.assertEqual(self.index.file_list('base', 'nginx'), [])
+        self.assertEqual(self.index.file_list('dev'), [])
+        self.assertEqual(self.index.file_list_emptydirs('base', 'apache'),
+                         ['apache/empty'])
+
+    def test_invalidate(self):
+        self.index.file_list('base')
+        self._touch('apache/conf/ssl.conf')
+        # Force the directory mtime to change on file systems with coarse
+        # timestamps
+        conf = os.path.join(self.tmpdir, 'apache', 'conf')
+        os.utime(conf, (0, 0))
+        self.assertTrue('apache/conf/ssl.conf' in self.index.file_list('base'))
+
+
+class ExtNodesTest(TestCase):
+    def setUp(self):
+        super(ExtNodesTest, self).setUp()
+        self.tmpdir = tempfile.mkdtemp()
+        self.runs = os.path.join(self.tmpdir, 'runs')
+        enc = os.path.join(self.tmpdir, 'enc')
+        with open(enc, 'w') as fp_:
+            fp_.write('#!/bin/sh\necho $1 >> {0}\n'
+                      'echo "classes: [$1]"\n'.format(self.runs))
+        os.chmod(enc, 493)
+        self.opts = {'cachedir': os.path.join(self.tmpdir, 'cache'),
+                     'serial': 'msgpack',
+                     'external_nodes': enc,
+                     'ext_nodes_cache_ttl': 60,
+                     'ext_nodes_stale_time': 300,
+                     'ext_nodes_max_procs': 2}
+
+    def tearDown(self):
+        shutil.rmtree(self.tmpdir)
+        super(ExtNodesTest, self).tearDown()
+
+    def _runs(self):
+        with open(self.runs) as fp_:
+            return fp_.read().split()
+
+    def test_get(self):
+        ext_nodes = salt.fileserver.ExtNodes(self.opts)
+        self.assertEqual(ext_nodes.get('web1'), {'base': ['web1']})
+        self.assertEqual(ext_nodes.get('web1'), {'base': ['web1']})
+        self.assertEqual(salt.fileserver.ExtNodes(self.opts).get('web2'),
+                         {'base': ['web2']})
+        self.assertEqual(self._runs(), ['web1', 'web2'])
+        self.assertEqual(ext_nodes.stats['hits'], 1)
+        self.assertEqual(ext_nodes.stats['runs'], 1)
+        self.assertEqual(ext_nodes.flush('web1'), ['web1'])
+        ext_nodes.get('web1')
+        self.assertEqual(self._runs(), ['web1', 'web2', 'web1'])
+
+    def test_stale(self):
+        ext_nodes = salt.fileserver.ExtNodes(self.opts)
+        ext_nodes.get('web1')
+        entry = os.path.join(self.opts['cachedir'], 'ext_nodes', 'web1')
+        ext_nodes._write(entry, {'classes': {'base': ['old']},
+                                 'time': time.time() - 120})
+        # The stale classes are returned while they are refreshed
+        self.assertEqual(ext_nodes.get('web1'), {'base': ['old']})
+        for _ in range(100):
+            if ext_nodes._read('web1')['classes'] != {'base': ['old']}:
+                break
+            time.sleep(0.05)
+        self.assertEqual(ext_nodes.get('web1'), {'base': ['web1']})
+        self.assertEqual(ext_nodes.stats['stale'], 1)
+        # The refresh is counted as a run, not as a miss as well
+        self.assertEqual(ext_nodes.stats['misses'], 1)
+        self.assertEqual(ext_nodes.stats['runs'], 2)
+
+    def test_stats(self):
+        self.opts['ext_nodes_cache_ttl'] = 0
+        ext_nodes = salt.fileserver.ExtNodes(self.opts)
+        ext_nodes.get('web1')
+        self.assertEqual(ext_nodes.stats['runs'], 0)
+        self.assertFalse(os.path.isdir(ext_nodes.stats_dir))
+        # The counters of a process which has exited are removed
+        proc = subprocess.Popen(['true'])
+        proc.wait()
+        dead = os.path.join(ext_nodes.stats_dir, str(proc.pid))
+        ext_nodes._write(dead, dict(ext_nodes.stats, hits=5))
+        ext_nodes._write(os.path.join(ext_nodes.stats_dir,
+                                      str(os.getpid())),
+                         dict(ext_nodes.stats, hits=2))
+        self.assertEqual(ext_nodes.read_stats()['hits'], 2)
+        self.assertFalse(os.path.exists(dead))
+
+    def test_unsafe_id(self):
+        ext_nodes = salt.fileserver.ExtNodes(self.opts)
+        self.assertEqual(ext_nodes.get('../escape'), {'base': ['../escape']})
+        self.assertEqual(ext_nodes.get('../escape'), {'base': ['../escape']})
+        # The classes of an id which is not a plain file name are not cached
+        self.assertEqual(self._runs(), ['../escape', '../escape'])
+        self.assertFalse(os.path.exists(
+            os.path.join(self.opts['cachedir'], 'escape')))
+        self.assertEqual(ext_nodes.flush('../escape'), [])
+
+
+if __name__ == "__main__":
+    loader = TestLoader()
+    tests = loader.loadTestsFromTestCase(HashCacheTest)
+    tests.addTests(loader.loadTestsFromTestCase(FileIndexTest))
+    tests.addTests(loader.loadTestsFromTestCase(ExtNodesTest))
+    TextTestRunner(verbosity=1).run(tests)
@@ -0,0 +1,92 @@
+import shutil
+import tempfile
+from saltunittest import TestCase, TestLoader, TextTestRunner, skipIf
+
+import salt.jobcache
+
+
+class LocalFSJobCacheTest(TestCase):
+    backend = 'localfs'
+
+    def setUp(self):
+        super(LocalFSJobCacheTest, self).setUp()
+        self.tmpdir = tempfile.mkdtemp()
+        self.cache = salt.jobcache.get_job_cache(
+                {'cachedir': self.tmpdir,
+                 'hash_type': 'md5',
+                 'keep_jobs': 24,
+                 'serial': 'msgpack',
+                 'job_cache_backend': self.backend}
+                )
+        self.jid = self.cache.prep_jid()
+        self.load = {'jid': self.jid,
+                     'fun': 'test.ping',
+                     'arg': [],
+                     'tgt': '*',
+                     'tgt_type': 'glob'}
+        self.cache.save_load(self.jid, self.load)
+
+    def tearDown(self):
+        shutil.rmtree(self.tmpdir)
+        super(LocalFSJobCacheTest, self).tearDown()
+
+    def test_load(self):
+        self.assertTrue(self.cache.has_jid(self.jid))
+        self.assertFalse(self.cache.has_jid('20000101000000000000'))
+        self.assertEqual(self.cache.get_load(self.jid), self.load)
+        self.assertEqual(list(self.cache.list_jobs()), [self.jid])
+
+    def test_returns(self):
+        self.assertTrue(self.cache.save_return(
+            {'jid': self.jid, 'id': 'web1', 'return': True, 'out': 'txt'}))
+        # A second return from the same minion is dropped
+        self.assertFalse(self.cache.save_return(
+            {'jid': self.jid, 'id': 'web1', 'return': False}))
+        # Returns for unknown jobs are dropped
+        self.assertFalse(self.cache.save_return(
+            {'jid': '20000101000000000000', 'id': 'web1', 'return': True}))
+        self.assertEqual(self.cache.save_returns(
+            [{'jid': self.jid, 'id': 'web2', 'return': [1, 2]},
+             {'jid': self.jid, 'id': 'web3', 'return': 'foo'}]), 2)
+        self.assertEqual(
+            self.cache.get_returns(self.jid),
+            {'web1': {'ret': True, 'out': 'txt'},
+             'web2': {'ret': [1, 2]},
+             'web3': {'ret': 'foo'}})
+        self.assertEqual(self.cache.get_minion_jids('web2'), [self.jid])
+        self.assertEqual(self.cache.get_minion_jids('db1'), [])
+
+    def test_clean_old_jobs(self):
+        old_jid = '20000101000000000000'
+        self.cache.save_load(old_jid, dict(self.load, jid=old_jid))
+        self.cache.save_return({'jid': old_jid, 'id': 'web1', 'return': 1})
+        self.assertTrue(self.cache.has_jid(old_jid))
+        if self.backend == 'localfs':
+            # A job indexed twice is counted once
+            self.cache._index_jid(self.jid)
+        self.assertEqual(self.cache.clean_old_jobs(),
+                         {'reclaimed': 1, 'retained': 1})
+        self.assertFalse(self.cache.has_jid(old_jid))
+        self.assertEqual(self.cache.get_returns(old_jid), {})
+        self.assertTrue(self.cache.has_jid(self.jid))
+        self.assertEqual(self.cache.clean_old_jobs(),
+                         {'reclaimed': 0, 'retained': 1})
+
+    def test_wtag(self):
+        self.assertFalse(self.cache.has_wtag(self.jid))
+        self.cache.add_wtag(self.jid, 'syndic1')
+        self.assertTrue(self.cache.has_wtag(self.jid))
+        self.cache.rm_wtag(self.jid, 'syndic1')
+        self.assertFalse(self.cache.has_wtag(self.jid))
+
+
+@skipIf(not salt.jobcache.HAS_SQLITE, 'sqlite3 is not available')
+class SQLiteJobCacheTest(LocalFSJobCacheTest):
+    backend = 'sqlite'
+
+
+if __name__ == "__main__":
+    loader = TestLoader()
+    tests = loader.loadTestsFromTestCase(LocalFSJobCacheTest)
+    tests.addTests(loader.loadTestsFromTestCase(SQLiteJobCacheTest))
+    TextTestRunner(verbosity=1).run(tests)
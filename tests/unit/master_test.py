@@ -0,0 +1,568 @@
+import os
+import errno
+import time
+import shutil
+import tempfile
+from saltunittest import TestCase, TestLoader, TextTestRunner
+
+import zmq
+
+import salt.master
+import salt.payload
+
+
+class FakeProc(object):
+    def __init__(self, ident):
+        self.ident = ident
+        self.alive = False
+        self.pid = None
+
+    def start(self):
+        self.alive = True
+
+    def is_alive(self):
+        return self.alive
+
+    def terminate(self):
+        self.alive = False
+
+
+class FakeSocket(object):
+    def __init__(self):
+        self.sent = []
+        self.incoming = []
+
+    def send_multipart(self, frames):
+        self.sent.append(frames)
+
+    def recv_multipart(self):
+        return self.incoming.pop(0)
+
+
+class WorkerPoolTest(TestCase):
+    def setUp(self):
+        super(WorkerPoolTest, self).setUp()
+        self.opts = {'worker_idle_time': 300,
+                     'worker_timeout': 60,
+                     'worker_max_memory': 0}
+        self.socket = FakeSocket()
+        self.pool = salt.master.WorkerPool(
+                self.opts, 'worker', FakeProc, self.socket, 1, 3)
+        self.pool.maintain()
+
+    def _ready(self, ident, reply=None):
+        self.socket.incoming.append([ident, ''] + (reply or ['ready']))
+        return self.pool.receive()
+
+    def test_grow_and_shrink(self):
+        self.assertEqual(self.pool.children.keys(), ['worker-1'])
+        self.assertEqual(self._ready('worker-1'), None)
+        self.pool.submit(['minion', '', 'req1'])
+        self.pool.submit(['minion', '', 'req2'])
+        self.assertEqual(self.socket.sent,
+                         [['worker-1', '', 'minion', '', 'req1']])
+        # A request is waiting, so a worker is added
+        self.pool.maintain()
+        self.assertEqual(len(self.pool.children), 2)
+        self._ready('worker-2')
+        self.assertEqual(self.socket.sent[-1],
+                         ['worker-2', '', 'minion', '', 'req2'])
+        self.assertEqual(self._ready('worker-1', ['minion', '', 'ret1']),
+                         ['minion', '', 'ret1'])
+        self._ready('worker-2', ['minion', '', 'ret2'])
+        # No worker is added again until the last one has had time to help
+        self.pool.submit(['minion', '', 'req3'])
+        self.pool.submit(['minion', '', 'req4'])
+        self.pool.submit(['minion', '', 'req5'])
+        self.pool.maintain()
+        self.assertEqual(len(self.pool.children), 2)
+        self.pool.last_grow -= 2
+        self.pool.maintain()
+        self.assertEqual(len(self.pool.children), 3)
+        self._ready('worker-3')
+        self._ready('worker-1', ['minion', '', 'ret4'])
+        self._ready('worker-2', ['minion', '', 'ret3'])
+        self._ready('worker-3', ['minion', '', 'ret5'])
+        stats = self.pool.read_stats()
+        self.assertEqual(stats['handled'], 5)
+        self.assertEqual(stats['queued'], 0)
+        # The longest idle worker is stopped once it has been idle too long
+        self.opts['worker_idle_time'] = 0
+        self.pool.children['worker-1']['idle_since'] -= 1
+        self.pool.maintain()
+        self.assertEqual(sorted(self.pool.children), ['worker-2', 'worker-3'])
+        self.pool.children['worker-2']['idle_since'] -= 1
+        self.pool.maintain()
+        self.assertEqual(self.pool.children.keys(), ['worker-3'])
+        self.pool.maintain()
+        self.assertEqual(len(self.pool.children), 1)
+
+    def test_hung(self):
+        self._ready('worker-1')
+        self.pool.submit(['minion', '', 'req1'])
+        self.pool.children['worker-1']['start'] = time.time() - 120
+        self.assertEqual(self.pool.maintain(), [('minion', '')])
+        self.assertEqual(self.pool.children.keys(), ['worker-2'])
+        self.assertEqual(self.pool.stats['hung'], 1)
+
+    def test_lanes(self):
+        lanes = {'return': {'cmds': ['_return'], 'weight': 2, 'reserved': 1},
+                 'file': {'cmds': ['_serve_file'], 'weight': 1}}
+        pool = salt.master.WorkerPool(
+                self.opts, 'worker', FakeProc, self.socket, 1, 1, lanes)
+        self.pool = pool
+        pool.maintain()
+        # A worker is left over for the lanes without reserved workers
+        self.assertEqual(len(pool.children), 2)
+        self._ready('worker-1')
+        for num in range(4):
+            pool.submit(['m', '', 'file{0}'.format(num)], '_serve_file')
+        # The reserved worker is not used for file transfers
+        self.assertEqual(len(self.socket.sent), 0)
+        self._ready('worker-2')
+        self.assertEqual(self.socket.sent[-1][-1], 'file0')
+        pool.submit(['m', '', 'ret0'], '_return')
+        self.assertEqual(self.socket.sent[-1],
+                         ['worker-1', '', 'm', '', 'ret0'])
+        # Once free the reserved worker only takes returns
+        pool.submit(['m', '', 'ret1'], '_return')
+        self._ready('worker-1', ['m', '', 'done'])
+        self.assertEqual(self.socket.sent[-1][-1], 'ret1')
+        self._ready('worker-1', ['m', '', 'done'])
+        self.assertEqual(len(self.socket.sent), 3)
+        self._ready('worker-2', ['m', '', 'done'])
+        self.assertEqual(self.socket.sent[-1][-1], 'file1')
+
+    def test_weights(self):
+        lanes = {'return': {'cmds': ['_return'], 'weight': 2},
+                 'file': {'cmds': ['_serve_file'], 'weight': 1}}
+        pool = salt.master.WorkerPool(
+                self.opts, 'worker', FakeProc, self.socket, 1, 1, lanes)
+        self.pool = pool
+        pool.maintain()
+        self._ready('worker-1')
+        pool.submit(['m', '', 'first'], 'runner')
+        for num in range(3):
+            pool.submit(['m', '', 'file{0}'.format(num)], '_serve_file')
+        for num in range(4):
+            pool.submit(['m', '', 'ret{0}'.format(num)], '_return')
+        pool.submit(['m', '', 'other'], 'runner')
+        served = []
+        for num in range(8):
+            self._ready('worker-1', ['m', '', 'done'])
+            served.append(self.socket.sent[-1][-1])
+        # The return lane gets twice the turns of the others
+        self.assertEqual(served, ['file0', 'ret0', 'ret1', 'other', 'file1',
+                                  'ret2', 'ret3', 'file2'])
+        self.assertEqual(pool.read_stats()['lanes']['return'],
+                         {'queued': 0, 'busy': 0})
+
+
+class FakeRegistry(object):
+    def check_glob(self, expr):
+        return set(['web1', 'web2']) if expr == 'web*' else set()
+
+    def check_list(self, expr):
+        return [id_ for id_ in expr if id_.startswith('web')]
+
+    def check_pcre(self, expr):
+        return set(['web{0}'.format(num) for num in range(100)])
+
+
+class PublishTopicsTest(TestCase):
+    def setUp(self):
+        super(PublishTopicsTest, self).setUp()
+        self.opts = {'publish_topics': 1, 'order_masters': False}
+        self.registry = FakeRegistry()
+
+    def _topics(self, tgt, tgt_type=None):
+        load = {'tgt': tgt}
+        if tgt_type:
+            load['tgt_type'] = tgt_type
+        return salt.master.publish_topics(self.opts, self.registry, load)
+
+    def test_targeted(self):
+        topics = sorted(set([salt.payload.pub_topic('web1', 1),
+                             salt.payload.pub_topic('web2', 1)]))
+        self.assertEqual(self._topics('web*'), topics)
+        self.assertEqual(self._topics(['web1', 'web2', 'db1'], 'list'),
+                         topics)
+        self.assertEqual(self._topics('db*'), [])
+
+    def test_broadcast(self):
+        self.assertEqual(self._topics('G@os:Ubuntu', 'compound'), None)
+        # Every bucket has a matching minion
+        self.assertEqual(self._topics('web.*', 'pcre'), None)
+        self.opts['order_masters'] = True
+        self.assertEqual(self._topics('web*'), None)
+
+
+class PublishChannelTest(TestCase):
+    def setUp(self):
+        super(PublishChannelTest, self).setUp()
+        self.tmpdir = tempfile.mkdtemp()
+        self.context = zmq.Context()
+        self.pull = self.context.socket(zmq.PULL)
+        self.pull.linger = 0
+        self.pull.bind('ipc://{0}'.format(
+            os.path.join(self.tmpdir, 'publish_pull.ipc')))
+        self.channel = salt.master.PublishChannel(
+                {'sock_dir': self.tmpdir, 'serial': 'msgpack'})
+
+    def tearDown(self):
+        self.channel.close()
+        self.pull.close()
+        self.context.term()
+        shutil.rmtree(self.tmpdir)
+        super(PublishChannelTest, self).tearDown()
+
+    def _recv(self):
+        self.assertTrue(self.pull.poll(1000))
+        return self.pull.recv_multipart()
+
+    def test_reuse(self):
+        self.channel.send({'jid': '1'})
+        socket = self.channel.socket
+        self.channel.send({'jid': '2'}, ['a'])
+        # No minion is targeted, nothing goes out
+        self.channel.send({'jid': '3'}, [])
+        self.assertTrue(self.channel.socket is socket)
+        self.assertEqual(self.channel.sent, 2)
+        serial = self.channel.serial
+        self.assertEqual(serial.loads(self._recv()[0]), {'jid': '1'})
+        frames = self._recv()
+        self.assertEqual(serial.loads(frames[0]), {'jid': '2'})
+        self.assertEqual(frames[1:], ['a'])
+        # A channel inherited across a fork connects again
+        self.channel.pid = -1
+        self.channel.send({'jid': '4'})
+        self.assertFalse(self.channel.socket is socket)
+        self.assertEqual(serial.loads(self._recv()[0]), {'jid': '4'})
+        socket.close()
+        self.channel.close()
+        self.assertEqual(self.channel.socket, None)
+
+
+NODROP = 'nodrop'
+
+
+class FakePubSocket(object):
+    '''
+    An XPUB socket with one healthy minion, and one minion which has room
+    for publications only while it is not full
+    '''
+    def __init__(self):
+        self.nodrop = 1
+        self.full = False
+        self.healthy = []
+        self.slow = []
+
+    def setsockopt(self, option, value):
+        self.nodrop = value
+
+    def send_multipart(self, msg, flags=0):
+        if self.full:
+            if self.nodrop:
+                raise zmq.ZMQError(errno.EAGAIN)
+        else:
+            self.slow.append(msg)
+        self.healthy.append(msg)
+
+
+class PublisherTest(TestCase):
+    def setUp(self):
+        super(PublisherTest, self).setUp()
+        self.opts = {'publish_topics': 0,
+                     'order_masters': False,
+                     'pub_queue_size': 3,
+                     'pub_queue_timeout': 10}
+        self.pub = salt.master.Publisher(self.opts)
+        self.sock = FakePubSocket()
+
+    def _flush(self):
+        return self.pub._flush(self.sock, NODROP, len(self.pub.queue))
+
+    def test_enqueue(self):
+        for num in range(5):
+            self.pub._enqueue(['pub{0}'.format(num)])
+        self.assertEqual([msg for _, msg in self.pub.queue],
+                         [['pub0'], ['pub1'], ['pub2']])
+        self.assertEqual(self.pub.stats['overflowed'], 2)
+        self.assertEqual(self.pub.stats['peak'], 3)
+        self.assertEqual(self.pub._flush(self.sock, NODROP, 2), 2)
+        self.assertEqual(self.sock.healthy, [['pub0'], ['pub1']])
+        self.assertEqual(len(self.pub.queue), 1)
+
+    def test_topics(self):
+        self.opts['publish_topics'] = 1
+        self.pub._enqueue(['pub', 'a', 'b'])
+        self.pub._enqueue(['all'])
+        self.assertEqual([msg for _, msg in self.pub.queue],
+                         [['a', 'pub'], ['b', 'pub'],
+                          [salt.payload.BROADCAST, 'all']])
+
+    def test_hold_and_skip(self):
+        self.sock.full = True
+        self.pub._enqueue(['pub0'])
+        self.pub._enqueue(['pub1'])
+        # The publications are held for the slow minion
+        self.assertEqual(self._flush(), 0)
+        self.assertEqual(self._flush(), 0)
+        self.assertEqual(self.pub.stats['delayed'], 1)
+        self.assertEqual(self.sock.healthy, [])
+        # Once it has waited too long the first one goes without it, and
+        # the rest are not held for the slow minion again
+        self.pub.queue[0] = (time.time() - 11, self.pub.queue[0][1])
+        self.assertEqual(self._flush(), 2)
+        self.pub._enqueue(['pub2'])
+        self.assertEqual(self._flush(), 1)
+        self.assertEqual(self.sock.healthy, [['pub0'], ['pub1'], ['pub2']])
+        self.assertEqual(self.sock.slow, [])
+        self.assertEqual(self.sock.nodrop, 1)
+        self.assertEqual(self.pub.stats['skipped'], 3)
+        self.assertEqual(self.pub.stats['delayed'], 1)
+
+    def test_catch_up(self):
+        self.sock.full = True
+        self.pub._enqueue(['pub0'])
+        self.pub.queue[0] = (time.time() - 11, self.pub.queue[0][1])
+        self._flush()
+        # The slow minion has room again, but has not kept up for long
+        self.sock.full = False
+        self.pub._enqueue(['pub1'])
+        self._flush()
+        self.assertNotEqual(self.pub.lagging, None)
+        self.sock.full = True
+        self.pub._enqueue(['pub2'])
+        self.assertEqual(self._flush(), 1)
+        # Once it has kept up for pub_queue_timeout publications are held
+        # for it again
+        self.sock.full = False
+        self.pub.lagging -= 10
+        self.pub._enqueue(['pub3'])
+        self._flush()
+        self.assertEqual(self.pub.lagging, None)
+        self.sock.full = True
+        self.pub._enqueue(['pub4'])
+        self.assertEqual(self._flush(), 0)
+        self.assertEqual(self.sock.slow, [['pub1'], ['pub3']])
+        self.assertEqual(self.pub.stats['skipped'], 2)
+
+
+class PillarPoolTest(TestCase):
+    def setUp(self):
+        super(PillarPoolTest, self).setUp()
+        self.opts = {'sock_dir': '/tmp',
+                     'serial': 'msgpack',
+                     'pillar_pool_size': 1,
+                     'pillar_timeout': 60}
+        self.serial = salt.payload.Serial(self.opts)
+        self.pool = salt.master.PillarPool(self.opts, FakeProc)
+        self.front = FakeSocket()
+        self.back = FakeSocket()
+        self.pool._spawn()
+
+    def _submit(self, waiter, id_='minion'):
+        load = {'id': id_, 'grains': {'os': 'Ubuntu'}, 'env': None}
+        self.pool.submit(self.front,
+                         [waiter, '', self.serial.dumps({'load': load})])
+
+    def _ready(self, ident='pillar-1', ret=None):
+        self.pool.finish(self.front, ident, self.serial.dumps(ret))
+
+    def _replies(self):
+        return [(frames[0], self.serial.loads(frames[-1]))
+                for frames in self.front.sent]
+
+    def test_deduplicate(self):
+        self._ready()
+        self._submit('mworker-1')
+        self._submit('mworker-2')
+        self.pool.dispatch(self.back)
+        self.assertEqual(len(self.back.sent), 1)
+        self._ready(ret={'role': 'web'})
+        self.assertEqual(self._replies(),
+                         [('mworker-1', {'role': 'web'}),
+                          ('mworker-2', {'role': 'web'})])
+        self.assertEqual(self.pool.stats['compiled'], 1)
+        self.assertEqual(self.pool.stats['deduplicated'], 1)
+        self.assertEqual(list(self.pool.idle), ['pillar-1'])
+
+    def test_expire_queued(self):
+        # The process is not ready, so the request stays queued
+        self._submit('mworker-1')
+        self._submit('mworker-2', 'other')
+        self.pool.jobs[('minion', self.pool.queue[0][1])]['queued'] -= 61
+        self.pool.maintain(self.front, time.time())
+        self.assertEqual(self._replies(), [('mworker-1', False)])
+        self.assertEqual(len(self.pool.queue), 1)
+        self.assertEqual(self.pool.stats['expired'], 1)
+
+    def test_timeout_running(self):
+        self._ready()
+        self._submit('mworker-1')
+        self.pool.dispatch(self.back)
+        proc = self.pool.children['pillar-1']['proc']
+        self.pool.maintain(self.front, time.time())
+        self.assertEqual(self.front.sent, [])
+        # The time spent queued counts towards the timeout
+        self.pool.maintain(self.front, time.time() + 61)
+        self.assertEqual(self._replies(), [('mworker-1', False)])
+        self.assertEqual(self.pool.stats['timed_out'], 1)
+        # The process is told to stop without waiting for it to exit
+        self.assertFalse(proc.is_alive())
+        self.assertEqual(self.pool.children.keys(), ['pillar-2'])
+        self.assertEqual(self.pool.jobs, {})
+        # A late answer from the killed process is ignored
+        self._ready(ret={'role': 'web'})
+        self.assertEqual(len(self.front.sent), 1)
+        self.pool.maintain(self.front, time.time())
+        self.assertEqual(self.pool.dying, [])
+
+
+class RequestCmdTest(TestCase):
+    def setUp(self):
+        super(RequestCmdTest, self).setUp()
+        # Only the serializer of the request server is needed
+        self.server = salt.master.ReqServer.__new__(salt.master.ReqServer)
+        self.server.serial = salt.payload.Serial('msgpack')
+
+    def _cmd(self, payload):
+        return self.server._request_cmd(self.server.serial.dumps(payload))
+
+    def test_request_cmd(self):
+        self.assertEqual(
+                self._cmd({'enc': 'aes', 'load': 'x' * 4096,
+                           'cmd': '_return'}),
+                '_return')
+        self.assertEqual(self._cmd({'enc': 'aes', 'load': 'x'}), None)
+        # Sign ins from older minions carry the command in the load
+        self.assertEqual(
+                self._cmd({'enc': 'clear', 'load': {'cmd': '_auth'}}),
+                '_auth')
+        self.assertEqual(
+                self._cmd({'enc': 'clear',
+                           'load': {'cmd': '_auth', 'pad': 'x' * 65536}}),
+                None)
+        self.assertEqual(self._cmd({'enc': 'aes', 'cmd': ['_auth']}), None)
+        self.assertEqual(self.server._request_cmd('garbage'), None)
+
+
+class AdmissionTest(TestCase):
+    def setUp(self):
+        super(AdmissionTest, self).setUp()
+        self.opts = {'auth_queue_size': 1,
+                     'worker_idle_time': 300,
+                     'worker_timeout': 0,
+                     'worker_max_memory': 0}
+        self.server = salt.master.ReqServer.__new__(salt.master.ReqServer)
+        self.server.opts = self.opts
+        self.server.serial = salt.payload.Serial('msgpack')
+        self.server.clients = FakeSocket()
+        self.server.pools = {}
+        for name in ('workers', 'auth'):
+            self.server.pools[name] = salt.master.WorkerPool(
+                    self.opts, name, FakeProc, FakeSocket(), 1, 1)
+
+    def _request(self, ident, cmd):
+        return [ident, '', self.server.serial.dumps(
+            {'enc': 'clear', 'load': {'cmd': cmd}, 'cmd': cmd})]
+
+    def test_busy(self):
+        auths = set()
+        self.server._admit(self._request('m1', '_auth'), auths, 'busy')
+        self.server._admit(self._request('m2', '_return'), auths, 'busy')
+        self.assertEqual(auths, set([('m1', '')]))
+        self.assertEqual(self.server.pools['auth'].queued, 1)
+        self.assertEqual(self.server.pools['workers'].queued, 1)
+        # A sign in over auth_queue_size is told to come back later
+        self.server._admit(self._request('m3', '_auth'), auths, 'busy')
+        self.assertEqual(self.server.clients.sent, [['m3', '', 'busy']])
+        self.assertEqual(self.server.pools['auth'].queued, 1)
+        # Without auth workers the sign ins go to the master workers
+        auths.clear()
+        del self.server.pools['auth']
+        self.server._admit(self._request('m3', '_auth'), auths, 'busy')
+        self.assertEqual(self.server.pools['workers'].queued, 2)
+
+
+class FakeRSA(object):
+    def __init__(self):
+        self.encrypted = []
+
+    def public_encrypt(self, data, padding):
+        self.encrypted.append(data)
+        return 'sealed-{0}'.format(data)
+
+
+class FakeKeys(object):
+    def __init__(self):
+        self.pubs = {}
+        self.rsa = FakeRSA()
+
+    def list_keys(self, state='minions'):
+        return []
+
+    def get_pub(self, id_, state='minions'):
+        return self.pubs.get(id_)
+
+    def set_pub(self, id_, pub, state='minions'):
+        self.pubs[id_] = pub
+
+    def get_rsa(self, id_):
+        return self.rsa
+
+
+class FakeEvent(object):
+    def fire_event(self, data, tag):
+        pass
+
+
+class AuthEnvelopeTest(TestCase):
+    def setUp(self):
+        super(AuthEnvelopeTest, self).setUp()
+        self.opts = {'open_mode': True,
+                     'auto_accept': False,
+                     'aes': 'aes1',
+                     'publish_port': 4505,
+                     'publish_topics': 0,
+                     'order_masters': False}
+        self.funcs = salt.master.ClearFuncs.__new__(salt.master.ClearFuncs)
+        self.funcs.opts = self.opts
+        self.funcs.key_registry = FakeKeys()
+        self.funcs.master_pub = 'master-pub'
+        self.funcs.master_key = type('MasterKey', (object,),
+                                     {'token': 'token'})()
+        self.funcs.auth_envelopes = {}
+        self.funcs.event = FakeEvent()
+
+    def _auth(self, pub):
+        return self.funcs._auth({'id': 'web1', 'pub': pub})
+
+    def test_envelopes(self):
+        rsa = self.funcs.key_registry.rsa
+        self.assertEqual(self._auth('pub1')['aes'], 'sealed-aes1')
+        self.assertEqual(self._auth('pub1')['aes'], 'sealed-aes1')
+        # The envelope is sealed once while neither key changes
+        self.assertEqual(rsa.encrypted, ['aes1'])
+        # A new minion key or a new aes key seal the envelope again
+        self._auth('pub2')
+        self.assertEqual(len(rsa.encrypted), 2)
+        self.opts['aes'] = 'aes2'
+        self.assertEqual(self._auth('pub2')['aes'], 'sealed-aes2')
+        self.assertEqual(rsa.encrypted, ['aes1', 'aes1', 'aes2'])
+        self.assertEqual(self._auth('pub2')['aes'], 'sealed-aes2')
+        self.assertEqual(len(rsa.encrypted), 3)
+
+
+if __name__ == "__main__":
+    loader = TestLoader()
+    tests = loader.loadTestsFromTestCase(WorkerPoolTest)
+    tests.addTests(loader.loadTestsFromTestCase(PublishTopicsTest))
+    tests.addTests(loader.loadTestsFromTestCase(PublishChannelTest))
+    tests.addTests(loader.loadTestsFromTestCase(PublisherTest))
+    tests.addTests(loader.loadTestsFromTestCase(PillarPoolTest))
+    tests.addTests(loader.loadTestsFromTestCase(RequestCmdTest))
+    tests.addTests(loader.loadTestsFromTestCase(AdmissionTest))
+    tests.addTests(loader.loadTestsFromTestCase(AuthEnvelopeTest))
+    TextTestRunner(verbosity=1).run(tests)
@@ -0,0 +1,402 @@
+import os
+import shutil
+import tempfile
+import time
+from saltunittest import TestCase, TestLoader, TextTestRunner
+
+import zmq
+
+import salt.minion
+import salt.payload
+import salt.pillar
+import salt.utils
+from salt.exceptions import AuthenticationError, SaltClientError
+
+GRAINS = {'os': 'Ubuntu',
+          'roles': ['web', 'db'],
+          'kernel': 'Linux'}
+
+
+class TargetMatcherTest(TestCase):
+    def test_same_as_matcher(self):
+        nodegroups = {'webs': 'G@roles:web and not db*'}
+        targets = [('web*', 'glob'),
+                   ('db[12]', 'glob'),
+                   ('web\\d', 'pcre'),
+                   ('web1,db1', 'list'),
+                   ('os:ubuntu', 'grain'),
+                   ('roles:d*', 'grain'),
+                   ('nothere:foo', 'grain'),
+                   ('kernel:lin.*', 'grain_pcre'),
+                   ('web* and G@os:Ubuntu', 'compound'),
+                   ('G@os:Debian or L@db1,db2', 'compound'),
+                   ('not E@web\\d and P@roles:w.*', 'compound'),
+                   ('Z@foo', 'compound'),
+                   ('webs', 'nodegroup')]
+        for id_ in ('web1', 'db1', 'db3'):
+            opts = {'id': id_, 'grains': GRAINS}
+            matcher = salt.minion.Matcher(opts, {'test.true': None})
+            for tgt, kind in targets:
+                expected = matcher.confirm_top(
+                        tgt, [{'match': kind}], nodegroups)
+                target = salt.minion.TargetMatcher(tgt, kind, nodegroups)
+                self.assertFalse(target.dynamic)
+                self.assertEqual(target(id_, GRAINS), expected,
+                                 '{0} {1} {2}'.format(id_, kind, tgt))
+
+    def test_dynamic(self):
+        self.assertTrue(
+                salt.minion.TargetMatcher('role:web', 'pillar').dynamic)
+        self.assertTrue(salt.minion.TargetMatcher(
+            'web* and I@role:web', 'compound').dynamic)
+
+
+class TopMatcherTest(TestCase):
+    def setUp(self):
+        super(TopMatcherTest, self).setUp()
+        self.top = {'base': {'*': ['common'],
+                             'web*': ['web'],
+                             'roles:db': [{'match': 'grain'}, 'db']},
+                    'dev': {'db*': ['devdb']}}
+
+    def test_matches(self):
+        top_matcher = salt.minion.TopMatcher(self.top)
+        self.assertEqual(sorted(top_matcher.matches('web1', GRAINS)['base']),
+                         ['common', 'db', 'web'])
+        self.assertEqual(top_matcher.matches('mail1', {}),
+                         {'base': ['common']})
+        self.assertEqual(top_matcher.matches('db1', {}, 'dev'),
+                         {'dev': ['devdb']})
+        ret = top_matcher.matches('db1', {'roles': ['db']})
+        self.assertEqual(ret, {'base': ['common', 'db'], 'dev': ['devdb']})
+        # The result is kept for the minion until its grains change
+        ret['base'].append('mutated')
+        self.assertEqual(
+                top_matcher.matches('db1', {'roles': ['db']})['base'],
+                ['common', 'db'])
+        self.assertEqual(
+                top_matcher.matches('db1', {'roles': []})['base'],
+                ['common'])
+
+
+class FakePull(object):
+    def __init__(self, packages):
+        self.packages = packages
+
+    def recv(self, flags=0):
+        if not self.packages:
+            raise zmq.ZMQError(zmq.EAGAIN)
+        return self.packages.pop(0)
+
+
+class FakePub(object):
+    def __init__(self):
+        self.sent = []
+
+    def send(self, package):
+        self.sent.append(package)
+
+
+class MainLoopTest(TestCase):
+    def setUp(self):
+        super(MainLoopTest, self).setUp()
+        # Skip the sign in done when a minion is created
+        self.minion = salt.minion.Minion.__new__(salt.minion.Minion)
+        self.minion.opts = {'sub_timeout': 0,
+                            'return_batch_window': 2}
+        self.minion.serial = salt.payload.Serial('msgpack')
+        self.minion._return_queue = []
+        self.minion._return_queue_start = 0
+        self.minion._spool_pending = False
+        self.minion._spool_next = 0
+        self.minion._refresh = None
+        self.minion._reauth_at = None
+        self.minion._held_pubs = []
+        self.minion.job_pool = None
+
+    def _event(self, tag, data):
+        return '{0}{1}'.format((tag + 20 * '|')[:20],
+                               self.minion.serial.dumps(data))
+
+    def test_poll_timeout(self):
+        now = time.time()
+        # An idle minion only wakes up once a minute
+        self.assertTrue(59000 <= self.minion._poll_timeout(now) <= 60000)
+        self.minion.opts['sub_timeout'] = 30
+        self.assertTrue(29000 <= self.minion._poll_timeout(now) <= 30000)
+        self.minion._return_queue.append({})
+        self.minion._return_queue_start = now
+        self.assertTrue(1000 <= self.minion._poll_timeout(now) <= 2000)
+        self.minion._spool_pending = True
+        self.assertEqual(self.minion._poll_timeout(now), 0)
+
+    def test_refresh_event(self):
+        pull = FakePull([self._event('module_refresh', {'pillar': False}),
+                         self._event('module_refresh', {'pillar': True}),
+                         self._event('module_refresh', {'pillar': False}),
+                         self._event('other', {})])
+        pub = FakePub()
+        self.minion._handle_events(pull, pub)
+        self.assertEqual(self.minion._refresh, True)
+        self.assertEqual(len(pub.sent), 4)
+
+    def test_spooled_event(self):
+        # A job process which spooled its return has the main loop replay it
+        pull = FakePull([self._event('__spooled__', {})])
+        pub = FakePub()
+        self.minion._handle_events(pull, pub)
+        self.assertTrue(self.minion._spool_pending)
+        self.assertEqual(pub.sent, [])
+
+    def test_pillar_failure(self):
+        class FailingPillar(object):
+            def compile_pillar(self):
+                raise SaltClientError('busy')
+        self.minion.opts.update({'pillar': {'role': 'web'},
+                                 'grains': {},
+                                 'id': 'web1',
+                                 'environment': None})
+        self.minion._Minion__load_modules = lambda: ({}, {})
+        get_pillar = salt.pillar.get_pillar
+        salt.pillar.get_pillar = lambda *args: FailingPillar()
+        try:
+            # The pillar the minion has is kept when the master is busy
+            self.minion.module_refresh(True)
+        finally:
+            salt.pillar.get_pillar = get_pillar
+        self.assertEqual(self.minion.opts['pillar'], {'role': 'web'})
+        self.assertEqual(self.minion._refresh, None)
+
+    def test_send_batch(self):
+        sent = []
+        replies = []
+
+        class FakeSREQ(object):
+            def __init__(self, uri):
+                pass
+
+            def send(self, enc, load, tries, timeout, cmd):
+                sent.append(load)
+                return replies.pop(0)
+        self.minion.opts.update({'id': 'web1', 'master_uri': 'tcp://master'})
+        self.minion.crypticle = PlainCrypticle()
+        returns = [{'jid': '1', 'return': True},
+                   {'jid': '2', 'return': False}]
+        sreq = salt.payload.SREQ
+        salt.payload.SREQ = FakeSREQ
+        try:
+            replies.append(True)
+            self.assertTrue(self.minion._send_batch(returns))
+            self.assertEqual(len(sent), 1)
+            self.assertEqual(sent[0]['cmd'], '_return_batch')
+            # An older master answers the batch with an encrypted False, the
+            # returns are then sent one at a time
+            del sent[:]
+            replies.extend(['sealed False', True, True])
+            self.assertTrue(self.minion._send_batch(returns))
+            self.assertEqual([load['cmd'] for load in sent],
+                             ['_return_batch', '_return', '_return'])
+            self.assertEqual(sent[2],
+                             {'cmd': '_return', 'id': 'web1', 'jid': '2',
+                              'return': False})
+            # The returns are kept while the minion signs in again
+            self.minion.opts['auth_splay'] = 0
+            replies.append('')
+            self.assertFalse(self.minion._send_batch(returns))
+            self.assertNotEqual(self.minion._reauth_at, None)
+        finally:
+            salt.payload.SREQ = sreq
+
+    def test_reauth(self):
+        self.minion.opts['auth_splay'] = 10
+        self.minion.crypticle = FakeCrypticle('old')
+        signed_in = []
+
+        def authenticate():
+            signed_in.append(True)
+            self.minion.crypticle = FakeCrypticle('new')
+        self.minion.authenticate = authenticate
+        now = time.time()
+        # A publication sealed with a new key is held, the sign in is put
+        # off by up to auth_splay seconds without blocking the main loop
+        self.minion._handle_aes('new:pub1')
+        self.minion._handle_aes('new:pub2')
+        self.assertEqual(self.minion._held_pubs, ['new:pub1', 'new:pub2'])
+        self.assertTrue(now <= self.minion._reauth_at <= now + 10)
+        self.assertEqual(signed_in, [])
+        # Queued returns wait for the sign in
+        self.minion._return_queue.append({})
+        self.assertTrue(self.minion._poll_timeout(now) <= 10000)
+        self.assertFalse(self.minion._send_batch([{}]))
+        self.minion._check_reauth()
+        self.assertEqual(signed_in, [])
+        # Once the time has come the held publications are handled
+        handled = []
+        self.minion._handle_aes = handled.append
+        self.minion._held_pubs.append('newer:pub3')
+        self.minion._reauth_at = time.time() - 1
+        self.minion._check_reauth()
+        self.assertEqual(signed_in, [True])
+        self.assertEqual(handled, ['new:pub1', 'new:pub2'])
+        self.assertEqual(self.minion._reauth_at, None)
+        self.assertEqual(self.minion._held_pubs, [])
+
+    def test_backoff(self):
+        for attempt in range(12):
+            for _ in range(20):
+                delay = salt.utils.backoff(attempt, 5, 60)
+                self.assertTrue(0 <= delay <= min(60, 5 * 2 ** attempt))
+
+
+class FakeCrypticle(object):
+    '''
+    Decrypts only the loads sealed with its key
+    '''
+    def __init__(self, key):
+        self.key = key
+
+    def loads(self, load):
+        key, data = load.split(':', 1)
+        if key != self.key:
+            raise AuthenticationError('Invalid key')
+        return {'data': data}
+
+
+class PlainCrypticle(object):
+    '''
+    Passes the loads through as they are
+    '''
+    def dumps(self, load):
+        return load
+
+
+class FakeConn(object):
+    def __init__(self):
+        self.sent = []
+
+    def send(self, data):
+        self.sent.append(data)
+
+    def close(self):
+        pass
+
+
+class FakeJobPool(salt.minion.JobPool):
+    def spawn(self):
+        self.spawned += 1
+        proc = FakeProc(self.spawned)
+        self.workers['job-{0}'.format(self.spawned)] = {'proc': proc,
+                                                        'conn': FakeConn(),
+                                                        'jid': None,
+                                                        'start': 0,
+                                                        'stale': False}
+
+
+class FakeProc(object):
+    def __init__(self, pid):
+        self.pid = pid
+        self.alive = True
+
+    def is_alive(self):
+        return self.alive
+
+    def terminate(self):
+        self.alive = False
+
+    def join(self, timeout=None):
+        pass
+
+
+class JobPoolTest(TestCase):
+    def setUp(self):
+        super(JobPoolTest, self).setUp()
+        self.tmpdir = tempfile.mkdtemp()
+        self.minion = salt.minion.Minion.__new__(salt.minion.Minion)
+        self.minion.opts = {'job_pool_size': 1,
+                            'job_queue_size': 2,
+                            'job_timeout': 0,
+                            'job_priorities': {'test.*': 1, 'test.ping': 5}}
+        self.minion.serial = salt.payload.Serial('msgpack')
+        self.minion.proc_dir = self.tmpdir
+        self.returns = []
+        self.minion._queue_return = self.returns.append
+        self.pool = FakeJobPool(self.minion)
+
+    def tearDown(self):
+        shutil.rmtree(self.tmpdir)
+        super(JobPoolTest, self).tearDown()
+
+    def _submit(self, jid, fun):
+        self.pool.submit({'jid': jid, 'fun': fun, 'arg': [], 'ret': ''})
+
+    def test_queue(self):
+        conn = self.pool.workers['job-1']['conn']
+        self._submit('1', 'cmd.run')
+        self._submit('2', 'cmd.run')
+        self._submit('3', 'test.echo')
+        self._submit('4', 'test.ping')
+        self.assertEqual([data['jid'] for data in conn.sent], ['1'])
+        self.assertEqual(self.pool.jobs['1']['pid'], 1)
+        self.assertTrue(self.pool.jobs['2']['queued'])
+        # The queue is full
+        self.assertEqual(self.returns[0]['jid'], '4')
+        self.assertFalse('4' in self.pool.jobs)
+        self.assertTrue(os.path.isfile(os.path.join(self.tmpdir, '2')))
+        self.pool.done('job-1')
+        self.pool.done('job-1')
+        self.assertEqual([data['jid'] for data in conn.sent], ['1', '3', '2'])
+        # A queued job is cancelled by removing its proc file
+        self._submit('5', 'test.ping')
+        os.remove(os.path.join(self.tmpdir, '5'))
+        self.pool.done('job-1')
+        self.assertEqual(len(conn.sent), 3)
+        self.assertEqual(self.pool.jobs, {})
+
+    def test_maintain(self):
+        self.minion.opts['job_timeout'] = 60
+        self._submit('1', 'cmd.run')
+        self.pool.workers['job-1']['start'] -= 120
+        self.pool.maintain()
+        self.assertEqual(self.pool.workers.keys(), ['job-2'])
+        self.assertTrue('killed' in self.returns[0]['return'])
+        self.assertEqual(self.pool.jobs, {})
+        # A busy process is replaced after its job when refreshed
+        self._submit('2', 'cmd.run')
+        self.pool.refresh()
+        self.assertEqual(self.pool.workers.keys(), ['job-2'])
+        self.pool.done('job-2')
+        self.assertEqual(self.pool.workers.keys(), ['job-3'])
+        # The job processes are stopped with the minion
+        proc = self.pool.workers['job-3']['proc']
+        self.pool.stop()
+        self.assertFalse(proc.is_alive())
+        self.assertEqual(self.pool.workers, {})
+
+    def test_running(self):
+        self.minion.job_pool = self.pool
+        proc = FakeProc(100)
+        self.minion.jobs = {'1': (proc, {'pid': 100, 'jid': '1'})}
+        self._submit('2', 'cmd.run')
+        self._submit('3', 'cmd.run')
+        jids = sorted([data['jid'] for data in self.minion._running(200)])
+        self.assertEqual(jids, ['1', '2', '3'])
+        # The job asking is left out, and so are the finished ones
+        proc.alive = False
+        self.assertEqual(
+                [data['jid'] for data in self.minion._running(1)], ['3'])
+        socket = FakePull([self.minion.serial.dumps({'pid': 1})])
+        socket.sent = []
+        socket.send = socket.sent.append
+        self.minion._handle_jobs(socket)
+        self.assertEqual(
+                [data['jid'] for data in
+                 self.minion.serial.loads(socket.sent[0])], ['3'])
+
+
+if __name__ == "__main__":
+    loader = TestLoader()
+    tests = loader.loadTestsFromTestCase(TargetMatcherTest)
+    tests.addTests(loader.loadTestsFromTestCase(TopMatcherTest))
+    tests.addTests(loader.loadTestsFromTestCase(MainLoopTest))
+    tests.addTests(loader.loadTestsFromTestCase(JobPoolTest))
+    TextTestRunner(verbosity=1).run(tests)
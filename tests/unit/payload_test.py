@@ -0,0 +1,83 @@
+import os
+import shutil
+import tempfile
+import threading
+
+import zmq
+from saltunittest import TestCase, TestLoader, TextTestRunner
+
+import salt.payload
+from salt.exceptions import SaltReqTimeoutError
+
+
+class SREQTest(TestCase):
+    def setUp(self):
+        super(SREQTest, self).setUp()
+        self.tmpdir = tempfile.mkdtemp()
+        self.uri = 'ipc://{0}'.format(os.path.join(self.tmpdir, 'req.ipc'))
+        self.serial = salt.payload.Serial('msgpack')
+        self.context = zmq.Context()
+        self.rep = self.context.socket(zmq.REP)
+        self.rep.linger = 0
+        self.rep.bind(self.uri)
+
+    def tearDown(self):
+        self.rep.close()
+        self.context.term()
+        shutil.rmtree(self.tmpdir)
+        super(SREQTest, self).tearDown()
+
+    def _serve(self, count):
+        '''
+        Echo back the load of the next count requests
+        '''
+        def echo():
+            for _ in range(count):
+                payload = self.serial.loads(self.rep.recv())
+                self.rep.send(self.serial.dumps(payload['load']))
+        thread = threading.Thread(target=echo)
+        thread.start()
+        return thread
+
+    def test_reuse(self):
+        before = salt.payload.req_stats()
+        thread = self._serve(3)
+        for num in range(3):
+            sreq = salt.payload.SREQ(self.uri)
+            self.assertEqual(sreq.send('clear', {'num': num}), {'num': num})
+        thread.join()
+        after = salt.payload.req_stats()
+        self.assertEqual(after['created'] - before['created'], 1)
+        self.assertEqual(after['reused'] - before['reused'], 2)
+        self.assertEqual(after['in_flight'], 0)
+
+    def test_timeout(self):
+        before = salt.payload.req_stats()
+        sreq = salt.payload.SREQ(self.uri)
+        # Nobody answers, each try gets a new socket
+        self.assertRaises(
+                SaltReqTimeoutError, sreq.send, 'clear', {}, 2, 0.1)
+        after = salt.payload.req_stats()
+        self.assertEqual(after['timed_out'] - before['timed_out'], 2)
+        self.assertEqual(after['in_flight'], 0)
+
+
+class SerialTest(TestCase):
+    def test_loads_keys(self):
+        big = 'x' * (1024 * 1024)
+        for serial in ('msgpack', 'pickle'):
+            serial = salt.payload.Serial(serial)
+            package = serial.dumps({'enc': 'aes',
+                                    'load': big,
+                                    'cmd': '_return',
+                                    'extra': [{'a': 1}]})
+            self.assertEqual(serial.loads_keys(package, ('cmd', 'enc')),
+                             {'cmd': '_return', 'enc': 'aes'})
+            self.assertEqual(serial.loads_keys(package, ('missing',)), {})
+
+
+if __name__ == "__main__":
+    loader = TestLoader()
+    tests = loader.loadTestsFromTestCase(SREQTest)
+    tests.addTests(loader.loadTestsFromTestCase(SerialTest))
+    TextTestRunner(verbosity=1).run(tests)
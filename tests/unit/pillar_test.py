@@ -0,0 +1,99 @@
+import os
+import shutil
+import tempfile
+from saltunittest import TestCase, TestLoader, TextTestRunner
+
+import salt.config
+import salt.loader
+import salt.pillar
+
+
+class PillarTest(TestCase):
+    def setUp(self):
+        super(PillarTest, self).setUp()
+        self.tmpdir = tempfile.mkdtemp()
+        self.roots = os.path.join(self.tmpdir, 'pillar')
+        os.makedirs(self.roots)
+        self._write('top.sls', "base:\n  '*':\n    - data\n")
+        self._write('data.sls', 'foo: bar\n')
+        self.opts = salt.config.master_config(
+                os.path.join(self.tmpdir, 'master'))
+        self.opts['cachedir'] = os.path.join(self.tmpdir, 'cache')
+        self.opts['pillar_roots'] = {'base': [self.roots]}
+        self.opts['extension_modules'] = os.path.join(self.tmpdir, 'ext')
+        self.grains = salt.loader.grains(self.opts)
+        self.cache = salt.pillar.PillarCache(self.opts)
+
+    def tearDown(self):
+        shutil.rmtree(self.tmpdir)
+        super(PillarTest, self).tearDown()
+
+    def _write(self, path, data, mtime=None):
+        path = os.path.join(self.roots, path)
+        with open(path, 'w') as fp_:
+            fp_.write(data)
+        if mtime is not None:
+            os.utime(path, (mtime, mtime))
+
+    def test_cache(self):
+        self.assertEqual(self.cache.get('web1', self.grains), {'foo': 'bar'})
+        self.assertEqual(self.cache.get('web1', self.grains), {'foo': 'bar'})
+        self.assertEqual(self.cache.stats, {'hits': 1, 'misses': 1})
+        # Changing a pillar sls file invalidates the cached pillar
+        self._write('data.sls', 'foo: baz\n', 0)
+        self.assertEqual(self.cache.get('web1', self.grains), {'foo': 'baz'})
+        self.assertEqual(self.cache.stats, {'hits': 1, 'misses': 2})
+        self.assertEqual(self.cache.read_stats(), {'hits': 0, 'misses': 1})
+
+    def test_flush(self):
+        self.cache.get('web1', self.grains)
+        self.cache.get('web2', self.grains)
+        self.assertEqual(self.cache.flush('web1'), ['web1'])
+        self.assertEqual(self.cache.flush(), ['web2'])
+        self.assertEqual(self.cache.flush(), [])
+
+    def test_unsafe_id(self):
+        self.assertEqual(self.cache.get('../escape', self.grains),
+                         {'foo': 'bar'})
+        self.assertEqual(self.cache.get('../escape', self.grains),
+                         {'foo': 'bar'})
+        # The pillar of an id which is not a plain file name is not cached
+        self.assertFalse(os.path.exists(
+            os.path.join(self.opts['cachedir'], 'escape')))
+        self.assertEqual(self.cache.stats, {'hits': 0, 'misses': 0})
+        self.assertEqual(self.cache.flush('../escape'), [])
+
+    def test_reset(self):
+        self._write('top.sls',
+                    "base:\n  '*':\n    - data\n  'web2':\n    - web\n")
+        self._write('web.sls', "role: {{ grains['role'] }}\n")
+        pillar = salt.pillar.Pillar(self.opts, self.grains, 'web1', None)
+        self.assertEqual(pillar.compile_pillar(), {'foo': 'bar'})
+        functions = pillar.functions
+        grains = dict(self.grains, role='frontend')
+        pillar.reset(grains, 'web2')
+        self.assertEqual(pillar.compile_pillar(),
+                         {'foo': 'bar', 'role': 'frontend'})
+        self.assertTrue(pillar.functions is functions)
+
+    def test_top(self):
+        pillar = salt.pillar.Pillar(self.opts, self.grains, 'web1', None)
+        top, errors = pillar.get_top()
+        pillar.reset(self.grains, 'web2')
+        self.assertTrue(pillar.get_top()[0] is top)
+        self.assertTrue(os.path.join(self.roots, 'top.sls') in pillar.deps)
+        # Changing the top file renders it again
+        self._write('top.sls', "base:\n  'web2':\n    - data\n", 0)
+        self.assertEqual(pillar.top_matches(pillar.get_top()[0]),
+                         {'base': ['data']})
+        # A templated top file is rendered for every minion
+        self._write('top.sls',
+                    "base:\n  '{{ 'web' }}2':\n    - data\n")
+        self.assertEqual(pillar.get_top()[1], [])
+        self.assertEqual(pillar._top, None)
+
+
+if __name__ == "__main__":
+    loader = TestLoader()
+    tests = loader.loadTestsFromTestCase(PillarTest)
+    TextTestRunner(verbosity=1).run(tests)
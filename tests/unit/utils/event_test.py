@@ -0,0 +1,92 @@
+import os
+import time
+import shutil
+import threading
+import tempfile
+
+import zmq
+from saltunittest import TestCase, TestLoader, TextTestRunner
+
+import salt.payload
+from salt.utils.event import SaltEvent
+
+
+class TestSaltEvent(TestCase):
+
+    def setUp(self):
+        super(TestSaltEvent, self).setUp()
+        self.tmpdir = tempfile.mkdtemp()
+        self.serial = salt.payload.Serial('msgpack')
+        self.context = zmq.Context()
+        self.pub = self.context.socket(zmq.PUB)
+        self.pub.linger = 0
+        self.pub.bind('ipc://{0}'.format(
+            os.path.join(self.tmpdir, 'master_event_pub.ipc')))
+        self.event = SaltEvent(self.tmpdir, 'master')
+
+    def tearDown(self):
+        self.event.sub.close()
+        self.pub.close()
+        self.context.term()
+        shutil.rmtree(self.tmpdir)
+        super(TestSaltEvent, self).tearDown()
+
+    def _fire(self, tag, data):
+        self.pub.send('{0}{1}'.format(
+            (tag + 20 * '|')[:20], self.serial.dumps(data)))
+
+    def _subscribe(self, *tags):
+        for tag in tags:
+            self.event.subscribe(tag)
+        # Give the subscriptions time to reach the publisher
+        time.sleep(0.2)
+
+    def test_pending(self):
+        self._subscribe('jid1', 'jid2')
+        self._fire('jid2', {'id': 'web2'})
+        self._fire('other', {'id': 'web3'})
+        self._fire('jid1', {'id': 'web1'})
+        # The event of the other job is held until it is asked for
+        self.assertEqual(self.event.get_event(1000, 'jid1'), {'id': 'web1'})
+        self.assertEqual(len(self.event.pending), 1)
+        self.assertEqual(self.event.get_event(1000, 'jid2', full=True),
+                         {'tag': 'jid2', 'data': {'id': 'web2'}})
+        self.assertEqual(self.event.pending, [])
+
+    def test_wait(self):
+        self._subscribe('jid1', 'jid2')
+
+        def fire():
+            for _ in range(20):
+                self._fire('jid2', {'id': 'web2'})
+                time.sleep(0.05)
+        thread = threading.Thread(target=fire)
+        thread.start()
+        start = time.time()
+        # The events of the other job do not put off the timeout
+        self.assertEqual(self.event.get_event(300, 'jid1'), None)
+        self.assertTrue(time.time() - start < 0.8)
+        thread.join()
+
+    def test_unsubscribe(self):
+        self._subscribe('jid1', 'jid2', 'jid3')
+        self._fire('jid2', {'id': 'web2'})
+        self._fire('jid3', {'id': 'web3'})
+        self._fire('jid1', {'id': 'web1'})
+        self.assertEqual(self.event.get_event(1000, 'jid1'), {'id': 'web1'})
+        # The events held for a job are dropped with its subscription, the
+        # events of the other jobs are kept
+        self.event.unsubscribe('jid2')
+        self.assertEqual(self.event.pending,
+                         [{'tag': 'jid3', 'data': {'id': 'web3'}}])
+        self.event.unsubscribe('jid3')
+        self.assertEqual(self.event.pending, [])
+        self.assertEqual(self.event.subscriptions, set(['jid1']))
+        self.event.unsubscribe('jid1')
+        self.assertEqual(self.event.subscriptions, set())
+
+
+if __name__ == "__main__":
+    loader = TestLoader()
+    tests = loader.loadTestsFromTestCase(TestSaltEvent)
+    TextTestRunner(verbosity=1).run(tests)
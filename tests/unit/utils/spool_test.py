@@ -0,0 +1,84 @@
+import os
+import shutil
+import tempfile
+
+from saltunittest import TestCase, TestLoader, TextTestRunner
+
+from salt.utils.spool import Spool
+
+
+class TestSpool(TestCase):
+
+    def setUp(self):
+        super(TestSpool, self).setUp()
+        self.tmpdir = tempfile.mkdtemp()
+        self.spool = Spool({'serial': 'msgpack'},
+                           os.path.join(self.tmpdir, 'spool'))
+
+    def tearDown(self):
+        shutil.rmtree(self.tmpdir)
+        super(TestSpool, self).tearDown()
+
+    def test_empty(self):
+        self.assertEqual(self.spool.peek(10), [])
+        self.assertEqual(self.spool.depth(), 0)
+
+    def test_append_consume(self):
+        self.spool.append([{'jid': str(num)} for num in range(5)])
+        self.spool.append([{'jid': '5'}])
+        self.assertEqual(self.spool.depth(), 6)
+        self.assertEqual(self.spool.peek(2), [{'jid': '0'}, {'jid': '1'}])
+        self.spool.consume(2)
+        self.assertEqual(self.spool.depth(), 4)
+        self.assertEqual(self.spool.peek(1), [{'jid': '2'}])
+        self.spool.consume(4)
+        self.assertEqual(self.spool.depth(), 0)
+        # A fully consumed log is started over
+        self.assertEqual(os.path.getsize(self.spool.log_path), 0)
+
+    def test_torn_record(self):
+        self.spool.append([{'jid': '0'}])
+        with open(self.spool.log_path, 'ab') as fp_:
+            fp_.write('\x00\x00\x00\x10abc')
+        self.assertEqual(self.spool.depth(), 1)
+        self.assertEqual(self.spool.peek(5), [{'jid': '0'}])
+        # Records appended after the tear are read back
+        self.spool.append([{'jid': '1'}, {'jid': '2'}])
+        self.assertEqual(self.spool.depth(), 3)
+        self.assertEqual(self.spool.peek(5),
+                         [{'jid': '0'}, {'jid': '1'}, {'jid': '2'}])
+        self.spool.consume(3)
+        self.assertEqual(os.path.getsize(self.spool.log_path), 0)
+
+    def test_append_end(self):
+        self.spool.append([{'jid': str(num)} for num in range(5)])
+        end = os.path.getsize(self.spool.log_path)
+        starts = []
+        tail = self.spool._tail
+        self.spool._tail = lambda fp_, pos: starts.append(pos) or \
+                tail(fp_, pos)
+        self.spool.append([{'jid': '5'}])
+        # The records written before are not walked again
+        self.assertEqual(starts, [end])
+        self.assertEqual(self.spool.depth(), 6)
+
+    def test_corrupt_record(self):
+        self.spool.append([{'jid': '0'}])
+        with open(self.spool.log_path, 'ab') as fp_:
+            fp_.write('\x00\x00\x00\x02\xc1\xc1')
+        self.spool.append([{'jid': '2'}])
+        # The records before the corrupt one are handed out first
+        self.assertEqual(self.spool.peek(5), [{'jid': '0'}])
+        self.spool.consume(1)
+        self.assertEqual(self.spool.peek(5), [{'jid': '2'}])
+        with open(self.spool.bad_path, 'rb') as fp_:
+            self.assertEqual(fp_.read(), '\x00\x00\x00\x02\xc1\xc1')
+        self.assertEqual(self.spool.depth(), 1)
+        self.spool.consume(1)
+        self.assertEqual(self.spool.peek(5), [])
+
+
+if __name__ == "__main__":
+    loader = TestLoader()
+    tests = loader.loadTestsFromTestCase(TestSpool)
+    TextTestRunner(verbosity=1).run(tests)
@@ -9,6 +9,7 @@ from saltunittest import skipIf, TestCase
 
 from salt.utils.verify import (
     check_user,
+    valid_id,
     verify_env,
     verify_socket,
     zmq_version,
@@ -47,5 +48,11 @@ class TestVerify(TestCase):
         self.assertEqual(dir_stat.st_mode & stat.S_IRWXG, 0)
         self.assertEqual(dir_stat.st_mode & stat.S_IRWXO, 0)
 
+    def test_valid_id(self):
+        self.assertTrue(valid_id('web1.example.com'))
+        for id_ in ('', '.', '..', '.hidden', '../../etc', 'a/b', 'a..b',
+                    'a\0b', None):
+            self.assertFalse(valid_id(id_))
+
     def test_verify_socket(self):
         self.assertTrue(verify_socket('', 18000, 18001))